@@ -0,0 +1,47 @@
+import io
+import tempfile
+import numpy as np
+import soundfile as sf
+import soxr
+from config import VOICE_SAMPLE_RATE, VOICE_FORMAT, VOICE_SUBTYPE
+
+
+def decode(data: bytes):
+    """
+    Decode audio bytes to a mono float32 signal.
+
+    libsndfile handles OGG/Opus, WAV, FLAC and MP3 straight from memory. Other
+    containers fall back to librosa/audioread, which needs a file on disk, so
+    a private temporary file is used.
+
+    Returns:
+        Tuple[np.ndarray, int]: The signal and its sample rate.
+    """
+    try:
+        y, sr = sf.read(io.BytesIO(data), dtype="float32", always_2d=True)
+        return y.mean(axis=1), sr
+    except sf.LibsndfileError:
+        import librosa
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            return librosa.load(f.name, sr=None, mono=True)
+
+
+def transcode_for_whisper(data: bytes) -> bytes:
+    """
+    Downmix to mono, resample to VOICE_SAMPLE_RATE and encode compactly for Whisper.
+    CPU bound, meant to run in the process pool.
+
+    Args:
+        data (bytes): The downloaded voice message.
+
+    Returns:
+        bytes: The encoded audio (OGG/Opus by default).
+    """
+    y, sr = decode(data)
+    if sr != VOICE_SAMPLE_RATE:
+        y = soxr.resample(y, sr, VOICE_SAMPLE_RATE)
+    out = io.BytesIO()
+    sf.write(out, np.clip(y, -1.0, 1.0), VOICE_SAMPLE_RATE, format=VOICE_FORMAT, subtype=VOICE_SUBTYPE)
+    return out.getvalue()
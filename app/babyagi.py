@@ -1,14 +1,23 @@
 import os
-import openai
-import pinecone
 import time
-import sys
-from collections import deque
-from typing import Dict, List
+import openai
+import uuid
+import asyncio
+from collections import Counter, defaultdict, deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
 from dotenv import load_dotenv
-from twilio.rest import Client
-from twilio.base.exceptions import TwilioException
-from config import BABYAGI, ACCOUNT_SID, AUTH_TOKEN, TWILIO_WHATSAPP_NUMBER, FACEBOOK_PAGE_ID
+from config import (BABYAGI, TWILIO_WHATSAPP_NUMBER, FACEBOOK_PAGE_ID, BABYAGI_CONCURRENCY, BABYAGI_MAX_STEPS,
+                    BABYAGI_MAX_TOKENS, BABYAGI_MAX_TASKS, BABYAGI_VECTOR_STORE, BABYAGI_VECTOR_PATH)
+from executor import run_sync
+from twilio_sender import send_message as queue_twilio_message
+from telegram_sender import send_message as queue_telegram_message, TelegramReplyStream
+from embeddings import service as embedding_service
+from models import model_tiers
+from langchain.prompts.base import StringPromptValue
+from shared_state import backend as shared_state
+import metrics
+import tracing
+from result_store import LocalResultStore, PineconeResultStore
 
 if BABYAGI:
   # Load environment variables
@@ -20,82 +29,132 @@ if BABYAGI:
   PINECONE_ENVIRONMENT = os.getenv("PINECONE_ENVIRONMENT", "us-east1-gcp")
   YOUR_TABLE_NAME = os.getenv("TABLE_NAME", "")
   YOUR_FIRST_TASK = os.getenv("FIRST_TASK", "")
-  USE_GPT4 = os.getenv("USE_GPT4", True)
   
   # Ensure required variables are set
   if not OPENAI_API_KEY:
       print("OPENAI_API_KEY environment variable is missing from .env")
-  if not YOUR_TABLE_NAME:
+  if not YOUR_TABLE_NAME and BABYAGI_VECTOR_STORE == 'pinecone':
       print("TABLE_NAME environment variable is missing from .env")
   if not YOUR_FIRST_TASK:
       print("FIRST_TASK environment variable is missing from .env")
   
-  # Configure OpenAI and Pinecone
+  # Configure OpenAI
   openai.api_key = OPENAI_API_KEY
-  if PINECONE_API_KEY:
-      pinecone.init(api_key=PINECONE_API_KEY, environment=PINECONE_ENVIRONMENT)
-  
-  # Create Pinecone index if PINECONE_API_KEY is set
-  if PINECONE_API_KEY and YOUR_TABLE_NAME not in pinecone.list_indexes():
-      pinecone.create_index(YOUR_TABLE_NAME, dimension=1536, metric="cosine", pod_type="p1")
-  
-  # Connect to the index if PINECONE_API_KEY is set
-  if PINECONE_API_KEY:
-      index = pinecone.Index(YOUR_TABLE_NAME)
-  
-  # Task list
-  task_list = deque([])
-  
+
+
+# Where completed task results are stored for the context of later tasks,
+# created on first use, see get_result_store
+result_store = None
+
+
+def get_result_store():
+    global result_store
+    if result_store is None:
+        if BABYAGI_VECTOR_STORE == 'pinecone':
+            result_store = PineconeResultStore(YOUR_TABLE_NAME, PINECONE_API_KEY, PINECONE_ENVIRONMENT)
+        elif BABYAGI_VECTOR_STORE == 'local':
+            result_store = LocalResultStore(BABYAGI_VECTOR_PATH)
+        else:
+            raise ValueError(f"Invalid BABYAGI_VECTOR_STORE: {BABYAGI_VECTOR_STORE}")
+    return result_store
+
+class Objective:
+    """
+    State of one /task run: its own task list, completed results and budget.
+
+    Runs of different chats, or several runs of one chat, never share state.
+    """
+
+    def __init__(self, objective: str, chat_id: str, platform: str, first_task: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.started = time.time()
+        self.objective = objective
+        self.chat_id = chat_id
+        self.platform = platform
+        self.task_list: Deque[Dict] = deque([{"task_id": 1, "task_name": first_task}])
+        self.completed: List[Tuple[Dict, str]] = []
+        self.task_id_counter = 1
+        self.steps = 0
+        # Tokens used by all model calls of this objective
+        self.usage = Counter({"total_tokens": 0})
+        self.status = StatusMessage(chat_id, platform)
+
+    def over_budget(self) -> Optional[str]:
+        """ Why the objective has to stop, None while it is within its step and token budget """
+        if self.steps >= BABYAGI_MAX_STEPS:
+            return f"step budget of {BABYAGI_MAX_STEPS} used up"
+        if self.usage["total_tokens"] >= BABYAGI_MAX_TOKENS:
+            return f"token budget of {BABYAGI_MAX_TOKENS} used up"
+        return None
+
+    def status_text(self, running: List[Dict] = (), note: str = "") -> str:
+        lines = [f"Objective: {self.objective}",
+                 f"Steps: {self.steps}/{BABYAGI_MAX_STEPS}, tokens: {self.usage['total_tokens']}/{BABYAGI_MAX_TOKENS}", ""]
+        lines += [f"[done] {task['task_id']}: {task['task_name']}" for task, _ in self.completed]
+        lines += [f"[running] {task['task_id']}: {task['task_name']}" for task in running]
+        lines += [f"[todo] {task['task_id']}: {task['task_name']}" for task in self.task_list]
+        if note:
+            lines += ["", note]
+        return "\n".join(lines)
+
+    def report(self) -> str:
+        return "\n\n".join(f"{task['task_id']}: {task['task_name']}\n{result}" for task, result in self.completed)
+
+
+class StatusMessage:
+    """
+    A single progress message per objective. On Telegram it is edited in
+    place, on WhatsApp/Messenger (no edits) it is sent once per round.
+    """
+
+    def __init__(self, chat_id: str, platform: str):
+        self.chat_id = chat_id
+        self.platform = platform
+        self.stream = TelegramReplyStream(chat_id) if platform == 'telegram' else None
+
+    async def update(self, text: str):
+        if self.stream is not None:
+            await self.stream.on_text(text)
+        else:
+            await send_message(self.chat_id, text, self.platform)
+
+    async def finish(self, text: str):
+        if self.stream is None or not await self.stream.finish(text):
+            await send_message(self.chat_id, text, self.platform)
+
+
 # Functions
-def add_task(task: Dict):
-    task_list.append(task)
-
-def get_ada_embedding(text: str) -> List[float]:
-    text = text.replace("\n", " ")
-    return openai.Embedding.create(input=[text], model="text-embedding-ada-002")["data"][0]["embedding"]
-
-def openai_call(prompt: str, use_gpt4: bool = False, temperature: float = 0.5, max_tokens: int = 100):
-    if not use_gpt4:
-        # Call GPT-3 DaVinci model
-        response = openai.Completion.create(
-            engine='text-davinci-003',
-            prompt=prompt,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
-        return response.choices[0].text.strip()
-    else:
-        # Call GPT-4 chat model
-        messages = [{"role": "user", "content": prompt}]
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            n=1,
-            stop=None,
-        )
-        return response.choices[0].message.content.strip()
-
-def task_creation_agent(objective: str, result: Dict, task_description: str, task_list: List[str], gpt_version: str = 'gpt-3'):
-    prompt = f"You are an task creation AI that uses the result of an execution agent to create new tasks with the following objective: {objective}, The last completed task has the result: {result}. This result was based on this task description: {task_description}. These are incomplete tasks: {', '.join(task_list)}. Based on the result, create new tasks to be completed by the AI system that do not overlap with incomplete tasks. Return the tasks as an array."
-    response = openai_call(prompt, USE_GPT4)
+async def get_ada_embedding(text: str) -> List[float]:
+    return await embedding_service.aembed_query(text)
+
+async def openai_call(prompt: str, stage: str = 'babyagi_plan', temperature: float = 0.5, max_tokens: int = 100,
+                      usage: Counter = None):
+    """ Run a prompt on the models of a stage, see config.MODEL_STAGES """
+    result = await model_tiers.call(
+        stage,
+        lambda llm: llm.agenerate_prompt([StringPromptValue(text=prompt)]),
+        temperature=temperature,
+        max_tokens=max_tokens,
+    )
+    if usage is not None and result.llm_output:
+        usage["total_tokens"] += result.llm_output.get("token_usage", {}).get("total_tokens", 0)
+    return result.generations[0][0].text.strip()
+
+async def task_creation_agent(run: Objective, result: Dict, task_description: str, task_list: List[str], gpt_version: str = 'gpt-3'):
+    prompt = f"You are an task creation AI that uses the result of an execution agent to create new tasks with the following objective: {run.objective}, The last completed task has the result: {result}. This result was based on this task description: {task_description}. These are incomplete tasks: {', '.join(task_list)}. Based on the result, create new tasks to be completed by the AI system that do not overlap with incomplete tasks. Return the tasks as an array."
+    response = await openai_call(prompt, 'babyagi_plan', usage=run.usage)
     new_tasks = response.split('\n')
-    return [{"task_name": task_name} for task_name in new_tasks]
+    return [{"task_name": task_name} for task_name in new_tasks if task_name.strip()]
 
 
-def prioritization_agent(this_task_id: int, objective, gpt_version: str = 'gpt-3'):
-    global task_list
-    task_names = [t["task_name"] for t in task_list]
+async def prioritization_agent(run: Objective, this_task_id: int, gpt_version: str = 'gpt-3'):
+    task_names = [t["task_name"] for t in run.task_list]
     next_task_id = int(this_task_id)+1
-    prompt = f"""You are an task prioritization AI tasked with cleaning the formatting of and reprioritizing the following tasks: {task_names}. Consider the ultimate objective of your team:{objective}. Do not remove any tasks. Return the result as a numbered list, like:
+    prompt = f"""You are an task prioritization AI tasked with cleaning the formatting of and reprioritizing the following tasks: {task_names}. Consider the ultimate objective of your team:{run.objective}. Do not remove any tasks. Return the result as a numbered list, like:
     #. First task
     #. Second task
     Start the task list with number {next_task_id}."""
-    response = openai_call(prompt, USE_GPT4)
+    response = await openai_call(prompt, 'babyagi_plan', usage=run.usage)
     new_tasks = response.split('\n')
     task_list = deque()
     for task_string in new_tasks:
@@ -104,102 +163,194 @@ def prioritization_agent(this_task_id: int, objective, gpt_version: str = 'gpt-3
             task_id = task_parts[0].strip()
             task_name = task_parts[1].strip()
             task_list.append({"task_id": task_id, "task_name": task_name})
+    run.task_list = task_list
 
 
-def execution_agent(objective: str, task: str, gpt_version: str = 'gpt-3') -> str:
-    #context = context_agent(index="quickstart", query="my_search_query", n=5)
-    context = context_agent(index=YOUR_TABLE_NAME, query=objective, n=5)
-    #print("\n*******RELEVANT CONTEXT******\n")
-    # print(context)
-    prompt = f"You are an AI who performs one task based on the following objective: {objective}.\nTake into account these previously completed tasks: {context}\nYour task: {task}\nResponse:"
-    return openai_call(prompt, USE_GPT4, 0.7, 2000)
+async def execution_agent(run: Objective, task: str, gpt_version: str = 'gpt-3') -> str:
+    with tracing.span("babyagi_execute", task=task[:100]):
+        context = await context_agent(run, query=run.objective, n=5)
+        #print("\n*******RELEVANT CONTEXT******\n")
+        # print(context)
+        prompt = f"You are an AI who performs one task based on the following objective: {run.objective}.\nTake into account these previously completed tasks: {context}\nYour task: {task}\nResponse:"
+        return await openai_call(prompt, 'babyagi_exec', 0.7, 2000, usage=run.usage)
 
 
-def context_agent(query: str, index: str, n: int):
-    query_embedding = get_ada_embedding(query)
-    index = pinecone.Index(index_name=index)
-    results = index.query(query_embedding, top_k=n,
-                          include_metadata=True)
+async def context_agent(run: Objective, query: str, n: int):
+    query_embedding = await get_ada_embedding(query)
+    # Only results of this objective are relevant
+    with metrics.timed("babyagi_context"):
+        results = await get_result_store().query(query_embedding, n, run.id)
     #print("***** RESULTS *****")
     # print(results)
     sorted_results = sorted(
-        results.matches, key=lambda x: x.score, reverse=True)
+        results, key=lambda x: x.score, reverse=True)
     return [(str(item.metadata['task'])) for item in sorted_results]
 
-async def send_message(chat_id: str, message: str, platform: str, client=None, base_url=None):
+async def store_results(run: Objective, completed: List[Tuple[Dict, str]]):
+    """ Embed the results of a round in one request and upsert them in one batch """
+    embeddings = await embedding_service.aembed_documents([result for _, result in completed])
+    with metrics.timed("babyagi_store"):
+        await get_result_store().upsert([
+            (f"{run.id}_result_{task['task_id']}", embedding,
+             {"objective_id": run.id, "task": task['task_name'], "result": result})
+            for (task, result), embedding in zip(completed, embeddings)])
+
+async def send_message(chat_id: str, message: str, platform: str):
     if platform == 'telegram':
-        await client.get(f"{base_url}/sendMessage?chat_id={chat_id}&text={message}")
-    elif platform == 'twilio':
-        await send_twilio_message(chat_id, message)
-
-async def process_task(objective: str, chat_id: str, platform='telegram', client=None, base_url=None):
-    first_task = {
-        "task_id": 1,
-        "task_name": YOUR_FIRST_TASK
-    }
-
-    add_task(first_task)
-
-    task_id_counter = 1
-    while True:
-        if task_list:
-            # Print the task list
-            print("\033[95m\033[1m" + "\n*****TASK LIST*****\n" + "\033[0m\033[0m")
-            temp = ""
-            for t in task_list:
-                tsk = str(t['task_id']) + ": " + t['task_name']
-                print(tsk)
-                temp = temp + tsk + "\n"
-
-            await send_message(chat_id, temp, platform, client, base_url)
-
-            # Step 1: Pull the first task
-            task = task_list.popleft()
-            print("\033[92m\033[1m" + "\n*****NEXT TASK*****\n" + "\033[0m\033[0m")
-            next_tsk = str(task['task_id']) + ": " + task['task_name']
-            print(next_tsk)
-
-            await send_message(chat_id, next_tsk, platform, client, base_url)
-
-            # Send to execution function to complete the task based on the context
-            result = execution_agent(objective, task["task_name"])
-            this_task_id = int(task["task_id"])
-            print("\033[93m\033[1m" + "\n*****TASK RESULT*****\n" + "\033[0m\033[0m")
-            print(result)
-
-            await send_message(chat_id, result, platform, client, base_url)
-
-            # Step 2: Enrich result and store in Pinecone
-            # This is where you should enrich the result if needed
-            enriched_result = {'data': result}
-            result_id = f"result_{task['task_id']}"
-            # extract the actual result from the dictionary
-            vector = enriched_result['data']
-            index.upsert([(result_id, get_ada_embedding(vector), {
-                "task": task['task_name'], "result": result})])
-
-        # Step 3: Create new tasks and reprioritize task list
-        if task_id_counter < 6:
-            print(f"tt: {task_id_counter}")
-            new_tasks = task_creation_agent(objective, enriched_result, task["task_name"], [
-                                            t["task_name"] for t in task_list])
-
-            for new_task in new_tasks:
-                task_id_counter += 1
-                new_task.update({"task_id": task_id_counter})
-                add_task(new_task)
-            prioritization_agent(this_task_id, objective)
-        if len(task_list) < 1:
-            print("Tasks completed")
-            await send_message(chat_id, "\n\nTask completed", platform, client, base_url)
+        queue_telegram_message(chat_id, message)
+    else:
+        # WhatsApp or Messenger, each is sent from its own Twilio address
+        await send_twilio_message(chat_id, message, platform)
+
+async def run_objective(run: Objective, concurrency: int = BABYAGI_CONCURRENCY):
+    """
+    Work on an objective until its task list is empty or its budget is used up.
+
+    Each round executes up to `concurrency` tasks from the front of the
+    prioritized list at the same time, then creates follow-up tasks for all
+    results concurrently and reprioritizes the list once.
+    """
+    note = "Task completed"
+    while run.task_list:
+        stop = run.over_budget()
+        if stop:
+            note = f"Stopped: {stop}"
             break
+        # /cancel may have been handled by another worker, see cancel_tasks
+        cancelled = await shared_state.get(CANCELLED, run.chat_id)
+        if cancelled is not None and cancelled >= run.started:
+            raise asyncio.CancelledError()
 
+        # Step 1: Pull the next tasks
+        batch = [run.task_list.popleft() for _ in range(min(concurrency, len(run.task_list)))]
+        with tracing.span("babyagi_step", tasks=[task["task_id"] for task in batch]):
+            await run.status.update(run.status_text(running=batch))
 
-async def send_twilio_message(chat_id: str, message: str, platform: str = "whatsapp"):
-    account_sid = ACCOUNT_SID
-    auth_token = AUTH_TOKEN
-    client = Client(account_sid, auth_token)
+            # Send to execution function to complete the tasks based on the context
+            results = await asyncio.gather(*(execution_agent(run, task["task_name"]) for task in batch))
+            run.steps += len(batch)
+            completed = list(zip(batch, results))
+            run.completed += completed
+            for task, result in completed:
+                print(f"*****TASK RESULT {run.id} {task['task_id']}*****\n{result}")
+
+            # Step 2: Store the results for the context of later tasks
+            await store_results(run, completed)
+
+            # Step 3: Create new tasks and reprioritize task list
+            if run.task_id_counter < BABYAGI_MAX_TASKS:
+                incomplete = [t["task_name"] for t in run.task_list]
+                with tracing.span("babyagi_create_tasks"):
+                    new_task_lists = await asyncio.gather(*(
+                        task_creation_agent(run, {"data": result}, task["task_name"], incomplete)
+                        for task, result in completed))
+                for new_tasks in new_task_lists:
+                    for new_task in new_tasks:
+                        run.task_id_counter += 1
+                        new_task.update({"task_id": run.task_id_counter})
+                        run.task_list.append(new_task)
+                with tracing.span("babyagi_prioritize"):
+                    await prioritization_agent(run, max(int(task["task_id"]) for task in batch))
+
+    print(f"Objective {run.id}: {note}")
+    await run.status.finish(run.status_text(note=note))
+    if run.completed:
+        await send_message(run.chat_id, run.report(), run.platform)
+
+
+# Shared state namespaces: the objectives running for a chat in any worker
+# ({objective id: worker pid}), and when /cancel was last sent in a chat
+RUNNING = "babyagi_running"
+CANCELLED = "babyagi_cancelled"
+
+
+class TaskEngine:
+    """ Runs BabyAGI objectives in the background, any number per chat, each with its own state """
+
+    def __init__(self):
+        self.runs: Dict[str, Set[asyncio.Task]] = defaultdict(set)
+
+    def start(self, objective: str, chat_id: str, platform: str) -> Objective:
+        run = Objective(objective, chat_id, platform, YOUR_FIRST_TASK)
+        key = str(chat_id)
+        task = asyncio.create_task(self._run(run))
+        self.runs[key].add(task)
+        task.add_done_callback(lambda task: self._forget(key, task))
+        return run
+
+    def _forget(self, key: str, task: asyncio.Task):
+        self.runs[key].discard(task)
+        if not self.runs[key]:
+            del self.runs[key]
+
+    async def _run(self, run: Objective):
+        await self._register(run, True)
+        # Its own trace, with the ID of the message that started it
+        try:
+            with tracing.trace("babyagi", tracing.current_trace_id.get(), objective_id=run.id):
+                await run_objective(run)
+        except asyncio.CancelledError:
+            await run.status.finish(run.status_text(note="Cancelled"))
+            raise
+        except Exception as e:
+            print(f"Objective {run.id} failed: {e}")
+            await run.status.finish(run.status_text(note=f"Failed: {e}"))
+        finally:
+            await asyncio.shield(self._register(run, False))
 
+    async def _register(self, run: Objective, running: bool):
+        """ Add or remove an objective in the shared list of the chat's running objectives """
+        key = str(run.chat_id)
+        async with shared_state.lock(f"{RUNNING}:{key}"):
+            runs = await shared_state.get(RUNNING, key) or {}
+            if running:
+                runs[run.id] = os.getpid()
+            else:
+                runs.pop(run.id, None)
+            if runs:
+                await shared_state.set(RUNNING, key, runs)
+            else:
+                await shared_state.delete(RUNNING, key)
+
+    def cancel(self, chat_id: str) -> int:
+        """ Cancel all objectives of a chat, returns how many were running """
+        tasks = self.runs.get(str(chat_id), set())
+        for task in tasks:
+            task.cancel()
+        return len(tasks)
+
+
+task_engine = TaskEngine()
+
+
+async def process_task(objective: str, chat_id: str, platform='telegram') -> Objective:
+    """
+    Start working on an objective in the background, progress is reported in the chat.
+
+    Args:
+        objective (str): The objective.
+        chat_id (str): Chat that started the objective.
+        platform (str): 'telegram', 'whatsapp' or 'messenger'.
+
+    Returns:
+        Objective: The state of the new run.
+    """
+    return task_engine.start(objective, chat_id, platform)
+
+
+async def cancel_tasks(chat_id: str) -> int:
+    """
+    Cancel the objectives running for a chat, returns how many were cancelled.
+
+    Objectives of this worker stop right away, those of other workers before
+    their next step.
+    """
+    await shared_state.set(CANCELLED, chat_id, time.time())
+    running = await shared_state.get(RUNNING, chat_id) or {}
+    return max(task_engine.cancel(chat_id), len(running))
+
+
+async def send_twilio_message(chat_id: str, message: str, platform: str = "whatsapp"):
     if platform not in ("whatsapp", "messenger"):
         raise ValueError("Invalid platform specified. Valid platforms are 'whatsapp' and 'messenger'.")
 
@@ -215,11 +366,5 @@ async def send_twilio_message(chat_id: str, message: str, platform: str = "whats
     else:
         twilio_phone_number = f'whatsapp:{TWILIO_WHATSAPP_NUMBER}'
 
-    try:
-        client.messages.create(
-            body=message,
-            from_=twilio_phone_number,
-            to=chat_id
-        )
-    except TwilioException as e:
-        print(f"Error sending message: {e}")
\ No newline at end of file
+    # Queued, so task updates arrive in order without blocking the agent loop
+    queue_twilio_message(chat_id, twilio_phone_number, message)
@@ -1,38 +1,150 @@
-from typing import Dict, Union, Tuple
+import asyncio
+from collections import Counter
+from typing import Dict, Optional, Union, Tuple
 from models import initialize_language_model
 from templates import get_template
-from config import SELECTED_MODEL
-from utils import get_topic, process_chat, process_image, process_calendar
+from config import SELECTED_MODEL, SPECULATIVE_CHAT, CHAT_WORKERS, CHAT_QUEUE_MAX, CHAT_QUEUE_OVERFLOW, BOT_NAME
+from utils import (topic_router, generate_chat, commit_chat, process_chat, process_image, process_calendar,
+                   sync_chat_session)
+from shared_state import backend as shared_state
+from scheduler import ChatScheduler, MailboxFull
+from streaming import stream_reply
+from resilience import DependencyError
+from job_queue import queue as job_queue
+import metrics
+import tracing
 
-# Initialize a dictionary to keep track of the last message for each user
-last_messages: Dict[int, str] = {}
+# The last 3 messages of each chat are kept in the shared state under this
+# namespace, so every worker sees the same history. Only updated while
+# holding the chat's lock, see answer_chat_message.
+LAST_MESSAGES = "last_messages"
 
-async def process_chat_message(text: str, chat_id: int) -> Union[str, Tuple[str, str]]:
+# Outcome of speculative chat generations: "hits" were used, "wasted" were thrown away
+speculation_stats = Counter({"hits": 0, "wasted": 0})
+
+
+def speculation_rates() -> Dict[str, float]:
+    """
+    Hit and waste rate of speculative chat generation.
+
+    Returns:
+        Dict[str, float]: {"hit_rate": ..., "waste_rate": ...}, both 0 before the first speculation.
+    """
+    total = speculation_stats["hits"] + speculation_stats["wasted"]
+    if not total:
+        return {"hit_rate": 0.0, "waste_rate": 0.0}
+    return {"hit_rate": speculation_stats["hits"] / total, "waste_rate": speculation_stats["wasted"] / total}
+
+
+async def speculate_chat(chat_id: int, text: str) -> Tuple[Dict, str]:
+    """ generate_chat without streaming, nothing is shown to the user before the topic is known """
+    with stream_reply(None):
+        return await generate_chat(chat_id, text)
+
+
+def discard_speculation(speculation: asyncio.Task):
+    """ Drop an unused speculative reply. It never touched memory, cancelling it is enough. """
+    speculation.cancel()
+    # It may have failed already, don't warn about an unretrieved exception
+    speculation.add_done_callback(lambda task: task.cancelled() or task.exception())
+    speculation_stats["wasted"] += 1
+
+
+async def process_chat_message(text: str, chat_id: int) -> Optional[Union[str, Tuple[str, str]]]:
+    """
+    Queue an incoming chat message and wait for its response.
+
+    Messages of a chat are answered one at a time, in order, see chat_scheduler.
+
+    Args:
+        text (str): Input text message.
+        chat_id (int): Unique identifier for the chat.
+    Returns:
+        The response (see answer_chat_message), or None if the message was
+        merged into a later one or dropped. The caller should not reply then.
+    """
+    with tracing.span("process_chat_message", chat_id=chat_id):
+        try:
+            return await chat_scheduler.run(chat_id, text)
+        except MailboxFull:
+            return f"{BOT_NAME}: I'm still working on your previous messages, please try again in a moment."
+        except DependencyError as e:
+            print(f"Could not answer chat {chat_id}: {e}")
+            return f"{BOT_NAME}: {e.message}"
+
+
+async def answer_chat_message(text: str, chat_id: int) -> Union[str, Tuple[str, str]]:
     """
     Process an incoming chat message and generate an appropriate response.
+
+    Runs while holding the chat's lock in the shared state, so when several
+    workers serve the app only one of them answers a chat at a time, with the
+    chat's latest memory.
+
     Args:
         text (str): Input text message.
         chat_id (int): Unique identifier for the chat.
     Returns:
         Union[str, Tuple[str, str]]: The generated response as a string, or a tuple containing a string and an image URL.
     """
-    # Get the last 3 messages for this user
-    last_3_messages = last_messages.get(chat_id, ["", "", ""])
-    history_string = f"""\n{last_3_messages[0]}\n{last_3_messages[1]}\n{last_3_messages[2]}\n"""
-
-    # Determine the topic
-    topic = await get_topic(text, history_string)
-
-    # Process the message based on the topic
-    output = ""
-    if topic == "chat":
-        output = process_chat(chat_id, text, history_string)
-    elif topic == "image":
-        output = await process_image(text, history_string)
-    elif topic == "calendar":
-        output = process_calendar(text, history_string)
-
-    # Update the last messages for this user
-    last_messages[chat_id] = [text] + last_3_messages[:-1]
-    print(output)
-    return output
+    platform = metrics.current_platform.get()
+    topic = "unknown"
+    async with shared_state.lock(chat_id):
+        answer = job_queue.progress("answer")
+        if answer is not None:
+            # A retried job whose message was answered and committed to memory already
+            return tuple(answer) if isinstance(answer, list) else answer
+        await sync_chat_session(chat_id)
+        try:
+            with metrics.timed("reply", platform=platform):
+                # Get the last 3 messages for this user
+                last_3_messages = await shared_state.get(LAST_MESSAGES, chat_id) or ["", "", ""]
+                history_string = f"""\n{last_3_messages[0]}\n{last_3_messages[1]}\n{last_3_messages[2]}\n"""
+
+                # Determine the topic. When the LLM has to be asked, optionally start the
+                # chat reply at the same time since most messages turn out to be chat.
+                speculation = None
+                try:
+                    with metrics.timed("topic_routing"):
+                        topic = topic_router.route_local(text, history_string)
+                        if topic is None:
+                            if SPECULATIVE_CHAT:
+                                speculation = asyncio.create_task(speculate_chat(chat_id, text))
+                            topic = await topic_router.route_llm(text, history_string)
+                except BaseException:
+                    if speculation is not None:
+                        discard_speculation(speculation)
+                    raise
+
+                # Process the message based on the topic
+                output = ""
+                if speculation is not None:
+                    if topic == "chat":
+                        inputs, output = await speculation
+                        await commit_chat(chat_id, inputs, output)
+                        speculation_stats["hits"] += 1
+                    else:
+                        discard_speculation(speculation)
+
+                if topic == "chat":
+                    if speculation is None:
+                        output = await process_chat(chat_id, text, history_string)
+                elif topic == "image":
+                    output = await process_image(text, history_string)
+                elif topic == "calendar":
+                    output = await process_calendar(text, history_string)
+                await job_queue.checkpoint("answer", output)
+
+                # Update the last messages for this user
+                await shared_state.set(LAST_MESSAGES, chat_id, [text] + last_3_messages[:-1])
+                print(output)
+        except Exception:
+            metrics.message_errors.inc(platform=platform, topic=topic or "unknown")
+            raise
+        metrics.messages.inc(platform=platform, topic=topic)
+        return output
+
+
+# Per-chat mailboxes, so messages of one chat never race on its history and memory
+chat_scheduler = ChatScheduler(answer_chat_message, workers=CHAT_WORKERS, max_queue=CHAT_QUEUE_MAX,
+                               overflow=CHAT_QUEUE_OVERFLOW)
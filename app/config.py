@@ -25,6 +25,22 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 # Choose your model between gpt-3, gpt-3.5-turbo, gpt-4
 SELECTED_MODEL = 'gpt-4'
 
+# Models of each prompt stage, in order of preference. A call that fails or
+# takes longer than 'timeout' seconds is retried with the next model. When the
+# p90 latency of the last MODEL_LATENCY_WINDOW calls of a stage is over its
+# 'target' seconds, the stage steps down to the next model, and tries the
+# previous one again after MODEL_STEP_UP_AFTER seconds.
+MODEL_STAGES = {
+    'chat': {'models': [SELECTED_MODEL, 'gpt-3.5-turbo'], 'timeout': 90.0, 'target': 30.0},
+    'topic': {'models': ['gpt-3.5-turbo', 'gpt-3'], 'timeout': 10.0, 'target': 2.0},
+    'image_prompt': {'models': ['gpt-3.5-turbo', 'gpt-3'], 'timeout': 20.0, 'target': 5.0},
+    'calendar': {'models': ['gpt-3.5-turbo', 'gpt-3'], 'timeout': 20.0, 'target': 5.0},
+    'babyagi_exec': {'models': ['gpt-4', 'gpt-3.5-turbo'], 'timeout': 120.0, 'target': 60.0},
+    'babyagi_plan': {'models': ['gpt-3.5-turbo', 'gpt-3'], 'timeout': 30.0, 'target': 10.0},
+}
+MODEL_LATENCY_WINDOW = 20
+MODEL_STEP_UP_AFTER = 600
+
 # Temperature value for OpenAI language model
 TEMPERATURE_VALUE = float(0.8)
 
@@ -41,4 +57,198 @@ BABYAGI = False
 HISTORY_DIR = './history'
 
 # TODO Numbers For testing purposes only, should be changed later
-MEMORYCONFIG = {'K_contextual':2, 'K_latest':4} 
\ No newline at end of file
+MEMORYCONFIG = {'K_contextual':2, 'K_latest':4}
+
+# Input token budget of the chat prompt per model, the rest of the context
+# window is left for the reply. Over budget, the least relevant retrieved turns
+# are dropped first, then the oldest recent turns.
+PROMPT_TOKEN_BUDGET = {'gpt-3': 3000, 'gpt-3.5-turbo': 3000, 'gpt-4': 6000}
+
+# Topic routing: rules and a local classifier answer first, the LLM is only
+# asked when the classifier's confidence is below the threshold
+TOPIC_ROUTER_THRESHOLD = 0.85
+# Confidence of a calendar rule match (keyword plus date or time), a more
+# confident classifier decision overrides it
+TOPIC_ROUTER_RULE_CONFIDENCE = 0.9
+# Cap of the local classifier's confidence: its posterior rounds to 1.0 on
+# short texts, but only a command is certain enough to skip the other stages
+TOPIC_ROUTER_CLASSIFIER_MAX_CONFIDENCE = 0.99
+TOPIC_ROUTER_MODEL = os.path.join(HISTORY_DIR, 'topic_model.json')
+TOPIC_ROUTER_LOG = os.path.join(HISTORY_DIR, 'topic_decisions.jsonl')
+
+# Start the chat reply while the topic is still being detected. The reply is
+# thrown away (never saved to memory) when the topic is image or calendar.
+SPECULATIVE_CHAT = False
+
+# Size of the thread pool used for blocking calls from async handlers
+WORKER_THREADS = 16
+
+# Shared outbound HTTP client settings
+HTTP_MAX_CONNECTIONS = 100
+HTTP_TIMEOUT = 30.0
+
+# Timeouts (seconds) and circuit breakers of external services. After
+# 'threshold' failures in a row a service isn't called for 'reset_after'
+# seconds, and users get its 'message' instead. Idempotent calls with 'hedge'
+# set are sent again when they take longer than that percentile of recent
+# calls. 'llm' applies to each model ("llm:gpt-4"), prompt stages set their
+# own timeouts, see MODEL_STAGES.
+DEPENDENCIES = {
+    'default': {'timeout': 30.0, 'hedge': None, 'threshold': 5, 'reset_after': 30.0,
+                'message': "Sorry, I can't answer right now. Please try again in a minute."},
+    'llm': {'timeout': 90.0},
+    'embeddings': {'timeout': 20.0, 'hedge': 95},
+    'images': {'timeout': 60.0, 'message': "Image generation isn't available right now. Please try again later."},
+    'whisper': {'timeout': 60.0, 'hedge': 95,
+                'message': "I can't listen to voice messages right now. Please type your message or try again later."},
+    'zapier': {'timeout': 60.0, 'message': "I can't reach your calendar right now. Please try again later."},
+    'pinecone': {'timeout': 10.0, 'hedge': 95},
+    'telegram': {'timeout': 15.0},
+    'twilio': {'timeout': 15.0},
+}
+
+# Conversation turns are appended to this SQLite database in batches: every
+# STORE_FLUSH_EVERY turns or STORE_FLUSH_INTERVAL seconds, and on shutdown
+CONVERSATION_DB = os.path.join(HISTORY_DIR, 'conversations.db')
+STORE_FLUSH_INTERVAL = 2.0
+STORE_FLUSH_EVERY = 20
+
+# State shared by the workers of the app: per-chat locks, chat state versions
+# (to drop cached sessions another worker made stale) and small per-chat
+# values. 'process' keeps it in memory, for a single worker. 'sqlite' keeps it
+# in STATE_DB with file locks in STATE_LOCK_DIR, for several workers
+# (uvicorn --workers N) on one machine.
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'process')
+STATE_DB = os.path.join(HISTORY_DIR, 'state.db')
+STATE_LOCK_DIR = os.path.join(HISTORY_DIR, 'locks')
+
+# Cached chat sessions: at most SESSION_CACHE_SIZE chats or roughly
+# SESSION_CACHE_MAX_BYTES of vectors, idle ones dropped after SESSION_CACHE_TTL
+# seconds. The SESSION_WARMUP most recently active chats are loaded at startup.
+SESSION_CACHE_SIZE = 256
+SESSION_CACHE_TTL = 3600
+SESSION_CACHE_MAX_BYTES = 512 * 1024 * 1024
+SESSION_WARMUP = 32
+
+# Per-chat vector memory, saved in FAISS's native format. Chats with at least
+# VECTOR_MEMORY_ANN_THRESHOLD vectors switch from an exact float16 index to
+# VECTOR_MEMORY_ANN ('hnsw' or 'ivfpq'). The exact and IVF-PQ indexes are
+# memory-mapped, HNSW graphs are loaded into RAM. IVF-PQ reranks
+# VECTOR_MEMORY_PQ_RERANK times k candidates with exact float16 distances.
+# New vectors are kept in RAM and merged into the file on eviction or after
+# VECTOR_MEMORY_DELTA_MAX new turns.
+VECTOR_MEMORY_DIR = os.path.join(HISTORY_DIR, 'vectors')
+VECTOR_MEMORY_ANN = 'hnsw'
+VECTOR_MEMORY_ANN_THRESHOLD = 10000
+VECTOR_MEMORY_HNSW_M = 32
+VECTOR_MEMORY_HNSW_EF_SEARCH = 64
+VECTOR_MEMORY_PQ_M = 192
+VECTOR_MEMORY_IVF_NPROBE = 16
+VECTOR_MEMORY_PQ_RERANK = 16
+VECTOR_MEMORY_DELTA_MAX = 256
+
+# Embeddings are cached by model and normalized text: EMBEDDING_CACHE_SIZE in
+# memory, all of them in EMBEDDING_CACHE_DB
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+EMBEDDING_CACHE_DB = os.path.join(HISTORY_DIR, 'embeddings.db')
+EMBEDDING_CACHE_SIZE = 10000
+
+# Embedding requests made within EMBEDDING_BATCH_WINDOW seconds of each other
+# are sent as one API call of at most EMBEDDING_BATCH_MAX texts
+EMBEDDING_BATCH_WINDOW = 0.01
+EMBEDDING_BATCH_MAX = 256
+
+# Response cache for the stateless prompt stages. Entries live for 'ttl'
+# seconds, at most 'max_entries' per stage. Set 'similarity' to a cosine
+# threshold (e.g. 0.97) to also reuse answers for near-identical inputs.
+RESPONSE_CACHE = {
+    'topic': {'ttl': 3600, 'max_entries': 5000, 'similarity': None},
+    'image_prompt': {'ttl': 86400, 'max_entries': 1000, 'similarity': None},
+    'calendar': {'ttl': 300, 'max_entries': 1000, 'similarity': None},
+}
+
+# Voice messages are downmixed to mono VOICE_SAMPLE_RATE audio and encoded as
+# VOICE_FORMAT/VOICE_SUBTYPE before transcription, in a pool of
+# VOICE_DECODE_WORKERS processes. Larger downloads are rejected.
+VOICE_SAMPLE_RATE = 16000
+VOICE_FORMAT = 'OGG'
+VOICE_SUBTYPE = 'OPUS'
+VOICE_DECODE_WORKERS = 2
+VOICE_MAX_BYTES = 25 * 1024 * 1024
+
+# Outbound messages are queued and sent in order per recipient by a pool of
+# workers. Failed sends (429, 5xx, network errors) are retried up to
+# OUTBOUND_MAX_ATTEMPTS times with exponential backoff from OUTBOUND_BACKOFF seconds.
+OUTBOUND_MAX_ATTEMPTS = 5
+OUTBOUND_BACKOFF = 0.5
+
+# Twilio REST API (override to point at a mock server), send workers and
+# messages per second across all recipients
+TWILIO_API_BASE = os.getenv('TWILIO_API_BASE', 'https://api.twilio.com')
+TWILIO_SEND_WORKERS = 8
+TWILIO_SEND_RATE = 20
+
+# Telegram Bot API (override to point at a mock server), send workers and
+# flood limits: messages per second across all chats, and per chat with
+# bursts of up to TELEGRAM_CHAT_SEND_BURST messages
+TELEGRAM_API_BASE = os.getenv('TELEGRAM_API_BASE', 'https://api.telegram.org')
+TELEGRAM_SEND_WORKERS = 8
+TELEGRAM_SEND_RATE = 30
+TELEGRAM_CHAT_SEND_RATE = 1
+TELEGRAM_CHAT_SEND_BURST = 3
+
+# Messages of a chat are answered one at a time, at most CHAT_WORKERS messages
+# across all chats. When CHAT_QUEUE_MAX messages of a chat are waiting, a new
+# one is merged into the newest waiting message ('merge'), the oldest waiting
+# message is dropped ('drop_oldest') or the new one is refused ('reject').
+CHAT_WORKERS = 32
+CHAT_QUEUE_MAX = 5
+CHAT_QUEUE_OVERFLOW = 'merge'
+
+# Incoming messages are saved to JOB_QUEUE_DB and processed by up to
+# JOB_WORKERS background jobs. Failed jobs are retried up to JOB_MAX_ATTEMPTS
+# times, with exponential backoff from JOB_BACKOFF seconds. Finished jobs (and
+# with them the update ids used to ignore redelivered webhooks) are kept for
+# JOB_RETENTION seconds.
+JOB_QUEUE_DB = os.path.join(HISTORY_DIR, 'jobs.db')
+JOB_WORKERS = 64
+JOB_MAX_ATTEMPTS = 3
+JOB_BACKOFF = 5.0
+JOB_RETENTION = 7 * 24 * 3600
+# A worker marks the jobs it is running as alive every JOB_LEASE / 3 seconds.
+# Jobs whose worker stopped doing so for JOB_LEASE seconds are run again by
+# another worker.
+JOB_LEASE = 60.0
+
+# Stream chat replies while they are generated: on Telegram the reply is sent
+# early and edited at most every TELEGRAM_STREAM_INTERVAL seconds, on
+# WhatsApp/Messenger it is sent in chunks of complete sentences of at least
+# TWILIO_STREAM_MIN_CHARS characters
+STREAM_REPLIES = True
+TELEGRAM_STREAM_INTERVAL = 1.0
+TWILIO_STREAM_MIN_CHARS = 80
+
+# BabyAGI: tasks executed at the same time per objective, and the budget of an
+# objective in executed tasks and model tokens. New tasks are only created
+# while fewer than BABYAGI_MAX_TASKS were created.
+BABYAGI_CONCURRENCY = 3
+BABYAGI_MAX_STEPS = 10
+BABYAGI_MAX_TOKENS = 20000
+BABYAGI_MAX_TASKS = 6
+
+# Where BabyAGI keeps task results: 'local' (a NumPy matrix appended to files at
+# BABYAGI_VECTOR_PATH, no external service) or 'pinecone' (needs
+# PINECONE_API_KEY and TABLE_NAME)
+BABYAGI_VECTOR_STORE = os.getenv('BABYAGI_VECTOR_STORE', 'local')
+BABYAGI_VECTOR_PATH = os.path.join(HISTORY_DIR, 'babyagi_results')
+
+# Every incoming update is traced; traces that take at least
+# TRACE_SLOW_SECONDS are appended to TRACE_LOG as JSON lines (None: off)
+TRACE_LOG = os.path.join(HISTORY_DIR, 'slow_traces.jsonl')
+TRACE_SLOW_SECONDS = 10.0
+
+# Token for the /admin endpoints, sent as "Authorization: Bearer <token>".
+# The endpoints are disabled without it. A profile runs for at most
+# PROFILE_MAX_SECONDS seconds.
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', None)
+PROFILE_MAX_SECONDS = 120
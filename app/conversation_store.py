@@ -0,0 +1,199 @@
+import os
+import sys
+import glob
+import time
+import pickle
+import sqlite3
+import asyncio
+import threading
+import numpy as np
+from typing import List, NamedTuple, Optional
+import config
+from executor import run_sync
+
+
+class Turn(NamedTuple):
+    human: str
+    ai: str
+    document: str
+    embedding: Optional[np.ndarray]
+
+
+class ConversationStore:
+    """
+    Append-only store of conversation turns in SQLite (WAL mode).
+
+    Only the new turn is written, never the whole memory. Appends are buffered
+    and written in one transaction every `flush_every` turns or `flush_interval`
+    seconds, whichever comes first, and on shutdown.
+    """
+
+    def __init__(self, path: str, flush_interval: float = config.STORE_FLUSH_INTERVAL,
+                 flush_every: int = config.STORE_FLUSH_EVERY):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self._pending = []
+        self._lock = threading.Lock()
+        self._conn = None
+        self._last_flush = time.monotonic()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                human TEXT NOT NULL,
+                ai TEXT NOT NULL,
+                document TEXT NOT NULL,
+                embedding BLOB,
+                created REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS turns_chat_id ON turns (chat_id, id)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def append(self, chat_id: str, human: str, ai: str, document: str, embedding: Optional[np.ndarray] = None):
+        """
+        Queue a turn for writing.
+
+        Args:
+            chat_id (str): Chat id.
+            human (str): The user message.
+            ai (str): The bot reply.
+            document (str): Text stored in the vector memory for this turn.
+            embedding (np.ndarray): Embedding of `document`, kept until the vector memory is saved.
+        """
+        blob = None if embedding is None else np.asarray(embedding, dtype=np.float32).tobytes()
+        with self._lock:
+            self._pending.append((str(chat_id), human, ai, document, blob, time.time()))
+            due = (len(self._pending) >= self.flush_every
+                   or time.monotonic() - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """ Write all buffered turns in a single transaction """
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "INSERT INTO turns (chat_id, human, ai, document, embedding, created) VALUES (?, ?, ?, ?, ?, ?)",
+                    pending)
+
+    def load(self, chat_id: str, limit: Optional[int] = None) -> List[Turn]:
+        """
+        Read the turns of a chat, oldest first.
+
+        Args:
+            chat_id (str): Chat id.
+            limit (int): Only return the latest `limit` turns.
+
+        Returns:
+            List[Turn]: The stored turns.
+        """
+        self.flush()
+        with self._lock:
+            query = "SELECT human, ai, document, embedding FROM turns WHERE chat_id = ? ORDER BY id DESC"
+            params = [str(chat_id)]
+            if limit is not None:
+                query += " LIMIT ?"
+                params.append(limit)
+            rows = self._connect().execute(query, params).fetchall()
+        return [Turn(human, ai, document, None if blob is None else np.frombuffer(blob, dtype=np.float32))
+                for human, ai, document, blob in reversed(rows)]
+
+    def drop_embeddings(self, chat_id: str, n: int):
+        """ Forget the stored embeddings of the first `n` turns once they are saved in the vector memory """
+        self.flush()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "UPDATE turns SET embedding = NULL WHERE id IN "
+                    "(SELECT id FROM turns WHERE chat_id = ? ORDER BY id LIMIT ?)", (str(chat_id), n))
+
+    def recent_chat_ids(self, n: int) -> List[str]:
+        """ The `n` chats with the most recent turns, most recent first """
+        self.flush()
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT chat_id FROM turns GROUP BY chat_id ORDER BY MAX(id) DESC LIMIT ?", (n,)).fetchall()
+        return [chat_id for chat_id, in rows]
+
+    def has_chat(self, chat_id: str) -> bool:
+        self.flush()
+        with self._lock:
+            row = self._connect().execute("SELECT 1 FROM turns WHERE chat_id = ? LIMIT 1", (str(chat_id),)).fetchone()
+        return row is not None
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+store = ConversationStore(config.CONVERSATION_DB)
+
+
+async def flush_periodically(conversation_store: ConversationStore = store):
+    """
+    Background task: flush buffered turns even when no new turn arrives.
+    Works for any buffered writer with `flush_interval` and `flush()`, e.g. the topic router's log.
+    """
+    while True:
+        await asyncio.sleep(conversation_store.flush_interval)
+        await run_sync(conversation_store.flush)
+
+
+def migrate_pickles(history_dir: str = config.HISTORY_DIR, conversation_store: ConversationStore = store) -> int:
+    """
+    One-time migration of the old `<chat_id>_memory.p` pickles into the store.
+
+    The recent-turn buffer and the FAISS docstore hold the same turns in the
+    same order, so they are paired by position. Migrated pickles are renamed
+    to `.p.migrated`; chats already present in the store are skipped.
+
+    Returns:
+        int: Number of chats migrated.
+    """
+    migrated = 0
+    for fp in sorted(glob.glob(os.path.join(history_dir, '*_memory.p'))):
+        chat_id = os.path.basename(fp)[:-len('_memory.p')]
+        if conversation_store.has_chat(chat_id):
+            print(f"{chat_id}: already in the store, skipping")
+            continue
+        with open(fp, 'rb') as f:
+            memory = pickle.load(f)
+        vector_memory, buffer_memory = memory.memories
+        vectorstore = vector_memory.retriever.vectorstore
+        messages = buffer_memory.chat_memory.messages
+        pairs = [(messages[i].content, messages[i + 1].content) for i in range(0, len(messages) - 1, 2)]
+        n = min(len(pairs), vectorstore.index.ntotal)
+        if n != len(pairs) or n != vectorstore.index.ntotal:
+            print(f"{chat_id}: {len(pairs)} buffered turns but {vectorstore.index.ntotal} vectors, keeping {n}")
+        embeddings = vectorstore.index.reconstruct_n(0, n) if n else []
+        for i in range(n):
+            document = vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]).page_content
+            conversation_store.append(chat_id, pairs[i][0], pairs[i][1], document, embeddings[i])
+        conversation_store.flush()
+        os.replace(fp, fp + '.migrated')
+        migrated += 1
+    return migrated
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["migrate"]:
+        sys.exit("usage: python conversation_store.py migrate")
+    print(f"Migrated {migrate_pickles()} chats into {store.path}")
+    store.close()
@@ -0,0 +1,248 @@
+import os
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+import openai
+from collections import Counter, OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import config
+from executor import run_sync
+from resilience import dependency
+import metrics
+
+
+def normalize_text(text: str) -> str:
+    """ Collapse whitespace (including newlines, like the OpenAI clients do) """
+    return " ".join(text.split())
+
+
+def in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent embedding requests into multi-input API calls.
+
+    Texts are collected for up to `window` seconds after the first one comes
+    in, or until `max_batch` of them are waiting, then sent as one request and
+    the vectors handed back to each caller. Identical texts of a batch are
+    sent once.
+    """
+
+    def __init__(self, request: Callable[[List[str]], Awaitable[List[List[float]]]], window: float, max_batch: int):
+        self.request = request
+        self.window = window
+        self.max_batch = max_batch
+        self.stats = Counter({"requests": 0, "texts": 0, "batches": 0, "failures": 0})
+        # Number of API calls per batch size
+        self.batch_sizes = Counter()
+        # Event loop that serves sync callers in worker threads, see bind
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """ Batch the requests of sync callers (worker threads) on `loop` too """
+        self.loop = loop
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed texts as part of the next batch.
+
+        Args:
+            texts (List[str]): Normalized texts to embed.
+
+        Returns:
+            List[List[float]]: One embedding per text, in order.
+        """
+        loop = asyncio.get_running_loop()
+        self.stats["requests"] += 1
+        self.stats["texts"] += len(texts)
+        futures = []
+        for text in texts:
+            futures.append(loop.create_future())
+            self._pending.append((text, futures[-1]))
+        while len(self._pending) >= self.max_batch:
+            self._send(self._pending[:self.max_batch])
+            self._pending = self._pending[self.max_batch:]
+        if self._timer is not None and not self._pending:
+            self._timer.cancel()
+            self._timer = None
+        elif self._timer is None and self._pending:
+            self._timer = loop.call_later(self.window, self._flush)
+        return list(await asyncio.gather(*futures))
+
+    def _flush(self):
+        self._timer = None
+        if self._pending:
+            self._send(self._pending)
+            self._pending = []
+
+    def _send(self, batch: List[Tuple[str, asyncio.Future]]):
+        task = asyncio.create_task(self._request(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _request(self, batch: List[Tuple[str, asyncio.Future]]):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.stats["batches"] += 1
+        self.batch_sizes[len(texts)] += 1
+        try:
+            vectors = dict(zip(texts, await self.request(texts)))
+        except Exception as e:
+            self.stats["failures"] += 1
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for text, future in batch:
+            # Callers that were cancelled no longer wait for their vectors
+            if not future.done():
+                future.set_result(vectors[text])
+
+
+class EmbeddingService:
+    """
+    Content-addressed embedding cache shared by chat memory and BabyAGI.
+
+    Embeddings are keyed on the model and a hash of the normalized text. A
+    bounded in-memory LRU sits in front of an SQLite store, so repeated texts
+    are embedded once, even across restarts. Cache misses of concurrent calls
+    are sent to the API together by an EmbeddingBatcher.
+    """
+
+    def __init__(self, model: str, path: str, max_entries: int,
+                 batch_window: float = config.EMBEDDING_BATCH_WINDOW, batch_max: int = config.EMBEDDING_BATCH_MAX):
+        self.model = model
+        self.path = path
+        self.max_entries = max_entries
+        self.stats = Counter({"memory_hits": 0, "disk_hits": 0, "misses": 0, "api_calls": 0, "api_calls_avoided": 0})
+        self._lru: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.batcher = EmbeddingBatcher(self._api_request, batch_window, batch_max)
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def embed_query(self, text: str) -> List[float]:
+        """ Drop-in replacement for OpenAIEmbeddings.embed_query """
+        return self.embed_documents([text])[0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed texts, calling the API only for the ones not cached yet.
+
+        Args:
+            texts (List[str]): Texts to embed.
+
+        Returns:
+            List[List[float]]: One embedding per text, in order.
+        """
+        keys = [self.key(text) for text in texts]
+        found = self._lookup(keys)
+        missing = {key: normalize_text(text) for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            found.update(self._store(missing, self._request(list(missing.values()))))
+        return [found[key].tolist() for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """ Async version of embed_documents: disk lookups in the worker pool, native async API call """
+        keys = [self.key(text) for text in texts]
+        found = await run_sync(self._lookup, keys)
+        missing = {key: normalize_text(text) for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            vectors = await self._arequest(list(missing.values()))
+            found.update(await run_sync(self._store, missing, vectors))
+        return [found[key].tolist() for key in keys]
+
+    def _request(self, texts: List[str]) -> List[List[float]]:
+        loop = self.batcher.loop
+        # Worker threads join the batches of the event loop, which must not wait for itself
+        if loop is not None and loop.is_running() and not in_event_loop():
+            return asyncio.run_coroutine_threadsafe(self.batcher.embed(texts), loop).result()
+        self.stats["api_calls"] += 1
+        response = openai.Embedding.create(input=texts, model=self.model, api_key=config.OPENAI_API_KEY)
+        return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+    async def _arequest(self, texts: List[str]) -> List[List[float]]:
+        return await self.batcher.embed(texts)
+
+    async def _api_request(self, texts: List[str]) -> List[List[float]]:
+        self.stats["api_calls"] += 1
+        with metrics.timed("embeddings"):
+            response = await dependency("embeddings").call(
+                lambda: openai.Embedding.acreate(input=texts, model=self.model, api_key=config.OPENAI_API_KEY))
+        return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _lookup(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    found[key] = self._lru[key]
+                    self.stats["memory_hits"] += 1
+            on_disk = [key for key in dict.fromkeys(keys) if key not in found]
+            if on_disk:
+                rows = self._connect().execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(on_disk))})", on_disk)
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+                    self._remember(key, found[key])
+                    self.stats["disk_hits"] += 1
+            self.stats["misses"] += len(set(keys) - found.keys())
+            self.stats["api_calls_avoided"] += sum(1 for key in keys if key in found)
+        return found
+
+    def _store(self, missing: Dict[str, str], vectors: List[List[float]]) -> Dict[str, np.ndarray]:
+        stored = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(missing, vectors)}
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                                 [(key, vector.tobytes()) for key, vector in stored.items()])
+            for key, vector in stored.items():
+                self._remember(key, vector)
+        return stored
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+service = EmbeddingService(config.EMBEDDING_MODEL, config.EMBEDDING_CACHE_DB, config.EMBEDDING_CACHE_SIZE)
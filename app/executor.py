@@ -0,0 +1,85 @@
+import os
+import asyncio
+import functools
+import contextvars
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+from config import WORKER_THREADS, VOICE_DECODE_WORKERS
+
+# Bounded pool for sync-only libraries (LangChain memory, FAISS, Pinecone,
+# Twilio, Zapier) so they never run on the event loop thread
+pool = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="worker")
+
+
+async def run_sync(fn: Callable, *args, **kwargs) -> Any:
+    """
+    Run a blocking function in the worker pool and await its result.
+
+    Args:
+        fn (Callable): The blocking function.
+        *args, **kwargs: Arguments passed to fn.
+
+    Returns:
+        Any: Whatever fn returns.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(pool, functools.partial(context.run, fn, *args, **kwargs))
+
+
+# Bounded pool for CPU-heavy work (audio decoding), created on first use
+_process_pool = None
+
+
+def process_context() -> multiprocessing.context.BaseContext:
+    """
+    Start method of the process pool. Forking the server would copy its
+    threads' locks (worker pool, SQLite, HTTP clients) in whatever state they
+    are. Workers come from a fork server instead, which imports the main
+    module and the audio libraries once, or are spawned where there is none
+    (Windows).
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["__main__", "audio"])
+    return context
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=VOICE_DECODE_WORKERS, mp_context=process_context())
+    return _process_pool
+
+
+def start_process_pool():
+    """ Start the fork server and every worker of the process pool, they are started on demand otherwise """
+    pool = get_process_pool()
+    for future in [pool.submit(os.getpid) for _ in range(VOICE_DECODE_WORKERS)]:
+        future.result()
+
+
+async def run_in_process(fn: Callable, *args) -> Any:
+    """
+    Run a CPU-bound function in the process pool and await its result.
+
+    Args:
+        fn (Callable): A picklable (module level) function.
+        *args: Picklable arguments passed to fn.
+
+    Returns:
+        Any: Whatever fn returns.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), fn, *args)
+
+
+def shutdown():
+    pool.shutdown(wait=False, cancel_futures=True)
+    if _process_pool is not None:
+        # Wait for the workers to stop: a uvicorn worker is itself a
+        # multiprocessing child, which joins its child processes on exit
+        # before the pool would tell them to stop, and hangs
+        _process_pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,8 @@
+import httpx
+from config import HTTP_MAX_CONNECTIONS, HTTP_TIMEOUT
+
+# One connection pool shared by every outbound HTTP call (Telegram, downloads, ...)
+client = httpx.AsyncClient(
+    timeout=HTTP_TIMEOUT,
+    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS),
+)
@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional, Set
+import config
+from executor import run_sync
+import metrics
+import tracing
+
+
+def worker_id() -> str:
+    """ Identifies the worker that runs a job: "<host>:<pid>:<random>" """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def worker_alive(owner: Optional[str]) -> bool:
+    """ False if `owner` is a worker process of this machine that is gone, True if unknown """
+    if owner is None:
+        return False
+    host, pid, _ = owner.rsplit(":", 2)
+    if host != socket.gethostname():
+        return True
+    if int(pid) == os.getpid():
+        # An earlier process with the same pid, e.g. PID 1 of a restarted container
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Job(NamedTuple):
+    id: int
+    kind: str
+    payload: Dict[str, Any]
+    attempts: int
+    trace_id: Optional[str]
+    # When the job was queued (epoch seconds)
+    created: Optional[float]
+    # Steps with side effects the job finished, also in earlier attempts, see JobQueue.checkpoint
+    progress: Dict[str, Any]
+
+
+# The job the current task processes, the chat scheduler runs messages in their job's context
+current_job: ContextVar[Optional[Job]] = ContextVar("current_job", default=None)
+
+
+class JobQueue:
+    """
+    Durable queue of incoming messages in SQLite (WAL mode).
+
+    Webhooks only save a job and return, workers process the jobs in the
+    background. A job is marked done after its handler returns, so jobs that
+    were running when their worker stopped run again (at-least-once): on the
+    next start, or in another worker once the stopped worker's lease runs out.
+    Several worker processes can share the queue. A job's chat is only
+    answered by one worker at a time, messages of a chat that another worker
+    is answering wait for it, so they stay in order. Jobs carry a dedup key (the Telegram update_id or Twilio
+    MessageSid): a redelivered webhook finds the key already queued and is
+    ignored, so it never causes a second LLM call or reply. A failed job is
+    retried, handlers record the steps with side effects a job finished
+    (the answer committed to memory, the reply sent) with checkpoint, so a
+    retry skips them instead of calling the LLM or replying again. Each job runs in
+    a trace with the ID its webhook gave it, see tracing.trace.
+    """
+
+    def __init__(self, path: str, workers: int, max_attempts: int, backoff: float, retention: float, lease: float):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.retention = retention
+        self.lease = lease
+        self.owner = worker_id()
+        self.handlers: Dict[str, Callable[[Dict[str, Any]], Awaitable[Any]]] = {}
+        self.stats = Counter({"enqueued": 0, "duplicates": 0, "done": 0, "retried": 0, "failed": 0})
+        self._lock = threading.Lock()
+        self._conn = None
+        self._wakeup = asyncio.Event()
+        self._running: Set[asyncio.Task] = set()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                dedup_key TEXT UNIQUE,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                not_before REAL NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL NOT NULL,
+                trace_id TEXT,
+                created REAL,
+                chat TEXT,
+                owner TEXT,
+                progress TEXT)""")
+            # Databases created before jobs were traced, shared by workers or checkpointed
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (("trace_id", "TEXT"), ("created", "REAL"), ("chat", "TEXT"), ("owner", "TEXT"),
+                                 ("progress", "TEXT")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def register(self, kind: str, handler: Callable[[Dict[str, Any]], Awaitable[Any]]):
+        """ Set the coroutine function that processes jobs of a kind """
+        self.handlers[kind] = handler
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], dedup_key: Optional[str] = None,
+                trace_id: Optional[str] = None, chat: Optional[str] = None) -> bool:
+        """
+        Save a job. Blocking, see aenqueue.
+
+        Args:
+            kind (str): Job kind, selects the handler.
+            payload (Dict[str, Any]): JSON-serializable handler argument.
+            dedup_key (str): Jobs with a key that was already queued are ignored.
+            trace_id (str): ID of the job's trace, a new one if None.
+            chat (str): Chat the job answers, e.g. "telegram:<chat id>". Jobs of a chat
+                run in one worker at a time.
+
+        Returns:
+            bool: False if the job is a duplicate.
+        """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                now = time.time()
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO jobs (dedup_key, kind, payload, updated, trace_id, created, chat) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (dedup_key, kind, json.dumps(payload), now, trace_id or tracing.new_trace_id(), now, chat))
+        if not cursor.rowcount:
+            self.stats["duplicates"] += 1
+            print(f"job queue: ignoring duplicate {dedup_key}")
+            return False
+        self.stats["enqueued"] += 1
+        return True
+
+    async def aenqueue(self, kind: str, payload: Dict[str, Any], dedup_key: Optional[str] = None,
+                       trace_id: Optional[str] = None, chat: Optional[str] = None) -> bool:
+        """ Save a job from the worker pool and wake up the queue """
+        added = await run_sync(self.enqueue, kind, payload, dedup_key, trace_id, chat)
+        if added:
+            self._wakeup.set()
+        return added
+
+    def _claim(self) -> Optional[Job]:
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                # Takes the write lock first, so two workers never claim the same job or chat
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute(
+                    "SELECT id, kind, payload, attempts, trace_id, created, progress FROM jobs WHERE state = 'queued' AND not_before <= ? "
+                    "AND (chat IS NULL OR chat NOT IN "
+                    "(SELECT chat FROM jobs WHERE state = 'running' AND owner != ? AND chat IS NOT NULL)) "
+                    "ORDER BY id LIMIT 1", (time.time(), self.owner)).fetchone()
+                if row is None:
+                    return None
+                conn.execute("UPDATE jobs SET state = 'running', owner = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                             (self.owner, time.time(), row[0]))
+        return Job(row[0], row[1], json.loads(row[2]), row[3] + 1, row[4], row[5], json.loads(row[6] or "{}"))
+
+    def progress(self, step: str) -> Any:
+        """ What the job the caller runs in recorded for a step, in this attempt or an earlier one. None if nothing. """
+        job = current_job.get()
+        return None if job is None else job.progress.get(step)
+
+    async def checkpoint(self, step: str, value: Any = True):
+        """
+        Record that the job the caller runs in finished a step with a side
+        effect. It is saved before this returns, so a retry of the job, also
+        after a crash, can skip the step, see progress. Does nothing outside a job.
+
+        Args:
+            step (str): Name of the step, e.g. "replied".
+            value (Any): JSON-serializable result of the step the retry needs, e.g. the answer.
+        """
+        job = current_job.get()
+        if job is None:
+            return
+        job.progress[step] = value
+        await run_sync(self._save_progress, job)
+
+    def _save_progress(self, job: Job):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(job.progress), job.id))
+
+    def _finish(self, job: Job, error: Optional[str] = None):
+        if error is None:
+            state, not_before = "done", 0
+        elif job.attempts < self.max_attempts:
+            state, not_before = "queued", time.time() + self.backoff * 2 ** (job.attempts - 1)
+        else:
+            state, not_before = "failed", 0
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("UPDATE jobs SET state = ?, not_before = ?, error = ?, updated = ? WHERE id = ?",
+                             (state, not_before, error, time.time(), job.id))
+        self.stats["done" if state == "done" else "retried" if state == "queued" else "failed"] += 1
+
+    def recover(self) -> int:
+        """
+        Requeue the jobs of stopped workers: worker processes of this machine
+        that are gone, and any worker that did not renew its lease.
+        """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                requeued = conn.execute("UPDATE jobs SET state = 'queued', owner = NULL WHERE state = 'running' AND updated < ?",
+                                        (time.time() - self.lease,)).rowcount
+                for owner, in conn.execute("SELECT DISTINCT owner FROM jobs WHERE state = 'running'").fetchall():
+                    if owner != self.owner and not worker_alive(owner):
+                        requeued += conn.execute("UPDATE jobs SET state = 'queued', owner = NULL "
+                                                 "WHERE state = 'running' AND owner IS ?", (owner,)).rowcount
+                return requeued
+
+    def renew(self):
+        """ Renew the lease of the jobs this worker is running """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("UPDATE jobs SET updated = ? WHERE state = 'running' AND owner = ?", (time.time(), self.owner))
+
+    async def _keep_alive(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await run_sync(self.renew)
+                recovered = await run_sync(self.recover)
+            except sqlite3.Error as e:
+                print(f"job queue: could not renew the lease: {e}")
+                continue
+            if recovered:
+                print(f"job queue: requeued {recovered} jobs of stopped workers")
+                self._wakeup.set()
+
+    def prune(self) -> int:
+        """ Delete finished jobs older than `retention` seconds, their dedup keys are no longer needed """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                return conn.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated < ?",
+                                    (time.time() - self.retention,)).rowcount
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+    async def run(self, poll_interval: float = 1.0):
+        """
+        Background task: process jobs in id order with up to `workers` running at once.
+
+        Jobs are started one after the other, so messages of a chat reach the
+        chat scheduler in the order they arrived.
+        """
+        # A new id in every process, also when the queue was created before a fork
+        self.owner = worker_id()
+        recovered = await run_sync(self.recover)
+        if recovered:
+            print(f"job queue: requeued {recovered} interrupted jobs")
+        await run_sync(self.prune)
+        last_prune = time.monotonic()
+        slots = asyncio.Semaphore(self.workers)
+        keep_alive = asyncio.create_task(self._keep_alive())
+        try:
+            await self._claim_jobs(slots, poll_interval, last_prune)
+        finally:
+            keep_alive.cancel()
+
+    async def _claim_jobs(self, slots: asyncio.Semaphore, poll_interval: float, last_prune: float):
+        while True:
+            await slots.acquire()
+            self._wakeup.clear()
+            job = await run_sync(self._claim)
+            if job is None:
+                slots.release()
+                if time.monotonic() - last_prune > self.retention / 10:
+                    await run_sync(self.prune)
+                    last_prune = time.monotonic()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self._process(job, slots))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _process(self, job: Job, slots: asyncio.Semaphore):
+        error = None
+        current_job.set(job)
+        try:
+            queued = None if job.created is None else round(time.time() - job.created, 3)
+            with metrics.timed("job", kind=job.kind), \
+                    tracing.trace(f"job:{job.kind}", job.trace_id, job_id=job.id, attempt=job.attempts,
+                                  queued_seconds=queued):
+                await self.handlers[job.kind](job.payload)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            print(f"job queue: {job.kind} job {job.id} failed (attempt {job.attempts}): {error}")
+        finally:
+            slots.release()
+        await run_sync(self._finish, job, error)
+        # Later messages of the chat may have waited for this one
+        self._wakeup.set()
+
+    def close(self):
+        """ Stop running jobs, they stay marked as running and are requeued on the next start, see recover """
+        for task in list(self._running):
+            task.cancel()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+queue = JobQueue(
+    config.JOB_QUEUE_DB,
+    workers=config.JOB_WORKERS,
+    max_attempts=config.JOB_MAX_ATTEMPTS,
+    backoff=config.JOB_BACKOFF,
+    retention=config.JOB_RETENTION,
+    lease=config.JOB_LEASE,
+)
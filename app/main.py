@@ -1,6 +1,29 @@
+import sys
+import time
+import asyncio
+import importlib
 from fastapi import FastAPI
-from telegram_handler import telegram_webhook
-from twilio_handler import twilio_api_reply
+from webhooks import telegram_webhook, twilio_api_reply
+from conversation_store import store as conversation_store, flush_periodically
+from executor import run_sync, start_process_pool, shutdown as shutdown_workers
+from job_queue import queue as job_queue
+from shared_state import backend as shared_state
+from config import SESSION_WARMUP
+import resilience
+import metrics
+import tracing
+from profiling import profiling_endpoint, stats as profiling_stats
+
+# Modules that answer the queued messages. They pull in LangChain, FAISS, OpenAI
+# and the Telegram client, so they are imported after the server accepts
+# traffic, see warm_up. Until then incoming messages wait in the job queue.
+PIPELINE_MODULES = ("telegram_handler", "twilio_handler", "babyagi")
+
+# Seconds each pipeline module took to import, including what it imported first
+import_times = {}
+
+# Set once the pipeline is imported and the job queue is processing messages
+pipeline_ready = asyncio.Event()
 
 # Create a FastAPI app instance
 app = FastAPI()
@@ -8,3 +31,140 @@ app = FastAPI()
 # Include the routers for the Telegram webhook and Twilio API reply
 app.include_router(telegram_webhook)
 app.include_router(twilio_api_reply)
+app.include_router(metrics.metrics_endpoint)
+app.include_router(profiling_endpoint)
+
+metrics.register_stats("job_queue", job_queue.stats)
+metrics.register_stats("tracing", tracing.stats)
+metrics.register_stats("profiling", profiling_stats)
+metrics.register_gauge("job_queue_depth", "Incoming messages waiting to be processed", job_queue.depth)
+metrics.register_gauge("pipeline_ready", "1 once the message pipeline is loaded", lambda: float(pipeline_ready.is_set()))
+metrics.CallbackGauge("dependency_circuit_open", "1 while the circuit breaker of an external service is open",
+                      lambda: {(("dependency", name),): float(dep.breaker.state != "closed")
+                               for name, dep in list(resilience.dependencies.items())})
+metrics.CallbackGauge("dependency_stats", "Calls, failures, timeouts and hedging of external services",
+                      lambda: {(("dependency", name), ("stat", stat)): value
+                               for name, dep in list(resilience.dependencies.items())
+                               for stat, value in dep.status().items() if not isinstance(value, str)})
+metrics.CallbackGauge("pipeline_import_seconds", "Seconds each pipeline module took to import",
+                      lambda: {(("module", module),): seconds for module, seconds in import_times.items()})
+
+background_tasks = []
+
+
+def load_pipeline():
+    """
+    Import the pipeline modules, which registers their job handlers, and
+    register the metrics they keep. Blocking, warm_up runs it in a worker thread.
+    """
+    for module in PIPELINE_MODULES:
+        if module in sys.modules:
+            continue
+        start = time.perf_counter()
+        importlib.import_module(module)
+        import_times[module] = time.perf_counter() - start
+        print(f"Imported {module} in {import_times[module]:.2f}s")
+    register_pipeline_metrics()
+
+
+def register_pipeline_metrics():
+    # Counters, queue depths and percentiles the subsystems already keep, read on scrape
+    from twilio_sender import dispatcher as twilio_dispatcher
+    from telegram_sender import dispatcher as telegram_dispatcher
+    from embeddings import service as embedding_service
+    from chat_handler import chat_scheduler, speculation_stats, speculation_rates
+    from voice_handler import stats as voice_stats
+    from utils import chat_sessions, topic_router, response_cache, prompt_budget
+    from models import model_tiers
+    from babyagi import task_engine
+    from streaming import first_token_percentile
+
+    for subsystem, stats in {
+        "twilio_send": twilio_dispatcher.stats,
+        "telegram_send": telegram_dispatcher.stats,
+        "chat_scheduler": chat_scheduler.stats,
+        "chat_sessions": chat_sessions.stats,
+        "embeddings": embedding_service.stats,
+        "embedding_batcher": embedding_service.batcher.stats,
+        "embedding_batch_sizes": embedding_service.batcher.batch_sizes,
+        "topic_router": topic_router.stats,
+        "prompt_budget": prompt_budget.stats,
+        "model_tiers": model_tiers.stats,
+        "speculation": speculation_stats,
+        "voice": voice_stats,
+        **{f"response_cache_{stage}": stats for stage, stats in response_cache.stats.items()},
+    }.items():
+        metrics.register_stats(subsystem, stats)
+    metrics.register_gauge("twilio_send_queue_depth", "WhatsApp and Messenger messages waiting to be sent", twilio_dispatcher.depth)
+    metrics.register_gauge("telegram_send_queue_depth", "Telegram API calls waiting to be sent", telegram_dispatcher.depth)
+    metrics.register_gauge("chat_mailbox_depth", "Chat messages waiting in their chat's mailbox", chat_scheduler.depth)
+    metrics.register_gauge("chat_in_flight", "Chat messages being answered", lambda: chat_scheduler.in_flight)
+    metrics.register_gauge("chat_sessions_cached", "Chat sessions in memory", lambda: len(chat_sessions))
+    metrics.register_gauge("speculation_hit_rate", "Share of speculative chat replies that were used",
+                           lambda: speculation_rates()["hit_rate"])
+    metrics.register_gauge("babyagi_objectives_running", "BabyAGI objectives running",
+                           lambda: sum(len(runs) for runs in task_engine.runs.values()))
+    metrics.register_quantiles("twilio_send_latency_seconds", "Twilio send latency", twilio_dispatcher.latency_percentile)
+    metrics.register_quantiles("telegram_send_latency_seconds", "Telegram send latency", telegram_dispatcher.latency_percentile)
+    metrics.register_quantiles("chat_mailbox_wait_seconds", "Time chat messages wait in their mailbox", chat_scheduler.wait_percentile)
+    metrics.register_quantiles("first_token_seconds", "Time to the first token of streamed replies", first_token_percentile)
+    metrics.register_quantiles("chat_prompt_tokens", "Tokens of assembled chat prompts", prompt_budget.prompt_percentile)
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    background_tasks.append(asyncio.create_task(flush_periodically(conversation_store)))
+    background_tasks.append(asyncio.create_task(warm_up()))
+
+
+async def warm_up():
+    """
+    Load the message pipeline in the background, then start processing the
+    job queue and warm up the chat sessions, the calendar agent and the
+    voice decoding processes.
+    """
+    start = time.perf_counter()
+    await run_sync(load_pipeline)
+    from embeddings import service as embedding_service
+    # Chat memory embeds from worker threads, through the batcher of this loop
+    embedding_service.batcher.bind(asyncio.get_running_loop())
+    background_tasks.append(asyncio.create_task(job_queue.run()))
+    from utils import topic_router
+    background_tasks.append(asyncio.create_task(flush_periodically(topic_router)))
+    pipeline_ready.set()
+    print(f"Message pipeline ready after {time.perf_counter() - start:.2f}s")
+
+    from utils import chat_sessions, session_versions, get_calendar_agent
+    chat_ids = await run_sync(conversation_store.recent_chat_ids, SESSION_WARMUP)
+    for chat_id in chat_ids:
+        # Read before loading, a change in between makes the session look stale, never current
+        session_versions[chat_id] = await shared_state.version(chat_id)
+    await chat_sessions.warm_up(chat_ids)
+    print(f"Warmed up {len(chat_sessions)} chat sessions")
+    try:
+        await run_sync(get_calendar_agent)
+    except Exception as e:
+        # Retried on the first calendar request
+        print(f"Calendar agent warm up failed: {e}")
+    await run_sync(start_process_pool)
+
+
+@app.on_event("shutdown")
+async def flush_state():
+    for task in background_tasks:
+        task.cancel()
+    # Interrupted jobs are requeued on the next start
+    job_queue.close()
+    if pipeline_ready.is_set():
+        from twilio_sender import dispatcher as twilio_dispatcher
+        from telegram_sender import dispatcher as telegram_dispatcher
+        from embeddings import service as embedding_service
+        from utils import chat_sessions, topic_router
+        await twilio_dispatcher.close()
+        await telegram_dispatcher.close()
+        await chat_sessions.clear()
+        await run_sync(topic_router.flush)
+        embedding_service.close()
+    conversation_store.close()
+    shared_state.close()
+    shutdown_workers()
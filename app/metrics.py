@@ -0,0 +1,202 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Mapping, Tuple
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+import tracing
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Every metric, in the order they are rendered
+registry: List["Metric"] = []
+
+# Messaging platform of the message being processed (telegram, whatsapp, messenger)
+current_platform: ContextVar[str] = ContextVar("current_platform", default="unknown")
+
+
+def label_key(labels: Mapping) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+class Metric:
+    """ A metric in the Prometheus text format. Updates are cheap, the text is only built on scrape. """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{format_labels(labels)} {value}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        self.inc_key(label_key(labels), amount)
+
+    def inc_key(self, key: Labels, amount: float = 1):
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[label_key(labels)] = value
+
+
+class CallbackGauge(Metric):
+    """ Gauge whose values are read from the app's own state on scrape """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, collect: Callable[[], Dict[Labels, float]]):
+        super().__init__(name, help)
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, key, value) for key, value in self.collect().items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+        # Per label set: observations per bucket (the last one is +Inf) and their sum
+        self.counts: Dict[Labels, List[int]] = {}
+        self.sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels):
+        self.observe_key(label_key(labels), value)
+
+    def observe_key(self, key: Labels, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.counts.get(key)
+            if counts is None:
+                counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+                self.sums[key] = 0.0
+            counts[i] += 1
+            self.sums[key] += value
+
+    def samples(self):
+        with self._lock:
+            series = [(key, list(counts), self.sums[key]) for key, counts in self.counts.items()]
+        samples = []
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append((f"{self.name}_bucket", key + (("le", le),), cumulative))
+            samples.append((f"{self.name}_sum", key, total))
+            samples.append((f"{self.name}_count", key, cumulative))
+        return samples
+
+
+stage_seconds = Histogram("stage_seconds", "Latency of each pipeline stage in seconds")
+stage_in_flight = Gauge("stage_in_flight", "Pipeline stages running now")
+stage_errors = Counter("stage_errors_total", "Pipeline stages that raised an exception")
+llm_requests = Counter("llm_requests_total", "LLM requests by model")
+llm_tokens = Counter("llm_tokens_total", "LLM tokens by model and kind (prompt or completion)")
+messages = Counter("messages_total", "Chat messages answered by platform and topic")
+message_errors = Counter("message_errors_total", "Chat messages that failed by platform and topic")
+
+
+@contextmanager
+def timed(stage: str, **labels):
+    """
+    Time a pipeline stage: records its latency and errors, counts it as in flight while it runs and
+    adds it as a span to the current trace.
+
+    Args:
+        stage (str): Stage name, e.g. "topic", "llm", "whisper".
+        **labels: Extra labels, keep their values few (model or platform names, not ids).
+    """
+    key = label_key(dict(labels, stage=stage))
+    stage_in_flight.inc_key(key)
+    start = time.perf_counter()
+    try:
+        with tracing.span(stage, **labels):
+            yield
+    except Exception:
+        stage_errors.inc_key(key)
+        raise
+    finally:
+        stage_seconds.observe_key(key, time.perf_counter() - start)
+        stage_in_flight.inc_key(key, -1)
+
+
+# Existing stats counters of the subsystems, see register_stats
+_stats: Dict[str, Mapping[str, float]] = {}
+
+
+def register_stats(subsystem: str, stats: Mapping[str, float]):
+    """ Export the stats Counter of a subsystem as app_stats{subsystem=..., stat=...} """
+    _stats[subsystem] = stats
+
+
+def _collect_stats() -> Dict[Labels, float]:
+    return {(("stat", stat), ("subsystem", subsystem)): value
+            for subsystem, stats in list(_stats.items()) for stat, value in list(stats.items())}
+
+
+CallbackGauge("app_stats", "Counters kept by the app's subsystems", _collect_stats)
+
+
+def register_gauge(name: str, help: str, read: Callable[[], float]):
+    """ Export a value read on scrape, e.g. a queue depth """
+    CallbackGauge(name, help, lambda: {(): read()})
+
+
+def register_quantiles(name: str, help: str, percentile: Callable[[float], float], quantiles=(50, 90, 99)):
+    """ Export percentiles the app already computes, e.g. Dispatcher.latency_percentile """
+    CallbackGauge(name, help, lambda: {(("quantile", str(q / 100)),): percentile(q) for q in quantiles})
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+metrics_endpoint = APIRouter()
+
+
+@metrics_endpoint.get("/metrics")
+def get_metrics():
+    # Sync endpoint: FastAPI runs it in a thread, some gauges read SQLite
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
@@ -1,16 +1,166 @@
+import time
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Tuple, TypeVar
 from langchain.chat_models import ChatOpenAI
-from config import TEMPERATURE_VALUE
+from langchain.callbacks.base import AsyncCallbackHandler, AsyncCallbackManager
+from langchain.schema import BaseLanguageModel, LLMResult
+from config import TEMPERATURE_VALUE, MODEL_STAGES, MODEL_LATENCY_WINDOW, MODEL_STEP_UP_AFTER
 from langchain import OpenAI
+from streaming import TokenStreamHandler, current_stream
+from resilience import DependencyTimeout, dependency
+from prompt_budget import count_tokens
+import metrics
+
+T = TypeVar("T")
+
+
+class ModelMetricsHandler(AsyncCallbackHandler):
+    """ Callback that counts the requests and tokens of a model, see metrics.py """
+
+    always_verbose = True
+
+    def __init__(self, model: str, streaming: bool):
+        self.model = model
+        self.streaming = streaming
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        metrics.llm_requests.inc(model=self.model)
+        # Streamed responses don't report their usage
+        if self.streaming:
+            tokens = sum(count_tokens(prompt, self.model) for prompt in prompts)
+            metrics.llm_tokens.inc(tokens, model=self.model, kind="prompt")
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        metrics.llm_tokens.inc(model=self.model, kind="completion")
+
+    async def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        for kind in ("prompt", "completion"):
+            if f"{kind}_tokens" in usage:
+                metrics.llm_tokens.inc(usage[f"{kind}_tokens"], model=self.model, kind=kind)
+
+
+def initialize_language_model(selected_model, streaming=False, temperature=TEMPERATURE_VALUE, max_tokens=None):
+    # Every model counts its requests and tokens, streaming models also send
+    # their tokens to the reply stream of the current request, see streaming.py
+    handlers = [ModelMetricsHandler(selected_model, streaming)]
+    kwargs = {}
+    if streaming:
+        handlers.append(TokenStreamHandler())
+        kwargs = dict(streaming=True)
+    kwargs["callback_manager"] = AsyncCallbackManager(handlers)
+    if max_tokens is not None:
+        kwargs["max_tokens"] = max_tokens
 
-def initialize_language_model(selected_model):
     if selected_model == 'gpt-3':
         # Initialize GPT-3 model here
-        return OpenAI(temperature=TEMPERATURE_VALUE)
+        return OpenAI(temperature=temperature, **kwargs)
     elif selected_model == 'gpt-3.5-turbo':
         # Initialize GPT-3.5 model here
-        return ChatOpenAI(model_name="gpt-3.5-turbo",temperature=TEMPERATURE_VALUE)
+        return ChatOpenAI(model_name="gpt-3.5-turbo",temperature=temperature, **kwargs)
     elif selected_model == 'gpt-4':
         # Initialize GPT-4 model here
-        return ChatOpenAI(model_name="gpt-4",temperature=TEMPERATURE_VALUE)
+        return ChatOpenAI(model_name="gpt-4",temperature=temperature, **kwargs)
     else:
-        raise ValueError(f"Invalid model selected: {selected_model}")
\ No newline at end of file
+        raise ValueError(f"Invalid model selected: {selected_model}")
+
+
+class StageModel:
+    """ Model choice of one prompt stage: its fallback list, current level and recent latencies """
+
+    def __init__(self, models, timeout: float, target: float, window: int):
+        self.models = models
+        self.timeout = timeout
+        self.target = target
+        # Index in models of the first model to try
+        self.level = 0
+        self.changed_at = 0.0
+        self.latencies: Deque[float] = deque(maxlen=window)
+
+    def latency_percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+
+class ModelTiers:
+    """
+    Runs each prompt stage on its configured models, see config.MODEL_STAGES.
+
+    A call that fails or times out is retried with the next model of the
+    stage, models whose circuit breaker is open are skipped. A stage whose p90 latency misses its target steps down to the next
+    model, and tries the faster model again `step_up_after` seconds later.
+    """
+
+    def __init__(self, stages: Dict[str, Dict], window: int, step_up_after: float):
+        self.stages = {name: StageModel(stage['models'], stage['timeout'], stage['target'], window)
+                       for name, stage in stages.items()}
+        self.step_up_after = step_up_after
+        self.stats = Counter({"calls": 0, "fallbacks": 0, "timeouts": 0, "errors": 0, "step_downs": 0, "step_ups": 0})
+        self._models: Dict[Tuple, BaseLanguageModel] = {}
+
+    def model(self, stage: str) -> str:
+        """ The model the next call of a stage starts with """
+        state = self.stages[stage]
+        return state.models[state.level]
+
+    def get_llm(self, model: str, **kwargs) -> BaseLanguageModel:
+        key = (model, tuple(sorted(kwargs.items())))
+        if key not in self._models:
+            self._models[key] = initialize_language_model(model, **kwargs)
+        return self._models[key]
+
+    async def call(self, stage: str, fn: Callable[[BaseLanguageModel], Awaitable[T]], **kwargs: Any) -> T:
+        """
+        Run `fn` with the models of a stage until one succeeds.
+
+        Args:
+            stage (str): Stage name, a key of config.MODEL_STAGES.
+            fn (Callable): Coroutine function that makes the call with the given model.
+            **kwargs: Model settings passed to initialize_language_model.
+
+        Returns:
+            Whatever fn returns.
+        """
+        state = self.stages[stage]
+        now = time.monotonic()
+        if state.level and now - state.changed_at >= self.step_up_after:
+            state.level -= 1
+            state.changed_at = now
+            state.latencies.clear()
+            self.stats["step_ups"] += 1
+            print(f"Stage {stage}: trying {state.models[state.level]} again")
+
+        self.stats["calls"] += 1
+        start = time.monotonic()
+        for i, model in enumerate(state.models[state.level:]):
+            if i:
+                self.stats["fallbacks"] += 1
+            try:
+                llm = self.get_llm(model, **kwargs)
+                with metrics.timed("llm", model=model, prompt=stage):
+                    result = await dependency(f"llm:{model}").call(lambda: fn(llm), timeout=state.timeout)
+                break
+            except Exception as e:
+                self.stats["timeouts" if isinstance(e, DependencyTimeout) else "errors"] += 1
+                stream = current_stream.get()
+                # A reply that is already shown to the user isn't restarted with another model
+                if state.level + i == len(state.models) - 1 or (stream is not None and stream.started):
+                    raise
+                print(f"Stage {stage}: {model} failed ({type(e).__name__}), falling back")
+        self._record(stage, state, time.monotonic() - start)
+        return result
+
+    def _record(self, stage: str, state: StageModel, seconds: float):
+        state.latencies.append(seconds)
+        if (len(state.latencies) == state.latencies.maxlen and state.level < len(state.models) - 1
+                and state.latency_percentile(90) > state.target):
+            state.level += 1
+            state.changed_at = time.monotonic()
+            state.latencies.clear()
+            self.stats["step_downs"] += 1
+            print(f"Stage {stage}: p90 latency over {state.target}s, stepping down to {state.models[state.level]}")
+
+
+model_tiers = ModelTiers(MODEL_STAGES, MODEL_LATENCY_WINDOW, MODEL_STEP_UP_AFTER)
@@ -0,0 +1,222 @@
+import time
+import random
+import asyncio
+import contextvars
+import httpx
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional, Tuple
+from resilience import CircuitBreaker
+import metrics
+
+
+class TokenBucket:
+    """ Allows `rate` operations per second on average, in bursts of up to `burst` """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Dispatcher:
+    """
+    Outbound message queue drained by a bounded set of workers.
+
+    Messages for the same key (the destination) are sent one at a time, in
+    the order they were submitted. Messages for different keys are sent
+    concurrently by up to `workers` tasks. Every send waits for the global
+    rate limit and, if `key_rate` is set, for the rate limit of its key.
+    Transport errors and responses with status 429 or 5xx are retried with
+    exponential backoff, or after the delay the server asked for. While the
+    `breaker` is open, attempts are skipped instead of sent. A message is
+    sent in the context it was submitted from, so its send spans land in the
+    trace of the message it answers.
+    """
+
+    def __init__(self, name: str, send: Callable[[Any], Awaitable[httpx.Response]], workers: int,
+                 rate: float = None, burst: float = None, key_rate: float = None, key_burst: float = None,
+                 max_attempts: int = 5, backoff: float = 0.5, breaker: CircuitBreaker = None):
+        self.name = name
+        self.send = send
+        self.workers = workers
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.key_rate = key_rate
+        self.key_burst = key_burst
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.breaker = breaker
+        self.stats = Counter({"sent": 0, "failed": 0, "retries": 0, "skipped": 0, "send_seconds": 0.0, "queue_seconds": 0.0})
+        # Latency of the most recent sends, for percentiles
+        self.latencies: Deque[float] = deque(maxlen=1000)
+        # Keys with queued or in-flight messages. A key is in the ready queue
+        # at most once, which keeps its messages in order.
+        self._pending: Dict[Hashable, Deque[Tuple[Any, asyncio.Future, float, contextvars.Context]]] = {}
+        self._key_buckets: Dict[Hashable, TokenBucket] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks = []
+
+    def depth(self) -> int:
+        """ Number of messages waiting to be sent """
+        return sum(len(queue) for queue in self._pending.values())
+
+    def latency_percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+    def submit(self, key: Hashable, payload: Any) -> asyncio.Future:
+        """
+        Queue a message.
+
+        Args:
+            key (Hashable): Destination, messages with the same key are sent in order.
+            payload (Any): Passed to `send`.
+
+        Returns:
+            asyncio.Future: Resolves to the final response, or None if the
+            message could not be sent. Callers don't have to await it.
+        """
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        queue = self._pending.get(key)
+        if queue is None:
+            queue = self._pending[key] = deque()
+            self._ready.put_nowait(key)
+        queue.append((payload, future, time.monotonic(), contextvars.copy_context()))
+        return future
+
+    def _start(self):
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+            # In an empty context, not the one of the message that happens to start them
+            self._tasks = [contextvars.Context().run(asyncio.create_task, self._work()) for _ in range(self.workers)]
+
+    async def _work(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._pending[key]
+            payload, future, enqueued, context = queue.popleft()
+            self.stats["queue_seconds"] += time.monotonic() - enqueued
+            try:
+                # Its send spans belong to the trace that queued the message
+                result = await context.run(asyncio.create_task, self._deliver(key, payload))
+            except Exception as e:
+                print(f"{self.name}: error sending message to {key}: {e}")
+                self.stats["failed"] += 1
+                result = None
+            if not future.done():
+                future.set_result(result)
+
+            if queue:
+                self._ready.put_nowait(key)
+            else:
+                del self._pending[key]
+                bucket = self._key_buckets.get(key)
+                if bucket is not None and bucket.full:
+                    del self._key_buckets[key]
+            self._ready.task_done()
+
+    async def _acquire(self, key: Hashable):
+        if self.key_rate:
+            bucket = self._key_buckets.get(key)
+            if bucket is None:
+                bucket = self._key_buckets[key] = TokenBucket(self.key_rate, self.key_burst)
+            await bucket.acquire()
+        if self.bucket is not None:
+            await self.bucket.acquire()
+
+    async def _deliver(self, key: Hashable, payload: Any) -> Optional[httpx.Response]:
+        response = None
+        for attempt in range(1, self.max_attempts + 1):
+            if self.breaker is not None and not self.breaker.allow():
+                # The API is down, wait for it without sending
+                self.stats["skipped"] += 1
+                response, delay = None, self.backoff_delay(attempt)
+            else:
+                response, delay = await self._attempt(key, payload, attempt)
+
+            if delay is None:
+                if response.is_success:
+                    self.stats["sent"] += 1
+                else:
+                    self.stats["failed"] += 1
+                    print(f"{self.name}: message to {key} rejected with {response.status_code}: {response.text}")
+                return response
+            if attempt < self.max_attempts:
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+
+        self.stats["failed"] += 1
+        print(f"{self.name}: giving up on message to {key} after {self.max_attempts} attempts")
+        return response
+
+    async def _attempt(self, key: Hashable, payload: Any, attempt: int) -> Tuple[Optional[httpx.Response], Optional[float]]:
+        await self._acquire(key)
+        start = time.perf_counter()
+        try:
+            with metrics.timed("send", platform=self.name):
+                response = await self.send(payload)
+            delay = self.retry_delay(response, attempt)
+        except httpx.TransportError as e:
+            print(f"{self.name}: {type(e).__name__} sending message to {key}")
+            response, delay = None, self.backoff_delay(attempt)
+        latency = time.perf_counter() - start
+        self.latencies.append(latency)
+        self.stats["send_seconds"] += latency
+        if self.breaker is not None:
+            # Rate limiting (429) and rejected messages don't mean the API is down
+            if response is None or response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        return response, delay
+
+    def backoff_delay(self, attempt: int) -> float:
+        """ Exponential backoff with jitter """
+        return self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+    def retry_delay(self, response: httpx.Response, attempt: int) -> Optional[float]:
+        """
+        How long to wait before retrying a response, None if it should not be retried.
+        Uses the Retry-After header of 429 and 5xx responses when there is one.
+        """
+        if response.status_code != 429 and response.status_code < 500:
+            return None
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return self.backoff_delay(attempt)
+
+    async def close(self, timeout: float = 10.0):
+        """ Wait up to `timeout` seconds for queued messages to be sent, then stop the workers """
+        if self._ready is None:
+            return
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"{self.name}: dropping {self.depth()} unsent messages")
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._ready = None
+        self._pending.clear()
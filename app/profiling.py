@@ -0,0 +1,113 @@
+import io
+import os
+import sys
+import time
+import pstats
+import asyncio
+import cProfile
+import secrets
+import threading
+from collections import Counter
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+import config
+from executor import run_sync
+
+# Innermost frames of threads that are waiting for work, left out of stack samples
+IDLE_FRAMES = {("selectors.py", "select"), ("threading.py", "wait"), ("thread.py", "_worker"), ("queue.py", "get")}
+
+stats = Counter({"profiles": 0, "refused": 0})
+
+# One profile at a time, see profile
+_running = asyncio.Lock()
+
+
+async def profile_event_loop(seconds: float, limit: int = 60) -> str:
+    """
+    Profile everything the event loop thread runs for `seconds` with cProfile.
+
+    Returns:
+        str: The `limit` functions with the most cumulative time.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+def sample_stacks(seconds: float, interval: float) -> Counter:
+    """
+    Sample the stacks of all threads every `interval` seconds. Blocking.
+
+    Returns:
+        Counter: Samples per stack, stacks as "thread;outer (file:line);...;inner (file:line)".
+    """
+    me = threading.get_ident()
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me or (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stacks[";".join([names.get(ident, str(ident))] + stack[::-1])] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def check_admin(authorization: Optional[str]):
+    if not config.ADMIN_TOKEN:
+        raise HTTPException(status_code=404)
+    if not secrets.compare_digest((authorization or "").encode(), f"Bearer {config.ADMIN_TOKEN}".encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+profiling_endpoint = APIRouter()
+
+
+@profiling_endpoint.post("/admin/profile")
+async def profile(seconds: float = 10.0, mode: str = "stack", interval: float = 0.01,
+                  authorization: Optional[str] = Header(None)):
+    """
+    Profile the running app for a few seconds, without a restart.
+
+    Args:
+        seconds (float): How long to profile, at most config.PROFILE_MAX_SECONDS.
+        mode (str): 'stack' samples the stacks of all threads (worker threads
+            included) every `interval` seconds and returns them in the
+            collapsed format of flame graph tools, most frequent first.
+            'cprofile' profiles the event loop thread with cProfile.
+        interval (float): Seconds between stack samples.
+        authorization (str): "Bearer <config.ADMIN_TOKEN>".
+
+    Returns:
+        PlainTextResponse: The profile.
+    """
+    check_admin(authorization)
+    if mode not in ("stack", "cprofile"):
+        raise HTTPException(status_code=400, detail="mode must be 'stack' or 'cprofile'")
+    if not 0 < seconds <= config.PROFILE_MAX_SECONDS or interval <= 0:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {config.PROFILE_MAX_SECONDS}]")
+    if _running.locked():
+        stats["refused"] += 1
+        raise HTTPException(status_code=409, detail="A profile is already running")
+
+    async with _running:
+        stats["profiles"] += 1
+        print(f"Profiling ({mode}) for {seconds}s")
+        if mode == "cprofile":
+            text = await profile_event_loop(seconds)
+        else:
+            stacks = await run_sync(sample_stacks, seconds, interval)
+            text = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    return PlainTextResponse(text)
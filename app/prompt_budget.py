@@ -0,0 +1,84 @@
+from collections import Counter, deque
+from typing import Deque, Dict, List, Tuple
+import tiktoken
+
+# tiktoken names of the models in config.SELECTED_MODEL
+TIKTOKEN_MODELS = {'gpt-3': 'text-davinci-003'}
+
+_encodings: Dict[str, "tiktoken.Encoding"] = {}
+
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Count the tokens of a text for a model.
+
+    Falls back to about four characters per token when the model's encoding
+    can't be loaded (tiktoken downloads it on first use).
+    """
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(TIKTOKEN_MODELS.get(model, model))
+        except Exception as e:
+            print(f"No tiktoken encoding for {model}, estimating token counts: {e}")
+            _encodings[model] = None
+    encoding = _encodings[model]
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class PromptBudget:
+    """
+    Fits the context sections of a prompt into an input token budget per model.
+
+    Retrieved turns (most relevant first) are dropped from the least relevant
+    one, then recent turns from the oldest one, until the prompt fits. The
+    size of every assembled prompt is recorded.
+    """
+
+    def __init__(self, budgets: Dict[str, int]):
+        self.budgets = budgets
+        self.stats = Counter({"prompts": 0, "prompt_tokens": 0, "tokens_trimmed": 0,
+                              "retrieved_dropped": 0, "recent_dropped": 0, "duplicates_dropped": 0})
+        # Tokens of the most recent prompts
+        self.prompt_sizes: Deque[int] = deque(maxlen=1000)
+
+    def prompt_percentile(self, p: float) -> int:
+        if not self.prompt_sizes:
+            return 0
+        sizes = sorted(self.prompt_sizes)
+        return sizes[min(len(sizes) - 1, int(p / 100 * len(sizes)))]
+
+    def fit(self, model: str, fixed: str, retrieved: List[str], recent: List[str]) -> Tuple[List[str], List[str]]:
+        """
+        Drop context until the prompt fits the model's budget.
+
+        Args:
+            model (str): Model the prompt is sent to, a key of `budgets`.
+            fixed (str): The prompt without context (template and user message).
+            retrieved (List[str]): Retrieved turns, most relevant first.
+            recent (List[str]): Recent turns, oldest first.
+
+        Returns:
+            Tuple[List[str], List[str]]: The retrieved and recent turns that fit.
+        """
+        budget = self.budgets[model]
+        retrieved_tokens = [count_tokens(text, model) + 1 for text in retrieved]
+        recent_tokens = [count_tokens(text, model) + 1 for text in recent]
+        total = count_tokens(fixed, model) + sum(retrieved_tokens) + sum(recent_tokens)
+        kept_retrieved, kept_recent = len(retrieved), 0
+        trimmed = 0
+        while total - trimmed > budget and kept_retrieved:
+            kept_retrieved -= 1
+            trimmed += retrieved_tokens[kept_retrieved]
+        while total - trimmed > budget and kept_recent < len(recent):
+            trimmed += recent_tokens[kept_recent]
+            kept_recent += 1
+
+        self.stats["prompts"] += 1
+        self.stats["prompt_tokens"] += total - trimmed
+        self.stats["tokens_trimmed"] += trimmed
+        self.stats["retrieved_dropped"] += len(retrieved) - kept_retrieved
+        self.stats["recent_dropped"] += kept_recent
+        self.prompt_sizes.append(total - trimmed)
+        return retrieved[:kept_retrieved], recent[kept_recent:]
@@ -0,0 +1,249 @@
+import time
+import asyncio
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+import config
+
+T = TypeVar("T")
+
+# Hedging starts once a dependency has this many recorded latencies
+HEDGE_MIN_SAMPLES = 20
+
+
+class DependencyError(Exception):
+    """ An external service failed or is unavailable. `message` can be sent to the user instead of a reply. """
+
+    def __init__(self, name: str, message: str, reason: str):
+        super().__init__(f"{name}: {reason}")
+        self.name = name
+        self.message = message
+
+
+class DependencyTimeout(DependencyError):
+    pass
+
+
+class CircuitOpen(DependencyError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency that keeps failing.
+
+    After `threshold` failures in a row the circuit opens and calls are
+    refused for `reset_after` seconds. Then a single trial call is let
+    through (half open): its success closes the circuit, its failure opens
+    it again.
+    """
+
+    def __init__(self, name: str, threshold: int, reset_after: float):
+        self.name = name
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_at = 0.0
+        self.stats = Counter({"opened": 0, "rejected": 0})
+
+    def allow(self) -> bool:
+        """ Whether a call may be made now, see the class docstring """
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if self.state == "open" and now - self.opened_at >= self.reset_after:
+            self.state = "half_open"
+            self._trial_at = 0.0
+        # Another trial if the previous one never reported back
+        if self.state == "half_open" and now - self._trial_at >= self.reset_after:
+            self._trial_at = now
+            return True
+        self.stats["rejected"] += 1
+        return False
+
+    def record_success(self):
+        if self.state != "closed":
+            print(f"Circuit of {self.name} closed")
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+            print(f"Circuit of {self.name} opened after {self.failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.stats["opened"] += 1
+
+
+def error_status(e: BaseException) -> Optional[int]:
+    """ HTTP status of a failed call, from the exception types of openai, httpx, requests and twilio """
+    for status in (getattr(e, "http_status", None), getattr(e, "status", None),
+                   getattr(getattr(e, "response", None), "status_code", None)):
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def transient_errors() -> tuple:
+    """ Exception types of timeouts and transport errors of the clients the dependencies use """
+    errors = [TimeoutError, ConnectionError]
+    try:
+        import openai.error
+        errors += [openai.error.Timeout, openai.error.APIConnectionError, openai.error.RateLimitError,
+                   openai.error.ServiceUnavailableError, openai.error.TryAgain]
+    except ImportError:
+        pass
+    try:
+        import httpx
+        errors.append(httpx.TransportError)
+    except ImportError:
+        pass
+    try:
+        import requests
+        errors += [requests.ConnectionError, requests.Timeout]
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+def is_service_failure(e: BaseException) -> bool:
+    """
+    Whether an error says the service is unhealthy: a timeout, a transport
+    error, rate limiting (429) or a server error (5xx). Client errors, e.g.
+    an invalid request or a prompt rejected by the safety system, are caused
+    by the input and say nothing about the service.
+    """
+    status = error_status(e)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(e, transient_errors())
+
+
+class Dependency:
+    """
+    Calls to one external service, with a timeout, a circuit breaker and
+    optional hedging.
+
+    With `hedge` set (a percentile, for idempotent calls only), a call that
+    is still running after that percentile of recent latencies is sent a
+    second time and the first answer wins.
+    """
+
+    def __init__(self, name: str, timeout: float, hedge: Optional[float] = None, threshold: int = 5,
+                 reset_after: float = 30.0, message: str = ""):
+        self.name = name
+        self.timeout = timeout
+        self.hedge = hedge
+        self.message = message
+        self.breaker = CircuitBreaker(name, threshold, reset_after)
+        self.stats = Counter({"calls": 0, "failures": 0, "client_errors": 0, "timeouts": 0, "hedged": 0, "hedge_wins": 0})
+        # Latency of the most recent successful calls
+        self.latencies: Deque[float] = deque(maxlen=1000)
+
+    def latency_percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.hedge is None or len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return self.latency_percentile(self.hedge)
+
+    async def call(self, fn: Callable[[], Awaitable[T]], timeout: float = None) -> T:
+        """
+        Make a call to the service.
+
+        Args:
+            fn (Callable): Makes the call, called twice when the call is hedged.
+            timeout (float): Overrides the dependency's timeout.
+
+        Returns:
+            Whatever fn's awaitable returns.
+
+        Raises:
+            CircuitOpen: The service failed too often recently, it was not called.
+            DependencyTimeout: No answer within the timeout.
+
+        Errors of fn are raised as they are. Only service failures, see
+        is_service_failure, count against the circuit breaker.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpen(self.name, self.message, "circuit open")
+        self.stats["calls"] += 1
+        start = time.monotonic()
+        try:
+            result = await asyncio.wait_for(self._attempts(fn), self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            self.breaker.record_failure()
+            raise DependencyTimeout(self.name, self.message, "timed out")
+        except Exception as e:
+            if not is_service_failure(e):
+                # Caused by the request, it doesn't count against the service
+                self.stats["client_errors"] += 1
+                raise
+            self.stats["failures"] += 1
+            self.breaker.record_failure()
+            raise
+        self.latencies.append(time.monotonic() - start)
+        self.breaker.record_success()
+        return result
+
+    async def _attempts(self, fn: Callable[[], Awaitable[T]]) -> T:
+        delay = self.hedge_delay()
+        first = asyncio.ensure_future(fn())
+        pending = {first}
+        hedged = False
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, timeout=None if hedged or delay is None else delay,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.stats["hedged"] += 1
+                    pending.add(asyncio.ensure_future(fn()))
+                    continue
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    if first not in succeeded:
+                        self.stats["hedge_wins"] += 1
+                    return succeeded[0].result()
+                if not pending:
+                    return done.pop().result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def status(self) -> Dict[str, Any]:
+        hedged = self.stats["hedged"]
+        return {
+            "state": self.breaker.state,
+            "failures_in_a_row": self.breaker.failures,
+            **self.stats,
+            "rejected": self.breaker.stats["rejected"],
+            "opened": self.breaker.stats["opened"],
+            "hedge_win_rate": self.stats["hedge_wins"] / hedged if hedged else 0.0,
+            "p95_seconds": self.latency_percentile(95),
+        }
+
+
+# Dependencies by name, created on first use from config.DEPENDENCIES. Names
+# can have a suffix after a colon ("llm:gpt-4"), which gets its own breaker
+# and the settings of the prefix.
+dependencies: Dict[str, Dependency] = {}
+
+
+def dependency(name: str) -> Dependency:
+    if name not in dependencies:
+        settings = dict(config.DEPENDENCIES['default'], **config.DEPENDENCIES.get(name.split(":")[0], {}))
+        dependencies[name] = Dependency(name, **settings)
+    return dependencies[name]
+
+
+def status() -> Dict[str, Dict[str, Any]]:
+    """ Breaker state, call counts and hedge win rate of every dependency used so far """
+    return {name: dep.status() for name, dep in dependencies.items()}
@@ -0,0 +1,144 @@
+import time
+import asyncio
+import hashlib
+import numpy as np
+from collections import Counter, OrderedDict
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+
+class Entry(NamedTuple):
+    value: str
+    expires: float
+    latency: float
+    vector: Optional[np.ndarray]
+
+
+class ResponseCache:
+    """
+    Cache for the stateless prompt stages (topic, image prompt, calendar extraction).
+
+    Each stage has its own entries, TTL and size bound, so an output is never
+    served to a different stage. Lookups try an exact match on
+    (history, text) first and, if the stage has a `similarity` threshold, the
+    most similar cached input by embedding cosine similarity. Outputs that
+    are still being computed count as cached: concurrent misses of the same
+    (or a similar) input wait for the first one instead of computing it again.
+    """
+
+    def __init__(self, stages: Dict[str, Dict], embed: Callable[[str], Awaitable[List[float]]] = None):
+        self.stages = stages
+        self.embed = embed
+        self.stats = {stage: Counter({"exact_hits": 0, "similar_hits": 0, "coalesced": 0, "misses": 0,
+                                      "saved_seconds": 0.0})
+                      for stage in stages}
+        self._entries: Dict[str, "OrderedDict[str, Entry]"] = {stage: OrderedDict() for stage in stages}
+        # Outputs being computed by key, with the input's vector when the stage matches similar inputs
+        self._computing: Dict[str, Dict[str, Tuple[asyncio.Future, Optional[np.ndarray]]]] = {
+            stage: {} for stage in stages}
+
+    @staticmethod
+    def key(history_string: str, text: str) -> str:
+        return hashlib.sha256(f"{history_string}\0{text}".encode("utf-8")).hexdigest()
+
+    async def get_or_compute(self, stage: str, history_string: str, text: str,
+                             compute: Callable[[], Awaitable[str]]) -> str:
+        """
+        Return the cached output of a stage, or compute and cache it.
+
+        Args:
+            stage (str): Stage name, one of the configured stages.
+            history_string (str): Formatted conversation history string.
+            text (str): Input text message.
+            compute: Coroutine function producing the output on a miss.
+
+        Returns:
+            str: The stage output.
+        """
+        settings = self.stages[stage]
+        entries = self._entries[stage]
+        computing = self._computing[stage]
+        now = time.monotonic()
+
+        key = self.key(history_string, text)
+        entry = entries.get(key)
+        if entry is not None and entry.expires <= now:
+            del entries[key]
+        elif entry is not None:
+            entries.move_to_end(key)
+            return self._hit(stage, "exact_hits", entry)
+        if key in computing:
+            return await self._wait(stage, computing[key][0], history_string, text, compute)
+
+        vector = None
+        threshold = settings.get("similarity")
+        if threshold is not None and self.embed is not None:
+            vector = np.asarray(await self.embed(f"{history_string}\n{text}"), dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+            similar_key = self._most_similar(entries, vector, threshold, time.monotonic())
+            if similar_key is not None:
+                entries.move_to_end(similar_key)
+                return self._hit(stage, "similar_hits", entries[similar_key])
+            # The same input may have started computing while this one was embedded
+            similar_key = key if key in computing else self._most_similar_computing(computing, vector, threshold)
+            if similar_key is not None:
+                return await self._wait(stage, computing[similar_key][0], history_string, text, compute)
+
+        self.stats[stage]["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        computing[key] = (future, vector)
+        start = time.perf_counter()
+        try:
+            value = await compute()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Nobody else may be waiting, don't warn about an unretrieved exception
+                future.exception()
+            raise
+        finally:
+            del computing[key]
+        future.set_result(value)
+        latency = time.perf_counter() - start
+        entries[key] = Entry(value, time.monotonic() + settings["ttl"], latency, vector)
+        while len(entries) > settings["max_entries"]:
+            entries.popitem(last=False)
+        return value
+
+    async def _wait(self, stage: str, future: asyncio.Future, history_string: str, text: str,
+                    compute: Callable[[], Awaitable[str]]) -> str:
+        """ Wait for the output another request is computing, compute it anew if that request was cancelled """
+        self.stats[stage]["coalesced"] += 1
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+        return await self.get_or_compute(stage, history_string, text, compute)
+
+    def _hit(self, stage: str, kind: str, entry: Entry) -> str:
+        self.stats[stage][kind] += 1
+        self.stats[stage]["saved_seconds"] += entry.latency
+        return entry.value
+
+    @staticmethod
+    def _most_similar_computing(computing: Dict[str, Tuple[asyncio.Future, Optional[np.ndarray]]],
+                                vector: np.ndarray, threshold: float) -> Optional[str]:
+        candidates = [(key, v) for key, (_, v) in computing.items() if v is not None]
+        if not candidates:
+            return None
+        similarities = np.stack([v for _, v in candidates]) @ vector
+        best = int(np.argmax(similarities))
+        return candidates[best][0] if similarities[best] >= threshold else None
+
+    @staticmethod
+    def _most_similar(entries: "OrderedDict[str, Entry]", vector: np.ndarray, threshold: float,
+                      now: float) -> Optional[str]:
+        candidates = [(key, entry.vector) for key, entry in entries.items()
+                      if entry.vector is not None and entry.expires > now]
+        if not candidates:
+            return None
+        similarities = np.stack([v for _, v in candidates]) @ vector
+        best = int(np.argmax(similarities))
+        return candidates[best][0] if similarities[best] >= threshold else None
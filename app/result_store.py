@@ -0,0 +1,122 @@
+import os
+import json
+import threading
+import numpy as np
+from typing import Any, Dict, List, NamedTuple, Tuple
+from executor import run_sync
+from resilience import dependency
+
+# (id, embedding, metadata) as in Pinecone upserts
+Item = Tuple[str, List[float], Dict[str, Any]]
+
+
+class Match(NamedTuple):
+    score: float
+    metadata: Dict[str, Any]
+
+
+class LocalResultStore:
+    """
+    BabyAGI results in a NumPy matrix, for running without a vector service.
+
+    Rows are normalized so a dot product is the cosine similarity, like the
+    Pinecone index. Upserts are appended to `path`.f32 (raw float32 rows) and
+    `path`.jsonl (id and metadata per row), so saving costs the new rows
+    only. Upserting an existing id appends a new row that replaces the old one.
+    """
+
+    def __init__(self, path: str, d: int = 1536):
+        self.path = path
+        self.d = d
+        self._lock = threading.Lock()
+        self._matrix = np.zeros((1024, d), dtype=np.float32)
+        self.n = 0
+        self.ids: List[str] = []
+        self.metadata: List[Dict[str, Any]] = []
+        # Latest row of each id, and the rows of each objective
+        self._positions: Dict[str, int] = {}
+        self._rows: Dict[str, List[int]] = {}
+        if os.path.exists(path + '.jsonl'):
+            self._load()
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._matrix[:self.n]
+
+    def _load(self):
+        with open(self.path + '.jsonl') as f:
+            lines = [json.loads(line) for line in f if line.endswith('\n')]
+        vectors = np.fromfile(self.path + '.f32', dtype=np.float32)
+        vectors = vectors[:len(vectors) // self.d * self.d].reshape(-1, self.d)
+        # A crash between the two appends leaves one file longer than the other
+        n = min(len(lines), len(vectors))
+        self._append([line["id"] for line in lines[:n]], vectors[:n], [line["metadata"] for line in lines[:n]])
+
+    def _append(self, ids: List[str], vectors: np.ndarray, metadata: List[Dict[str, Any]]):
+        if self.n + len(ids) > len(self._matrix):
+            capacity = max(2 * len(self._matrix), self.n + len(ids))
+            self._matrix = np.vstack([self._matrix, np.zeros((capacity - len(self._matrix), self.d), dtype=np.float32)])
+        self._matrix[self.n:self.n + len(ids)] = vectors
+        for i, (vector_id, meta) in enumerate(zip(ids, metadata), start=self.n):
+            previous = self._positions.get(vector_id)
+            if previous is not None:
+                self._rows[self.metadata[previous].get("objective_id")].remove(previous)
+            self._positions[vector_id] = i
+            self._rows.setdefault(meta.get("objective_id"), []).append(i)
+        self.ids += ids
+        self.metadata += metadata
+        self.n += len(ids)
+
+    def _upsert(self, items: List[Item]):
+        ids = [vector_id for vector_id, _, _ in items]
+        metadata = [meta for _, _, meta in items]
+        vectors = np.asarray([vector for _, vector, _ in items], dtype=np.float32).reshape(-1, self.d)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + '.f32', 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.path + '.jsonl', 'a') as f:
+                f.writelines(json.dumps({"id": vector_id, "metadata": meta}) + '\n'
+                             for vector_id, meta in zip(ids, metadata))
+            self._append(ids, vectors, metadata)
+
+    def _query(self, vector: List[float], n: int, objective_id: str) -> List[Match]:
+        with self._lock:
+            rows = np.array(self._rows.get(objective_id, []), dtype=np.int64)
+            if not len(rows):
+                return []
+            query = np.asarray(vector, dtype=np.float32)
+            scores = self._matrix[rows] @ (query / max(np.linalg.norm(query), 1e-12))
+            best = np.argsort(-scores)[:n]
+            return [Match(float(scores[i]), self.metadata[rows[i]]) for i in best]
+
+    async def upsert(self, items: List[Item]):
+        await run_sync(self._upsert, items)
+
+    async def query(self, vector: List[float], n: int, objective_id: str) -> List[Match]:
+        return await run_sync(self._query, vector, n, objective_id)
+
+
+class PineconeResultStore:
+    """ BabyAGI results in a Pinecone index, one index handle (and connection pool) for the whole process """
+
+    def __init__(self, index_name: str, api_key: str, environment: str, d: int = 1536, batch_size: int = 100):
+        # Only imported when Pinecone is configured, the client is slow to import
+        import pinecone
+        pinecone.init(api_key=api_key, environment=environment)
+        if index_name not in pinecone.list_indexes():
+            pinecone.create_index(index_name, dimension=d, metric="cosine", pod_type="p1")
+        self.index = pinecone.Index(index_name)
+        self.batch_size = batch_size
+
+    async def upsert(self, items: List[Item]):
+        # The Pinecone client is sync only
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            await dependency("pinecone").call(lambda: run_sync(self.index.upsert, batch))
+
+    async def query(self, vector: List[float], n: int, objective_id: str) -> List[Match]:
+        results = await dependency("pinecone").call(lambda: run_sync(
+            self.index.query, vector, top_k=n, include_metadata=True, filter={"objective_id": objective_id}))
+        return [Match(match.score, match.metadata) for match in results.matches]
@@ -0,0 +1,289 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import asyncio
+import threading
+from collections import Counter
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+import config
+from executor import run_sync
+
+TOPICS = ("chat", "image", "calendar")
+
+# A routing stage returns (topic, confidence) or None when it has no opinion
+Decision = Optional[Tuple[str, float]]
+
+CALENDAR_WORDS = re.compile(
+    r"\b(calendar|agenda|meeting|appointment|event|schedule|reschedule|remind me|reminder)\b", re.I)
+MONTHS = (r"(jan(uary)?|feb(ruary)?|mar(ch)?|apr(il)?|may|june?|july?|aug(ust)?|sept?(ember)?|oct(ober)?"
+          r"|nov(ember)?|dec(ember)?)\.?")
+DAY = r"\d{1,2}(st|nd|rd|th)?"
+# Month names only count with a day number next to them, "may" and "mar" are everyday words too
+CALENDAR_DATES = re.compile(
+    r"\b(today|tonight|tomorrow|next (week|month|year)|(mon|tues|wednes|thurs|fri|satur|sun)day"
+    rf"|{MONTHS}\s+{DAY}|{DAY}\s+(of\s+)?{MONTHS}|\d{{1,2}}[-/.]\d{{1,2}}([-/.]\d{{2,4}})?)\b", re.I)
+CALENDAR_TIMES = re.compile(r"\b(\d{1,2}:\d{2}|\d{1,2}\s?(am|pm)|noon|midnight)\b", re.I)
+WORDS = re.compile(r"[a-z0-9']+")
+
+
+def normalize_topic(raw: str) -> str:
+    """
+    Map a free-form LLM answer onto one of the known topics.
+
+    Args:
+        raw (str): Raw model output, e.g. " Image." or "calendar\\n".
+
+    Returns:
+        str: One of TOPICS, "chat" when nothing matches.
+    """
+    words = WORDS.findall(raw.lower())
+    for word in words:
+        if word in TOPICS:
+            return word
+    return "chat"
+
+
+class RuleStage:
+    """
+    Deterministic rules: documented commands and calendar date/time patterns.
+
+    Commands are certain. A calendar pattern only gets `calendar_confidence`,
+    so a more confident later stage can still override it.
+    """
+
+    name = "rules"
+
+    def __init__(self, calendar_confidence: float = config.TOPIC_ROUTER_RULE_CONFIDENCE):
+        self.calendar_confidence = calendar_confidence
+
+    def __call__(self, text: str, history_string: str) -> Decision:
+        lowered = text.strip().lower()
+        if "/image" in lowered:
+            return "image", 1.0
+        # /task only reaches the router when BabyAGI is disabled, answer it as chat
+        if lowered.startswith("/task"):
+            return "chat", 1.0
+        if CALENDAR_WORDS.search(text) and (CALENDAR_DATES.search(text) or CALENDAR_TIMES.search(text)):
+            return "calendar", self.calendar_confidence
+        return None
+
+
+class NaiveBayesClassifier:
+    """Multinomial naive Bayes over word counts, small enough to keep as JSON on disk."""
+
+    def __init__(self, doc_counts: Dict[str, int] = None, word_counts: Dict[str, Dict[str, int]] = None):
+        self.doc_counts = doc_counts or {}
+        self.word_counts = word_counts or {}
+        self._totals = {topic: sum(counts.values()) for topic, counts in self.word_counts.items()}
+        self._vocab = {word for counts in self.word_counts.values() for word in counts}
+
+    @classmethod
+    def fit(cls, samples: Iterable[Tuple[str, str]]) -> "NaiveBayesClassifier":
+        doc_counts = Counter()
+        word_counts: Dict[str, Counter] = {}
+        for text, topic in samples:
+            doc_counts[topic] += 1
+            word_counts.setdefault(topic, Counter()).update(WORDS.findall(text.lower()))
+        return cls(dict(doc_counts), {topic: dict(counts) for topic, counts in word_counts.items()})
+
+    def predict(self, text: str) -> Decision:
+        if not self.doc_counts:
+            return None
+        words = WORDS.findall(text.lower())
+        n_docs = sum(self.doc_counts.values())
+        vocab_size = len(self._vocab) + 1
+        scores = {}
+        for topic, n in self.doc_counts.items():
+            counts = self.word_counts.get(topic, {})
+            denominator = self._totals.get(topic, 0) + vocab_size
+            score = math.log(n / n_docs)
+            for word in words:
+                score += math.log((counts.get(word, 0) + 1) / denominator)
+            scores[topic] = score
+        best = max(scores, key=scores.get)
+        # Softmax over the log scores gives the posterior of the best topic
+        top = scores[best]
+        probability = 1.0 / sum(math.exp(score - top) for score in scores.values())
+        return best, probability
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"doc_counts": self.doc_counts, "word_counts": self.word_counts}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "NaiveBayesClassifier":
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data["doc_counts"], data["word_counts"])
+
+
+class LocalClassifierStage:
+    """Runs the on-disk classifier, if one has been trained. Its confidence is capped at `max_confidence`."""
+
+    name = "local"
+
+    def __init__(self, model_path: str, max_confidence: float = config.TOPIC_ROUTER_CLASSIFIER_MAX_CONFIDENCE):
+        self.model_path = model_path
+        self.max_confidence = max_confidence
+        self.model = None
+        self.reload()
+
+    def reload(self):
+        try:
+            self.model = NaiveBayesClassifier.load(self.model_path)
+        except FileNotFoundError:
+            self.model = None
+
+    def __call__(self, text: str, history_string: str) -> Decision:
+        if self.model is None:
+            return None
+        decision = self.model.predict(text)
+        if decision is None:
+            return None
+        topic, confidence = decision
+        return topic, min(confidence, self.max_confidence)
+
+
+class TopicRouter:
+    """
+    Pluggable routing stage in front of the LLM topic prompt.
+
+    Stages run in order. A certain decision (confidence 1.0, only commands
+    are) wins right away, otherwise the most confident decision at or above the
+    threshold wins, the earlier stage on a tie. Without one the LLM fallback
+    is awaited. Every decision is appended to a JSON lines log so the local
+    classifier can be retrained offline. Like the conversation store, log
+    entries are buffered and written from a worker thread every
+    `flush_every` decisions or `flush_interval` seconds, and on shutdown.
+    """
+
+    def __init__(self, fallback: Callable[[str, str], Awaitable[str]], stages: List[Callable] = None,
+                 threshold: float = config.TOPIC_ROUTER_THRESHOLD, log_path: Optional[str] = config.TOPIC_ROUTER_LOG,
+                 flush_interval: float = config.STORE_FLUSH_INTERVAL, flush_every: int = config.STORE_FLUSH_EVERY):
+        self.fallback = fallback
+        self.stages = stages if stages is not None else [RuleStage(), LocalClassifierStage(config.TOPIC_ROUTER_MODEL)]
+        self.threshold = threshold
+        self.log_path = log_path
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self.stats = Counter({"total": 0, "llm": 0})
+        self._pending: List[str] = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._flushing = False
+
+    async def route(self, text: str, history_string: str) -> str:
+        """
+        Decide the topic of a message.
+
+        Args:
+            text (str): Input text message.
+            history_string (str): Formatted conversation history string.
+
+        Returns:
+            str: One of TOPICS.
+        """
+        topic = self.route_local(text, history_string)
+        if topic is not None:
+            return topic
+        return await self.route_llm(text, history_string)
+
+    def route_local(self, text: str, history_string: str) -> Optional[str]:
+        """
+        Run only the local stages.
+
+        Returns:
+            Optional[str]: The topic, or None when the LLM would have to be asked.
+        """
+        best, best_stage = None, None
+        for stage in self.stages:
+            decision = stage(text, history_string)
+            if decision is None or decision[1] < self.threshold:
+                continue
+            if best is None or decision[1] > best[1]:
+                best, best_stage = decision, stage
+            if best[1] >= 1.0:
+                break
+        if best is None:
+            return None
+        return self._record(text, best[0], best_stage.name, best[1])
+
+    async def route_llm(self, text: str, history_string: str) -> str:
+        """Ask the LLM fallback directly, skipping the local stages."""
+        topic = normalize_topic(await self.fallback(text, history_string))
+        return self._record(text, topic, "llm", None)
+
+    def fallback_rate(self) -> float:
+        """Share of routed messages that needed the LLM."""
+        return self.stats["llm"] / self.stats["total"] if self.stats["total"] else 0.0
+
+    def _record(self, text: str, topic: str, source: str, confidence: Optional[float]) -> str:
+        self.stats["total"] += 1
+        self.stats[source] += 1
+        if self.log_path:
+            entry = {"ts": time.time(), "text": text, "topic": topic, "source": source, "confidence": confidence}
+            with self._lock:
+                self._pending.append(json.dumps(entry) + "\n")
+                due = len(self._pending) >= self.flush_every and not self._flushing
+            if due:
+                self._flush_soon()
+        return topic
+
+    def _flush_soon(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not on the event loop, e.g. a script, writing right away blocks nobody
+            self.flush()
+            return
+        self._flushing = True
+        loop.create_task(run_sync(self.flush)).add_done_callback(self._flushed)
+
+    def _flushed(self, task: asyncio.Task):
+        self._flushing = False
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Writing the topic decision log failed: {task.exception()}")
+
+    def flush(self):
+        """ Append the buffered decisions to the log, blocking """
+        # Flushes write one at a time, so the log keeps the order of the decisions
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending or not self.log_path:
+                return
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            with open(self.log_path, "a") as f:
+                f.writelines(pending)
+
+
+def retrain(log_path: str = config.TOPIC_ROUTER_LOG, model_path: str = config.TOPIC_ROUTER_MODEL) -> int:
+    """
+    Retrain the local classifier from the decision log.
+
+    Only rule and LLM decisions are used as labels, so the classifier never
+    learns from its own guesses.
+
+    Returns:
+        int: Number of training samples used.
+    """
+    samples = []
+    with open(log_path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry["source"] in ("rules", "llm") and entry["topic"] in TOPICS:
+                samples.append((entry["text"], entry["topic"]))
+    NaiveBayesClassifier.fit(samples).save(model_path)
+    return len(samples)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["retrain"]:
+        sys.exit("usage: python router.py retrain")
+    print(f"Trained topic classifier on {retrain()} decisions")
@@ -0,0 +1,132 @@
+import time
+import asyncio
+import contextvars
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Tuple
+
+
+class MailboxFull(Exception):
+    """ Raised for a message that arrives while its chat's mailbox is full (overflow policy "reject") """
+
+
+class ChatScheduler:
+    """
+    Processes the messages of each chat one at a time, in arrival order.
+
+    Every chat has a mailbox drained by its own task, so per-chat state (the
+    last messages, the chat memory) is never updated by two messages at once.
+    At most `workers` messages are processed at the same time across all
+    chats. When `max_queue` messages of a chat are already waiting, a new one
+    is handled according to `overflow`:
+
+    - "drop_oldest": the oldest waiting message is dropped.
+    - "merge": the new message is appended to the newest waiting one.
+    - "reject": the new message is rejected with MailboxFull.
+
+    Dropped messages, and messages merged into a later one, resolve to None.
+    The handler runs in the context of the code that submitted the message,
+    so context variables (e.g. the reply stream) carry over.
+    """
+
+    OVERFLOW_POLICIES = ("drop_oldest", "merge", "reject")
+
+    def __init__(self, handler: Callable[[str, Any], Awaitable[Any]], workers: int, max_queue: int,
+                 overflow: str = "merge"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy: {overflow}. Valid policies are {self.OVERFLOW_POLICIES}.")
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.stats = Counter({"processed": 0, "dropped": 0, "merged": 0, "rejected": 0, "queue_seconds": 0.0})
+        # Queue wait of the most recent messages, for percentiles
+        self.waits: Deque[float] = deque(maxlen=1000)
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(workers)
+        self._mailboxes: Dict[str, Deque[Tuple[Any, str, asyncio.Future, float, contextvars.Context]]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def depth(self) -> int:
+        """ Number of messages waiting across all chats """
+        return sum(len(mailbox) for mailbox in self._mailboxes.values())
+
+    def wait_percentile(self, p: float) -> float:
+        if not self.waits:
+            return 0.0
+        waits = sorted(self.waits)
+        return waits[min(len(waits) - 1, int(p / 100 * len(waits)))]
+
+    def submit(self, chat_id, text: str) -> asyncio.Future:
+        """
+        Put a message in the mailbox of its chat.
+
+        Args:
+            chat_id: Chat id, normalized to str so int and str ids share a mailbox.
+            text (str): The message.
+
+        Returns:
+            asyncio.Future: Resolves to the handler's result, or None if the
+            message was dropped or merged into a later one.
+
+        Raises:
+            MailboxFull: The mailbox is full and the overflow policy is "reject".
+        """
+        key = str(chat_id)
+        mailbox = self._mailboxes.setdefault(key, deque())
+        future = asyncio.get_running_loop().create_future()
+
+        if len(mailbox) >= self.max_queue:
+            if self.overflow == "reject":
+                self.stats["rejected"] += 1
+                raise MailboxFull(f"Chat {chat_id} has {len(mailbox)} messages waiting")
+            elif self.overflow == "drop_oldest":
+                _, _, dropped, _, _ = mailbox.popleft()
+                if not dropped.done():
+                    dropped.set_result(None)
+                self.stats["dropped"] += 1
+            else:
+                # Answer both messages with a single reply, to the newer one
+                _, previous_text, merged, enqueued, _ = mailbox.pop()
+                if not merged.done():
+                    merged.set_result(None)
+                self.stats["merged"] += 1
+                mailbox.append((chat_id, f"{previous_text}\n{text}", future, enqueued, contextvars.copy_context()))
+                return future
+
+        mailbox.append((chat_id, text, future, time.monotonic(), contextvars.copy_context()))
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._drain(key))
+        return future
+
+    async def run(self, chat_id, text: str) -> Any:
+        """ Submit a message and wait for its result """
+        return await self.submit(chat_id, text)
+
+    async def _drain(self, key: str):
+        mailbox = self._mailboxes[key]
+        try:
+            while mailbox:
+                chat_id, text, future, enqueued, context = mailbox.popleft()
+                if future.done():
+                    # The sender stopped waiting
+                    continue
+                async with self._semaphore:
+                    wait = time.monotonic() - enqueued
+                    self.waits.append(wait)
+                    self.stats["queue_seconds"] += wait
+                    self.in_flight += 1
+                    try:
+                        # create_task(context=) needs Python 3.11, the task copies the context it is created in
+                        result = await context.run(asyncio.create_task, self.handler(text, chat_id))
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+                    else:
+                        if not future.done():
+                            future.set_result(result)
+                    finally:
+                        self.in_flight -= 1
+                        self.stats["processed"] += 1
+        finally:
+            del self._mailboxes[key]
+            del self._tasks[key]
@@ -0,0 +1,152 @@
+import time
+import asyncio
+from contextlib import nullcontext
+from collections import Counter, OrderedDict
+from typing import Any, AsyncContextManager, Awaitable, Callable, Dict, Iterable, Optional, Set
+from executor import run_sync
+
+
+class SessionCache:
+    """
+    LRU/TTL cache of per-chat sessions (the chat chain with its memory).
+
+    The cache is bounded both by number of entries and by an estimated size
+    in bytes. Concurrent requests for a chat that is still loading wait for
+    the same load instead of loading it twice. Evicted sessions are handed
+    to `on_evict` so their state can be written back to disk.
+
+    Write-backs run in a task that holds `lock(chat_id)`, so they never run
+    alongside a message of the same chat, and an eviction while the caller
+    holds another chat's lock can't deadlock. `is_stale(chat_id)` is called
+    when a session is evicted and returns an awaitable, checked under the
+    lock: a session another worker changed since it was loaded is dropped
+    instead of overwriting the newer state.
+    """
+
+    def __init__(self, loader: Callable[[str], Any], max_entries: int, ttl: float,
+                 max_bytes: Optional[int] = None, sizeof: Callable[[Any], int] = None,
+                 on_evict: Callable[[str, Any], None] = None,
+                 lock: Callable[[str], AsyncContextManager] = None,
+                 is_stale: Callable[[str], Awaitable[bool]] = None):
+        self.loader = loader
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.on_evict = on_evict
+        self.lock = lock or (lambda chat_id: nullcontext())
+        self.is_stale = is_stale
+        self.stats = Counter({"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "discarded": 0,
+                              "stale_evictions": 0, "write_back_errors": 0})
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._writing: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, chat_id) -> bool:
+        return str(chat_id) in self._entries
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(self.sizeof(value) for value, _ in self._entries.values())
+
+    async def get(self, chat_id) -> Any:
+        """
+        Return the session of a chat, loading it in the worker pool on a miss.
+
+        Args:
+            chat_id: Chat id, normalized to str so int and str ids share an entry.
+
+        Returns:
+            Any: Whatever the loader returns.
+        """
+        key = str(chat_id)
+        await self._expire()
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[1] = time.monotonic()
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+
+        if key in self._loading:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self._loading[key])
+
+        self.stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            value = await run_sync(self.loader, key)
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody else may be waiting, don't warn about an unretrieved exception
+            future.exception()
+            raise
+        finally:
+            del self._loading[key]
+        future.set_result(value)
+        self._entries[key] = [value, time.monotonic()]
+        await self._shrink()
+        return value
+
+    async def evict(self, chat_id):
+        """ Drop a chat from the cache and start writing its state back, see write_back """
+        key = str(chat_id)
+        if key in self._entries:
+            value, _ = self._entries.pop(key)
+            self.stats["evictions"] += 1
+            if self.on_evict is not None:
+                stale = self.is_stale(key) if self.is_stale is not None else None
+                task = asyncio.create_task(self._write_back(key, value, stale))
+                self._writing.add(task)
+                task.add_done_callback(self._writing.discard)
+
+    async def _write_back(self, key: str, value: Any, stale: Optional[Awaitable[bool]]):
+        try:
+            async with self.lock(key):
+                if stale is not None and await stale:
+                    self.stats["stale_evictions"] += 1
+                    return
+                await run_sync(self.on_evict, key, value)
+        except Exception as e:
+            self.stats["write_back_errors"] += 1
+            print(f"Saving evicted session of chat {key} failed: {e}")
+
+    async def flush(self):
+        """ Wait for the write-backs of evicted sessions """
+        while self._writing:
+            await asyncio.gather(*self._writing)
+
+    def discard(self, chat_id):
+        """ Drop a chat from the cache without writing it back, e.g. when another worker changed the chat """
+        if self._entries.pop(str(chat_id), None) is not None:
+            self.stats["discarded"] += 1
+
+    async def clear(self):
+        for key in list(self._entries):
+            await self.evict(key)
+        await self.flush()
+
+    async def warm_up(self, chat_ids: Iterable):
+        """ Load the given chats ahead of their first message """
+        for chat_id in chat_ids:
+            if len(self._entries) >= self.max_entries:
+                break
+            await self.get(chat_id)
+
+    async def _expire(self):
+        # Entries are kept in last-used order, so expired ones are at the front
+        now = time.monotonic()
+        while self._entries:
+            key, (_, last_used) = next(iter(self._entries.items()))
+            if now - last_used < self.ttl:
+                break
+            await self.evict(key)
+
+    async def _shrink(self):
+        while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and len(self._entries) > 1 and self.size_bytes > self.max_bytes):
+            await self.evict(next(iter(self._entries)))
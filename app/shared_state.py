@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import fcntl
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+import config
+from executor import run_sync
+
+
+class StateBackend:
+    """
+    State the workers of the app share, by chat.
+
+    - lock(key): only one worker at a time holds the lock of a key, e.g. while
+      it answers a message of the chat.
+    - version(chat_id) / bump(chat_id): the chat state version goes up every
+      time a worker changes the chat's memory. A worker whose cached session
+      was loaded at an older version drops it and loads the chat again.
+    - get / set / delete: small JSON values by namespace and key.
+
+    A networked store (e.g. Redis with SET NX PX locks and INCR versions) has
+    to implement these methods with the same meaning. `shared` tells whether
+    other processes see the state, writes that other workers must read (the
+    conversation store) are only flushed eagerly then.
+    """
+
+    shared = False
+
+    def lock(self, key: str):
+        raise NotImplementedError
+
+    async def version(self, chat_id: str) -> int:
+        raise NotImplementedError
+
+    async def bump(self, chat_id: str) -> int:
+        """ Increment the state version of a chat and return the new version """
+        raise NotImplementedError
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def set(self, namespace: str, key: str, value: Any):
+        raise NotImplementedError
+
+    async def delete(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ProcessStateBackend(StateBackend):
+    """ State in the memory of this process, for a single worker """
+
+    def __init__(self):
+        self._locks: Dict[str, list] = {}
+        self._versions: Dict[str, int] = {}
+        self._values: Dict[tuple, Any] = {}
+
+    @asynccontextmanager
+    async def lock(self, key: str) -> AsyncIterator[None]:
+        # The lock of a key and how many hold or wait for it, forgotten at 0
+        entry = self._locks.setdefault(str(key), [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[str(key)]
+
+    async def version(self, chat_id: str) -> int:
+        return self._versions.get(str(chat_id), 0)
+
+    async def bump(self, chat_id: str) -> int:
+        version = self._versions[str(chat_id)] = self._versions.get(str(chat_id), 0) + 1
+        return version
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        return self._values.get((namespace, str(key)))
+
+    async def set(self, namespace: str, key: str, value: Any):
+        self._values[(namespace, str(key))] = value
+
+    async def delete(self, namespace: str, key: str):
+        self._values.pop((namespace, str(key)), None)
+
+
+class SQLiteStateBackend(StateBackend):
+    """
+    State in a SQLite database (WAL mode) and lock files, shared by the
+    processes on one machine.
+
+    Locks are flock()s on a file per key, so the kernel releases the locks of a
+    worker that dies. Waiting for a lock polls with backoff instead of
+    blocking a worker thread.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, lock_dir: str, poll_min: float = 0.002, poll_max: float = 0.05):
+        self.path = path
+        self.lock_dir = lock_dir
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS state_values (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (namespace, key))""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS chat_versions (
+                chat_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL)""")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _lock_path(self, key: str) -> str:
+        # Chat ids like "whatsapp:+123" are not safe file names
+        return os.path.join(self.lock_dir, hashlib.sha1(str(key).encode()).hexdigest()[:20] + ".lock")
+
+    @asynccontextmanager
+    async def lock(self, key: str) -> AsyncIterator[None]:
+        os.makedirs(self.lock_dir, exist_ok=True)
+        fd = os.open(self._lock_path(key), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            delay = self.poll_min
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.poll_max)
+            yield
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+
+    def _version(self, chat_id: str) -> int:
+        with self._lock:
+            row = self._connect().execute("SELECT version FROM chat_versions WHERE chat_id = ?", (str(chat_id),)).fetchone()
+        return 0 if row is None else row[0]
+
+    def _bump(self, chat_id: str) -> int:
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                # No UPSERT ... RETURNING, it needs SQLite 3.35 and the Docker image has 3.27.
+                # The write lock is taken first, so the version read back is this bump's.
+                conn.execute("BEGIN IMMEDIATE")
+                if not conn.execute("UPDATE chat_versions SET version = version + 1 WHERE chat_id = ?", (str(chat_id),)).rowcount:
+                    conn.execute("INSERT INTO chat_versions (chat_id, version) VALUES (?, 1)", (str(chat_id),))
+                return conn.execute("SELECT version FROM chat_versions WHERE chat_id = ?", (str(chat_id),)).fetchone()[0]
+
+    def _get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._connect().execute("SELECT value FROM state_values WHERE namespace = ? AND key = ?",
+                                          (namespace, str(key))).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _set(self, namespace: str, key: str, value: Any):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO state_values (namespace, key, value, updated) VALUES (?, ?, ?, ?)",
+                             (namespace, str(key), json.dumps(value), time.time()))
+
+    def _delete(self, namespace: str, key: str):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM state_values WHERE namespace = ? AND key = ?", (namespace, str(key)))
+
+    async def version(self, chat_id: str) -> int:
+        return await run_sync(self._version, chat_id)
+
+    async def bump(self, chat_id: str) -> int:
+        return await run_sync(self._bump, chat_id)
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        return await run_sync(self._get, namespace, key)
+
+    async def set(self, namespace: str, key: str, value: Any):
+        await run_sync(self._set, namespace, key, value)
+
+    async def delete(self, namespace: str, key: str):
+        await run_sync(self._delete, namespace, key)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def create_backend(name: str) -> StateBackend:
+    if name == 'process':
+        return ProcessStateBackend()
+    elif name == 'sqlite':
+        return SQLiteStateBackend(config.STATE_DB, config.STATE_LOCK_DIR)
+    raise ValueError(f"Invalid STATE_BACKEND: {name}. Valid backends are 'process' and 'sqlite'.")
+
+
+backend = create_backend(config.STATE_BACKEND)
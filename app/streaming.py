@@ -0,0 +1,83 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+from langchain.callbacks.base import AsyncCallbackHandler
+
+# Time from the LLM request to its first token, for the most recent streamed replies
+first_token_latencies: Deque[float] = deque(maxlen=1000)
+
+
+def first_token_percentile(p: float) -> float:
+    if not first_token_latencies:
+        return 0.0
+    latencies = sorted(first_token_latencies)
+    return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+
+class ReplyStream:
+    """
+    Receives the tokens of a chat reply while it is generated.
+
+    Platforms subclass it: `on_text` shows the partial reply, `finish`
+    delivers the final output (which may be an image or a canned answer
+    instead of the streamed text) and returns False if nothing was shown,
+    so the caller sends the output as usual.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.llm_started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+
+    @property
+    def started(self) -> bool:
+        return bool(self.text)
+
+    def llm_started(self):
+        self.llm_started_at = time.monotonic()
+
+    async def push(self, token: str):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+            if self.llm_started_at is not None:
+                first_token_latencies.append(self.first_token_at - self.llm_started_at)
+        self.text += token
+        await self.on_text(self.text)
+
+    async def on_text(self, text: str):
+        pass
+
+    async def finish(self, output: Union[str, Tuple[str, str]]) -> bool:
+        raise NotImplementedError
+
+
+# Stream of the reply the current request is generating, see stream_reply
+current_stream: ContextVar[Optional[ReplyStream]] = ContextVar("current_stream", default=None)
+
+
+@contextmanager
+def stream_reply(stream: Optional[ReplyStream]):
+    """ Send the tokens of streaming LLMs called within this block to `stream` (None disables streaming) """
+    token = current_stream.set(stream)
+    try:
+        yield stream
+    finally:
+        current_stream.reset(token)
+
+
+class TokenStreamHandler(AsyncCallbackHandler):
+    """ Callback of streaming LLMs, forwards their tokens to the stream of the current request """
+
+    always_verbose = True
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        stream = current_stream.get()
+        if stream is not None:
+            stream.llm_started()
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        stream = current_stream.get()
+        if stream is not None:
+            await stream.push(token)
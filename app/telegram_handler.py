@@ -1,43 +1,40 @@
 import os
-from fastapi import APIRouter, Request
-import httpx
 import telegram
 from chat_handler import process_chat_message
 from voice_handler import process_voice_message
-from config import TELEGRAM_BOT_TOKEN, BABYAGI
-from babyagi import process_task
-
-BASE_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
-client = httpx.AsyncClient()
+from config import TELEGRAM_BOT_TOKEN, BABYAGI, STREAM_REPLIES
+from babyagi import process_task, cancel_tasks
+from telegram_sender import send_message, send_photo, TelegramReplyStream
+from streaming import stream_reply
+from job_queue import queue as job_queue
+import metrics
 
 if TELEGRAM_BOT_TOKEN is not None:
     bot = telegram.Bot(token=TELEGRAM_BOT_TOKEN)
 else:
     bot = None
 
-telegram_webhook = APIRouter()
-
 
-@telegram_webhook.post("/webhook/")
-async def handle_telegram_webhook(req: Request):
+async def process_telegram_update(data: dict):
     """
     Handle incoming text or voice messages from Telegram and generate appropriate responses.
 
     Args:
-        req (Request): Incoming request containing message data.
+        data (dict): The Telegram update.
 
     Returns:
         dict: The generated response as a text message or a photo with a caption, depending on the type of output.
     """
-    if bot is None:
-        return {"message": "Telegram bot token is not configured. Please set the TELEGRAM_BOT_TOKEN environment variable."}
-
-    data = await req.json()
+    metrics.current_platform.set("telegram")
+    if job_queue.progress("replied"):
+        # A retried job that got its reply out already
+        return {"message": None}
     chat_id = data['message']['chat']['id']
     text = data['message'].get('text', '')
     voice = data['message'].get('voice', None)
     print(text)
 
+    stream = None
     if voice:
         # Process voice messages
         voice_file_id = voice['file_id']
@@ -53,17 +50,30 @@ async def handle_telegram_webhook(req: Request):
                   is_task = True
                   task = text[5:]
                   print(task)
-                  await process_task(task, chat_id=chat_id, platform='telegram', client=client, base_url=BASE_URL,)
+                  await process_task(task, chat_id=chat_id, platform='telegram')
                   return {"message": task}
+              if text[0:7] == "/cancel":
+                  cancelled = await cancel_tasks(chat_id)
+                  send_message(chat_id, f"Cancelled {cancelled} running tasks")
+                  return {"message": "cancel"}
+          return {"message": None}
         else:
-            output = await process_chat_message(text, chat_id)
+            stream = TelegramReplyStream(chat_id) if STREAM_REPLIES else None
+            with stream_reply(stream):
+                output = await process_chat_message(text, chat_id)
+
+    # Send the output as a text message or a photo with a caption, depending on the type of output,
+    # unless it was already shown while it was generated
+    if stream is None or not await stream.finish(output):
+        if isinstance(output, tuple):
+            summary, image = output
+            send_photo(chat_id, image)
+            send_message(chat_id, summary)
+        elif output is not None:
+            send_message(chat_id, output)
+    await job_queue.checkpoint("replied")
+
+    return {"message": output}
 
-    # Send the output as a text message or a photo with a caption, depending on the type of output
-            if isinstance(output, tuple):
-                summary, image = output
-                await bot.send_photo(chat_id, image)
-                await client.get(f"{BASE_URL}/sendMessage?chat_id={chat_id}&text={summary}")
-            else:
-                await client.get(f"{BASE_URL}/sendMessage?chat_id={chat_id}&text={output}")
 
-            return {"message": output}
+job_queue.register("telegram", process_telegram_update)
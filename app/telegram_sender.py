@@ -0,0 +1,167 @@
+import time
+import asyncio
+import httpx
+from typing import Dict, List, Optional, Tuple, Union
+import config
+from http_client import client
+from outbound import Dispatcher
+from streaming import ReplyStream
+from resilience import dependency
+
+# Telegram rejects longer messages
+MAX_MESSAGE_LENGTH = 4096
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Split a message into parts Telegram accepts, preferably at line breaks, then at spaces.
+
+    Args:
+        text (str): The message.
+        limit (int): Maximum part length.
+
+    Returns:
+        List[str]: The parts, in order.
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit + 1)
+        if cut <= 0:
+            parts.append(text[:limit])
+            text = text[limit:]
+        else:
+            # Drop the line break or space the message is split at
+            parts.append(text[:cut])
+            text = text[cut + 1:]
+    parts.append(text)
+    return parts
+
+
+async def call_api(payload: Tuple[str, Dict]) -> httpx.Response:
+    """ POST a Bot API method with a JSON body over the shared connection pool """
+    method, params = payload
+    return await client.post(f"{config.TELEGRAM_API_BASE}/bot{config.TELEGRAM_BOT_TOKEN}/{method}", json=params,
+                             timeout=dependency("telegram").timeout)
+
+
+class TelegramDispatcher(Dispatcher):
+    """ Dispatcher that honours the retry_after of Telegram's flood control errors """
+
+    def retry_delay(self, response: httpx.Response, attempt: int) -> Optional[float]:
+        if response.status_code == 429:
+            try:
+                return float(response.json()["parameters"]["retry_after"])
+            except (ValueError, KeyError, TypeError):
+                pass
+        return super().retry_delay(response, attempt)
+
+
+# Bot API calls, in order per chat, within the global and per-chat flood limits
+dispatcher = TelegramDispatcher(
+    "telegram",
+    call_api,
+    workers=config.TELEGRAM_SEND_WORKERS,
+    rate=config.TELEGRAM_SEND_RATE,
+    key_rate=config.TELEGRAM_CHAT_SEND_RATE,
+    key_burst=config.TELEGRAM_CHAT_SEND_BURST,
+    max_attempts=config.OUTBOUND_MAX_ATTEMPTS,
+    backoff=config.OUTBOUND_BACKOFF,
+    breaker=dependency("telegram").breaker,
+)
+
+
+def send_message(chat_id: int, text: str) -> asyncio.Future:
+    """
+    Queue a text message, split into several if it is too long.
+
+    Args:
+        chat_id (int): Telegram chat id.
+        text (str): Message text.
+
+    Returns:
+        asyncio.Future: Resolves to the response to the last part, or None if sending failed.
+    """
+    for part in split_message(str(text)):
+        future = dispatcher.submit(chat_id, ("sendMessage", {"chat_id": chat_id, "text": part}))
+    return future
+
+
+def send_photo(chat_id: int, photo: str, caption: str = None) -> asyncio.Future:
+    """
+    Queue a photo.
+
+    Args:
+        chat_id (int): Telegram chat id.
+        photo (str): URL or file id of the photo.
+        caption (str): Optional caption.
+
+    Returns:
+        asyncio.Future: Resolves to the response, or None if sending failed.
+    """
+    params = {"chat_id": chat_id, "photo": photo}
+    if caption:
+        params["caption"] = caption
+    return dispatcher.submit(chat_id, ("sendPhoto", params))
+
+
+def edit_message_text(chat_id: int, message_id: int, text: str) -> asyncio.Future:
+    """ Queue an edit of a sent message, see send_message """
+    return dispatcher.submit(chat_id, ("editMessageText", {"chat_id": chat_id, "message_id": message_id, "text": text}))
+
+
+class TelegramReplyStream(ReplyStream):
+    """
+    Shows a chat reply while it is generated: the first tokens are sent as a
+    message, which is then edited with the text so far at most every
+    `interval` seconds.
+    """
+
+    def __init__(self, chat_id: int, interval: float = config.TELEGRAM_STREAM_INTERVAL):
+        super().__init__()
+        self.chat_id = chat_id
+        self.interval = interval
+        self.message_id: Optional[int] = None
+        self.shown = ""
+        self._last_update = 0.0
+        self._update: Optional[asyncio.Task] = None
+
+    async def on_text(self, text: str):
+        if self._update is not None and not self._update.done():
+            return
+        if time.monotonic() - self._last_update >= self.interval:
+            # Edits can't make a message longer than the limit, later parts are sent by finish
+            self._update = asyncio.create_task(self._show(split_message(text)[0]))
+
+    async def _show(self, text: str):
+        self._last_update = time.monotonic()
+        # Telegram trims messages and rejects edits that change nothing
+        if not text.strip() or text.strip() == self.shown.strip():
+            return
+        if self.message_id is None:
+            response = await send_message(self.chat_id, text)
+            if response is None or not response.is_success:
+                return
+            self.message_id = response.json()["result"]["message_id"]
+        else:
+            await edit_message_text(self.chat_id, self.message_id, text)
+        self.shown = text
+
+    async def finish(self, output: Union[str, Tuple[str, str]]) -> bool:
+        """
+        Replace the partial reply with the final output.
+
+        Returns:
+            bool: False if nothing was shown yet, the caller sends the output then.
+        """
+        if self._update is not None:
+            await self._update
+        if self.message_id is None or not isinstance(output, str):
+            return False
+        parts = split_message(output)
+        if parts[0].strip() != self.shown.strip():
+            edit_message_text(self.chat_id, self.message_id, parts[0])
+        for part in parts[1:]:
+            send_message(self.chat_id, part)
+        return True
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import uuid
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+import config
+
+
+class Span:
+    """ A timed step of a trace, with the steps it ran as children """
+
+    def __init__(self, name: str, attributes: Dict[str, Any]):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self.children: List["Span"] = []
+
+    def to_dict(self, trace_start: float) -> Dict[str, Any]:
+        span = {"name": self.name, "start_ms": round((self.start - trace_start) * 1000, 1),
+                "duration_ms": None if self.duration is None else round(self.duration * 1000, 1)}
+        if self.attributes:
+            span["attributes"] = self.attributes
+        if self.error:
+            span["error"] = self.error
+        if self.children:
+            span["children"] = [child.to_dict(trace_start) for child in self.children]
+        return span
+
+
+# Innermost open span of the current message, None outside of a trace
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+current_trace_id: ContextVar[Optional[str]] = ContextVar("current_trace_id", default=None)
+
+stats = Counter({"traces": 0, "slow": 0})
+_write_lock = threading.Lock()
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Time a step as a child of the current span. Does nothing outside of a trace.
+
+    Args:
+        name (str): Step name, e.g. "get_topic".
+        **attributes: Stored with the span, e.g. the model.
+    """
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, attributes)
+    parent.children.append(child)
+    token = current_span.set(child)
+    start = time.perf_counter()
+    try:
+        yield child
+    except BaseException as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        child.duration = time.perf_counter() - start
+        current_span.reset(token)
+
+
+@contextmanager
+def trace(name: str, trace_id: Optional[str] = None, **attributes) -> Iterator[Span]:
+    """
+    Start a trace: the spans opened in this context (including tasks and
+    worker threads started from it) become its tree. Traces slower than
+    config.TRACE_SLOW_SECONDS are appended to config.TRACE_LOG.
+
+    Args:
+        name (str): Root span name, e.g. "job:telegram".
+        trace_id (str): ID given to the update by its webhook, a new one if None.
+        **attributes: Stored with the root span.
+    """
+    root = Span(name, attributes)
+    trace_id = trace_id or new_trace_id()
+    span_token = current_span.set(root)
+    id_token = current_trace_id.set(trace_id)
+    start = time.perf_counter()
+    try:
+        yield root
+    except BaseException as e:
+        root.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        root.duration = time.perf_counter() - start
+        current_span.reset(span_token)
+        current_trace_id.reset(id_token)
+        stats["traces"] += 1
+        if config.TRACE_LOG and root.duration >= config.TRACE_SLOW_SECONDS:
+            stats["slow"] += 1
+            write(trace_id, root)
+
+
+def write(trace_id: str, root: Span):
+    # Slow traces are rare and a line is small, appending it on the loop is cheaper than a thread hop
+    line = json.dumps({"trace_id": trace_id, "time": root.start, **root.to_dict(root.start)}, default=str)
+    with _write_lock:
+        os.makedirs(os.path.dirname(config.TRACE_LOG) or ".", exist_ok=True)
+        with open(config.TRACE_LOG, "a") as f:
+            f.write(line + "\n")
@@ -1,14 +1,12 @@
-import asyncio
-from fastapi import APIRouter, Form, Response, Request
-from twilio.twiml.messaging_response import MessagingResponse
-from twilio.rest import Client
-from twilio.base.exceptions import TwilioException
 from chat_handler import process_chat_message
 from voice_handler import process_voice_message
-from config import BABYAGI, ACCOUNT_SID, AUTH_TOKEN, TWILIO_WHATSAPP_NUMBER, FACEBOOK_PAGE_ID
-from babyagi import process_task
+from config import BABYAGI, TWILIO_WHATSAPP_NUMBER, FACEBOOK_PAGE_ID, STREAM_REPLIES
+from babyagi import process_task, cancel_tasks
+from twilio_sender import send_message, SentenceReplyStream
+from streaming import stream_reply
+from job_queue import queue as job_queue
+import metrics
 
-twilio_api_reply = APIRouter()
 
 async def send_twilio_response(chat_id: str, message: str, platform: str = "whatsapp", is_voice: bool = False):
     """
@@ -35,88 +33,45 @@ async def send_twilio_response(chat_id: str, message: str, platform: str = "what
     else:
         twilio_phone_number = f'whatsapp:{TWILIO_WHATSAPP_NUMBER}'
 
-    # Rest of the function remains unchanged
-    if is_voice:
-        # Process voice messages
-        output = await process_voice_message(message, chat_id)
-    elif BABYAGI and message.startswith("/task"):
-        if BABYAGI:
-          # Process text messages
-            task = message[5:]
-            await process_task(task, chat_id=chat_id, platform='twilio', client=None, base_url=None)
-            output = task
-    else:
-      output = await process_chat_message(message, chat_id)
-
-    # Initialize Twilio response
-    resp = MessagingResponse()
-
-    # Send the output as a text message or a photo with a caption, depending on the type of output
-    if isinstance(output, tuple):
-        summary, image = output
-        response_msg = resp.message(summary)
-        response_msg.media(image)
-    else:
-        response_msg = resp.message(output)
+    # Chat replies are sent sentence by sentence while they are generated
+    stream = SentenceReplyStream(chat_id, twilio_phone_number) if STREAM_REPLIES else None
+    with stream_reply(stream):
+        if is_voice:
+            # Process voice messages
+            output = await process_voice_message(message, chat_id)
+        elif BABYAGI and message.startswith("/task"):
+            if BABYAGI:
+              # Process text messages
+                task = message[5:]
+                await process_task(task, chat_id=chat_id, platform=platform)
+                output = task
+        elif BABYAGI and message.startswith("/cancel"):
+            cancelled = await cancel_tasks(chat_id)
+            output = f"Cancelled {cancelled} running tasks"
+        else:
+          output = await process_chat_message(message, chat_id)
 
-    # Send the message using Twilio client
-    from twilio.rest import Client
-    account_sid = ACCOUNT_SID
-    auth_token = AUTH_TOKEN
-    client = Client(account_sid, auth_token)
+    if output is None:
+        # Dropped, or merged into a later message that gets the reply
+        return
 
-    if is_voice:
-        if isinstance(output, tuple):
-            summary, image = output
-            client.messages.create(
-                body=summary,
-                media_url=image,
-                from_=twilio_phone_number,
-                to=chat_id
-            )
-        else:
-            client.messages.create(
-                body=output,
-                from_=twilio_phone_number,
-                to=chat_id
-            )
-    else:
+    # Send the output as a text message or a photo with a caption, depending on the type of output,
+    # unless it was already shown while it was generated
+    if stream is None or not await stream.finish(output):
         if isinstance(output, tuple):
             summary, image = output
-            client.messages.create(
-                body=summary,
-                media_url=image,
-                from_=twilio_phone_number,
-                to=chat_id
-            )
+            send_message(chat_id, twilio_phone_number, summary, media_url=image)
         else:
-            client.messages.create(
-                body=output,
-                from_=twilio_phone_number,
-                to=chat_id
-            )
+            send_message(chat_id, twilio_phone_number, output)
+    await job_queue.checkpoint("replied")
 
-@twilio_api_reply.post("/api")
-async def handle_twilio_api_reply(request: Request, Body: str = Form(""), MediaUrl0: str = Form("")):
-    form_data = await request.form()
-    chat_id = form_data.get("From")
-    platform = form_data.get("To")
 
-    if platform.startswith("whatsapp"):
-        platform = "whatsapp"
-    elif platform.startswith("messenger"):
-        platform = "messenger"
-    else:
-        return Response(content="Invalid platform", media_type="text/plain", status_code=400)
-
-    # Only process Twilio messages if the Twilio WhatsApp number or Facebook Page ID is configured
-    if (platform == "whatsapp" and TWILIO_WHATSAPP_NUMBER) or (platform == "messenger" and FACEBOOK_PAGE_ID):
-        if MediaUrl0:
-            asyncio.create_task(send_twilio_response(chat_id, MediaUrl0, platform=platform, is_voice=True))
-        else:
-            asyncio.create_task(send_twilio_response(chat_id, Body.strip(), platform=platform))
+async def process_twilio_job(job: dict):
+    metrics.current_platform.set(job["platform"])
+    if job_queue.progress("replied"):
+        # A retried job that got its reply out already
+        return
+    await send_twilio_response(**job)
 
-    # Return an empty response to Twilio
-    resp = MessagingResponse()
-    return Response(content=str(resp), media_type="application/xml")
 
+job_queue.register("twilio", process_twilio_job)
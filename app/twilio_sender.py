@@ -0,0 +1,115 @@
+import re
+import asyncio
+import httpx
+from typing import Dict, List, Tuple, Union
+import config
+from http_client import client
+from outbound import Dispatcher
+from streaming import ReplyStream
+from resilience import dependency
+
+
+def messages_url() -> str:
+    return f"{config.TWILIO_API_BASE}/2010-04-01/Accounts/{config.ACCOUNT_SID}/Messages.json"
+
+
+async def post_message(payload: Dict[str, str]) -> httpx.Response:
+    """ Create a message with Twilio's REST API over the shared connection pool """
+    return await client.post(messages_url(), data=payload, auth=(config.ACCOUNT_SID, config.AUTH_TOKEN),
+                             timeout=dependency("twilio").timeout)
+
+
+# WhatsApp and Messenger replies, in order per recipient
+dispatcher = Dispatcher(
+    "twilio",
+    post_message,
+    workers=config.TWILIO_SEND_WORKERS,
+    rate=config.TWILIO_SEND_RATE,
+    max_attempts=config.OUTBOUND_MAX_ATTEMPTS,
+    backoff=config.OUTBOUND_BACKOFF,
+    breaker=dependency("twilio").breaker,
+)
+
+
+def send_message(to: str, from_: str, body: str, media_url: str = None) -> asyncio.Future:
+    """
+    Queue a WhatsApp or Messenger message.
+
+    Args:
+        to (str): Recipient, e.g. "whatsapp:+15551234567".
+        from_ (str): Sender, e.g. "whatsapp:+15557654321".
+        body (str): Message text.
+        media_url (str): Optional URL of an image to attach.
+
+    Returns:
+        asyncio.Future: Resolves to Twilio's response, or None if sending failed.
+    """
+    payload = {"To": to, "From": from_, "Body": body}
+    if media_url:
+        payload["MediaUrl"] = media_url
+    return dispatcher.submit(to, payload)
+
+
+# Whitespace after the end of a sentence
+SENTENCE_END = re.compile(r"(?<=[.!?\n])\s+")
+
+
+class SentenceReplyStream(ReplyStream):
+    """
+    Sends a chat reply in sentence-sized messages while it is generated,
+    since WhatsApp and Messenger messages can't be edited. Complete sentences
+    are sent once at least `min_chars` of them are waiting.
+    """
+
+    def __init__(self, to: str, from_: str, min_chars: int = config.TWILIO_STREAM_MIN_CHARS):
+        super().__init__()
+        self.to = to
+        self.from_ = from_
+        self.min_chars = min_chars
+        # Length of the prefix of self.text that was sent
+        self.sent = 0
+        # The messages sent so far
+        self.chunks: List[str] = []
+
+    async def on_text(self, text: str):
+        pending = text[self.sent:]
+        if len(pending) < self.min_chars:
+            return
+        ends = [match.end() for match in SENTENCE_END.finditer(pending)]
+        if ends and ends[-1] >= self.min_chars:
+            chunk = pending[:ends[-1]].strip()
+            send_message(self.to, self.from_, chunk)
+            self.chunks.append(chunk)
+            self.sent += ends[-1]
+
+    def unsent(self, output: str) -> str:
+        """
+        The part of the output after the sent messages it starts with. When
+        the output differs from what was streamed, e.g. an error notice after
+        a timeout, this starts at the first sent message it doesn't match.
+        """
+        position = 0
+        for chunk in self.chunks:
+            start = len(output) - len(output[position:].lstrip())
+            if not output.startswith(chunk, start):
+                break
+            position = start + len(chunk)
+        return output[position:].strip()
+
+    async def finish(self, output: Union[str, Tuple[str, str]]) -> bool:
+        """
+        Send the rest of the reply, never again what was already sent.
+
+        Returns:
+            bool: False if nothing was sent yet, the caller sends the output then.
+        """
+        if not self.sent:
+            return False
+        if isinstance(output, tuple):
+            summary, image = output
+            send_message(self.to, self.from_, self.unsent(summary), media_url=image)
+            return True
+        rest = self.unsent(output)
+        if rest:
+            send_message(self.to, self.from_, rest)
+        return True
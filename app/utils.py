@@ -1,34 +1,60 @@
 import os
-import faiss
-import pickle
+import threading
 import config
 import openai
-import functools
+import numpy as np
+from typing import Awaitable, Dict, Tuple
 from langchain import OpenAI, LLMChain, PromptTemplate
 from langchain.chains.conversation.memory import ConversationBufferWindowMemory, ConversationBufferMemory
 from langchain.agents.agent_toolkits import ZapierToolkit
 from langchain.utilities.zapier import ZapierNLAWrapper
 from langchain.agents import initialize_agent
 from langchain.docstore import InMemoryDocstore
+from langchain.docstore.document import Document
 from langchain.vectorstores import FAISS
-from langchain.embeddings import OpenAIEmbeddings
 from langchain.memory import VectorStoreRetrieverMemory, CombinedMemory
 from langchain.chat_models import ChatOpenAI
+from langchain.schema import get_buffer_string
 from config import SELECTED_MODEL, IMAGE_SIZE, ZAPIER_NLA_API_KEY, BOT_NAME
-from models import initialize_language_model
+from models import model_tiers
 from templates import get_template
+from router import TopicRouter
+from executor import run_sync
+from conversation_store import store as conversation_store
+from session_cache import SessionCache
+import vector_memory
+from embeddings import service as embedding_service
+from response_cache import ResponseCache
+from prompt_budget import PromptBudget
+from resilience import DependencyError, dependency
+from shared_state import backend as shared_state
+import metrics
+import tracing
 
 
 
-if ZAPIER_NLA_API_KEY:
-    llm = OpenAI(temperature=0)
-    zapier = ZapierNLAWrapper()
-    toolkit = ZapierToolkit.from_zapier_nla_wrapper(zapier)
-    agent = initialize_agent(toolkit.get_tools(), llm, agent="zero-shot-react-description", verbose=True)
-else:
-    zapier = None
-    toolkit = None
-    agent = None
+# The Zapier agent lists the Zapier actions over the network, so it is built on
+# first use (or by the warm up of main.py) instead of at import
+_calendar_agent = None
+_calendar_agent_lock = threading.Lock()
+
+
+def get_calendar_agent():
+    """
+    Build the Zapier calendar agent once. Blocking, call it from a worker thread.
+
+    Returns:
+        The agent, or None if ZAPIER_NLA_API_KEY is not configured.
+    """
+    global _calendar_agent
+    if not ZAPIER_NLA_API_KEY:
+        return None
+    with _calendar_agent_lock:
+        if _calendar_agent is None:
+            llm = OpenAI(temperature=0)
+            toolkit = ZapierToolkit.from_zapier_nla_wrapper(ZapierNLAWrapper())
+            _calendar_agent = initialize_agent(toolkit.get_tools(), llm, agent="zero-shot-react-description", verbose=True)
+    return _calendar_agent
 
 
 def load_memory(chat_id: str):
@@ -46,22 +72,27 @@ def load_memory(chat_id: str):
         memory object for langchain chain
     '''
 
-    # First check if memory is saved on disk and load it
-
-    fp = os.path.join(config.HISTORY_DIR, '{}_memory.p'.format(chat_id))
-    try:
-        with open(fp, 'rb') as f:
-            memory = pickle.load(f)
-            return memory
-    except FileNotFoundError:
-        pass
-
-    # Create new memory
     memconfig = config.MEMORYCONFIG
     embedding_size = 1536 # Dimensions of the OpenAIEmbeddings
-    index = faiss.IndexFlatL2(embedding_size)
-    embedding_fn = OpenAIEmbeddings(openai_api_key=config.OPENAI_API_KEY).embed_query
-    vectorstore = FAISS(embedding_fn, index, InMemoryDocstore({}), {})
+    embedding_fn = embedding_service.embed_query
+
+    # The saved vector index covers the first index.ntotal turns, the store
+    # still has the embeddings of later turns
+    turns = conversation_store.load(chat_id)
+    index = vector_memory.open_index(chat_id, embedding_size)
+    if index.ntotal > len(turns):
+        # Buffered turns were lost after the index was saved, rebuild it
+        vector_memory.remove_index(chat_id)
+        index = vector_memory.open_index(chat_id, embedding_size)
+    indexed = index.ntotal
+    docstore = InMemoryDocstore({str(i): Document(page_content=turn.document) for i, turn in enumerate(turns[:indexed])})
+    vectorstore = FAISS(embedding_fn, index, docstore, {i: str(i) for i in range(indexed)})
+    missing = turns[indexed:]
+    if missing:
+        vectorstore.add_embeddings([
+            (turn.document, embedding_fn(turn.document) if turn.embedding is None else turn.embedding)
+            for turn in missing])
+
     retriever = vectorstore.as_retriever(search_kwargs=dict(k=memconfig["K_latest"]))
 
     conv_memory = ConversationBufferWindowMemory(
@@ -72,14 +103,16 @@ def load_memory(chat_id: str):
 
     faissmemory = VectorStoreRetrieverMemory(retriever=retriever)
 
+    for turn in turns[-memconfig["K_latest"]:]:
+        conv_memory.save_context({"human_input": turn.human}, {"text": turn.ai})
+
     memory = CombinedMemory(memories=[faissmemory, conv_memory])
     return memory
 
 
-@functools.cache
 def load_chat_model(chat_id: str):
     ''' Loads the langchain chain for chat.
-        cache is used to avoid reloading the model for each request
+        Use chat_sessions.get to get the cached chain instead of reloading it for each request
 
     Args:
         chat_id (str): Chat id (used for caching)
@@ -90,25 +123,181 @@ def load_chat_model(chat_id: str):
     print ('Loading chat model...')
     prompt_template = get_template("chat")
     prompt = PromptTemplate(input_variables=["history", "recent_history", "human_input"], template=prompt_template)
-    memory = load_memory(chat_id)
+    with metrics.timed("memory_load"):
+        memory = load_memory(chat_id)
     return LLMChain(
-        llm=initialize_language_model(SELECTED_MODEL),
+        llm=model_tiers.get_llm(model_tiers.model("chat"), streaming=config.STREAM_REPLIES),
         prompt=prompt,
         verbose=True,
         memory=memory
     )
 
 
-def save_memory_to_disk(chat_id, chatgpt_chain):
-    ''' Saves the memory of the langchain chain to disk '''
-    # TODO memory is currently serialized and saved at every step
-    # It's probably better to do it on exit or on every 10 steps etc.
-    
-    if not os.path.exists(config.HISTORY_DIR):
-        os.makedirs(config.HISTORY_DIR)
-    fp = os.path.join(config.HISTORY_DIR, '{}_memory.p'.format(chat_id))
-    with open(fp, 'wb') as f:
-        pickle.dump(chatgpt_chain.memory, f, protocol=pickle.HIGHEST_PROTOCOL)
+def chain_size(chatgpt_chain: LLMChain) -> int:
+    ''' Rough size in bytes of a cached chain, dominated by the FAISS vectors '''
+    return chatgpt_chain.memory.memories[0].retriever.vectorstore.index.memory_bytes()
+
+
+def save_session(chat_id: str, chatgpt_chain: LLMChain):
+    ''' Writes the state of a chat back to disk: pending turns and new vectors '''
+    with metrics.timed("memory_save"):
+        conversation_store.flush()
+        index = chatgpt_chain.memory.memories[0].retriever.vectorstore.index
+        if vector_memory.save_index(chat_id, index):
+            conversation_store.drop_embeddings(chat_id, index.ntotal)
+
+
+# Chat state version each cached session was loaded at, see shared_state.StateBackend
+session_versions: Dict[str, int] = {}
+
+
+def session_is_stale(chat_id: str) -> Awaitable[bool]:
+    ''' Whether the chat changed since its cached session was loaded, checked when awaited '''
+    key = str(chat_id)
+    # The version is read now, the write-back of an evicted session awaits the check later,
+    # after a newer session of the chat (in this worker or another) may have committed turns
+    loaded = session_versions.get(key)
+
+    async def check() -> bool:
+        return loaded is not None and loaded != await shared_state.version(key)
+    return check()
+
+
+# Chat chains by chat id. Turns are appended to the conversation store as
+# they happen, evicting a chat saves its vector memory unless it went stale.
+chat_sessions = SessionCache(
+    load_chat_model,
+    max_entries=config.SESSION_CACHE_SIZE,
+    ttl=config.SESSION_CACHE_TTL,
+    max_bytes=config.SESSION_CACHE_MAX_BYTES,
+    sizeof=chain_size,
+    on_evict=save_session,
+    lock=shared_state.lock,
+    is_stale=session_is_stale,
+)
+
+
+async def sync_chat_session(chat_id: str):
+    """
+    Drop the cached session of a chat if another worker changed the chat since
+    it was loaded. Call it while holding the chat's lock, see shared_state.
+    """
+    key = str(chat_id)
+    version = await shared_state.version(key)
+    if key in chat_sessions and session_versions.get(key) != version:
+        # Its turns are in the conversation store, the next get loads them
+        chat_sessions.discard(key)
+    session_versions[key] = version
+
+
+def save_turn(chat_id: str, chatgpt_chain: LLMChain, inputs: Dict, output: str):
+    ''' Adds a turn to the memory of the langchain chain and appends it to the conversation store '''
+    # Only the message itself, not the context it was answered with, goes into the vector memory
+    chatgpt_chain.memory.save_context({"human_input": inputs["human_input"]}, {chatgpt_chain.output_key: output})
+
+    # The vector memory just embedded the turn, store that embedding with it
+    vectorstore = chatgpt_chain.memory.memories[0].retriever.vectorstore
+    position = vectorstore.index.ntotal - 1
+    document = vectorstore.docstore.search(vectorstore.index_to_docstore_id[position]).page_content
+    conversation_store.append(chat_id, inputs["human_input"], output, document, vectorstore.index.reconstruct(position))
+    if vectorstore.index.delta.ntotal >= config.VECTOR_MEMORY_DELTA_MAX:
+        save_session(chat_id, chatgpt_chain)
+
+
+# Size of the chat prompts, see config.PROMPT_TOKEN_BUDGET
+prompt_budget = PromptBudget(config.PROMPT_TOKEN_BUDGET)
+
+
+def assemble_chat_inputs(chatgpt_chain: LLMChain, text: str) -> Dict:
+    ''' Builds the chat prompt inputs from memory within the model's token budget
+
+    Retrieved turns that are in the recent window too are left out. When the
+    prompt is too long, the least relevant retrieved turns and then the oldest
+    recent turns are dropped.
+
+    Args:
+        chatgpt_chain (LLMChain): Chain of the chat, see load_chat_model
+        text (str): Input text message.
+
+    Returns:
+        Dict: The chain inputs: human_input, history and recent_history
+    '''
+    faissmemory, conv_memory = chatgpt_chain.memory.memories
+    vectorstore = faissmemory.retriever.vectorstore
+    messages = conv_memory.buffer[-conv_memory.k * 2:]
+    recent = [get_buffer_string(messages[i:i + 2]) for i in range(0, len(messages), 2)]
+
+    # Turn i of the chat is vector i, so the recent window is the last len(recent) vectors
+    k = faissmemory.retriever.search_kwargs["k"]
+    first_recent = vectorstore.index.ntotal - len(recent)
+    retrieved = []
+    if vectorstore.index.ntotal:
+        embedding = embedding_service.embed_query(text)
+        with metrics.timed("retrieval"):
+            _, ids = vectorstore.index.search(np.array([embedding], dtype=np.float32), k + len(recent))
+        for i in ids[0]:
+            if i < 0:
+                continue
+            if i >= first_recent:
+                prompt_budget.stats["duplicates_dropped"] += 1
+                continue
+            retrieved.append(vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]).page_content)
+    fixed = chatgpt_chain.prompt.format(history="", recent_history="", human_input=text)
+    retrieved, recent = prompt_budget.fit(model_tiers.model("chat"), fixed, retrieved[:k], recent)
+    return {"human_input": text, "history": "\n".join(retrieved), "recent_history": "\n".join(recent)}
+
+
+# Outputs of the stateless prompt stages, see config.RESPONSE_CACHE
+response_cache = ResponseCache(config.RESPONSE_CACHE, embed=embedding_service.aembed_query)
+
+
+async def predict_stage(stage: str, template_type: str, text: str, history_string: str) -> str:
+    """
+    Run a stateless prompt stage through the response cache.
+
+    Args:
+        stage (str): Response cache stage name.
+        template_type (str): Prompt template, see templates.get_template.
+        text (str): Input text message.
+        history_string (str): Formatted conversation history string.
+
+    Returns:
+        str: The model output.
+    """
+    async def compute() -> str:
+        prompt_template = get_template(template_type)
+        prompt = PromptTemplate(input_variables=["history", "human_input"], template=prompt_template)
+
+        def predict(llm) -> Awaitable[str]:
+            chatgpt_chain = LLMChain(
+                llm=llm,
+                prompt=prompt,
+                verbose=False,
+                memory=ConversationBufferMemory(),
+            )
+            return chatgpt_chain.apredict(history=history_string, human_input=text)
+
+        # The stage runs on its own models, see config.MODEL_STAGES
+        return await model_tiers.call(stage, predict)
+
+    return await response_cache.get_or_compute(stage, history_string, text, compute)
+
+
+async def llm_topic(text: str, history_string: str) -> str:
+    """
+    Ask the LLM for the topic of the given text. Used by the topic router as a fallback.
+
+    Args:
+        text (str): Input text message.
+        history_string (str): Formatted conversation history string.
+
+    Returns:
+        str: The raw model answer.
+    """
+    return await predict_stage("topic", "topic", text, history_string)
+
+
+topic_router = TopicRouter(fallback=llm_topic)
 
 
 async def get_topic(text: str, history_string: str) -> str:
@@ -122,20 +311,45 @@ async def get_topic(text: str, history_string: str) -> str:
     Returns:
         str: The detected topic.
     """
-    prompt_template = get_template("topic")
-    prompt = PromptTemplate(input_variables=["history", "human_input"], template=prompt_template)
+    with tracing.span("get_topic"):
+        return await topic_router.route(text, history_string)
 
-    chatgpt_chain = LLMChain(
-        llm=initialize_language_model(SELECTED_MODEL),
-        prompt=prompt,
-        verbose=False,
-        memory=ConversationBufferMemory(),
+async def generate_chat(chat_id: str, text: str) -> Tuple[Dict, str]:
+    """
+    Generate a chat response without changing the chat memory.
+
+    Memory is only read here, so a generated response can be thrown away
+    without any rollback. Use commit_chat to store the turn.
+
+    Args:
+        chat_id(str): Chat id (used for caching)
+        text (str): Input text message.
+
+    Returns:
+        Tuple[Dict, str]: The chain inputs (including loaded memory) and the generated response.
+    """
+    chatgpt_chain = await chat_sessions.get(chat_id)
+    # Memory retrieval embeds the query with a sync client
+    inputs = await run_sync(assemble_chat_inputs, chatgpt_chain, text)
+    # The chat's chain holds its memory and prompt, the model comes from the chat stage
+    output = await model_tiers.call(
+        "chat",
+        lambda llm: LLMChain(llm=llm, prompt=chatgpt_chain.prompt, verbose=chatgpt_chain.verbose).apredict(**inputs),
+        streaming=config.STREAM_REPLIES,
     )
-    topic = chatgpt_chain.predict(history=history_string, human_input=text)
+    return inputs, output
+
 
-    return topic
+async def commit_chat(chat_id: str, inputs: Dict, output: str):
+    """ Saves a generated turn to the chat memory and to disk """
+    await run_sync(save_turn, chat_id, await chat_sessions.get(chat_id), inputs, output)
+    if shared_state.shared:
+        # Other workers load the chat from the store once they see the new version
+        await run_sync(conversation_store.flush)
+    session_versions[str(chat_id)] = await shared_state.bump(chat_id)
 
-def process_chat(chat_id:str, text: str, history_string: str) -> str:
+
+async def process_chat(chat_id:str, text: str, history_string: str) -> str:
     """
     Process a chat message and generate a response.
 
@@ -147,10 +361,9 @@ def process_chat(chat_id:str, text: str, history_string: str) -> str:
     Returns:
         str: The generated response.
     """
-
-    chatgpt_chain = load_chat_model(chat_id)
-    output = chatgpt_chain.predict(human_input=text)
-    save_memory_to_disk(chat_id, chatgpt_chain)
+    with tracing.span("process_chat"):
+        inputs, output = await generate_chat(chat_id, text)
+        await commit_chat(chat_id, inputs, output)
     return output
 
 async def process_image(text: str, history_string: str) -> str:
@@ -164,25 +377,19 @@ async def process_image(text: str, history_string: str) -> str:
     Returns:
         str: The generated response.
     """
-    prompt_template = get_template("image")
-    prompt = PromptTemplate(input_variables=["history", "human_input"], template=prompt_template)
-
-    chatgpt_chain = LLMChain(
-        llm=initialize_language_model(SELECTED_MODEL),
-        prompt=prompt,
-        verbose=False,
-        memory=ConversationBufferMemory(),
-    )
-
-    prompt_text = chatgpt_chain.predict(history=history_string, human_input=text)
+    prompt_text = await predict_stage("image_prompt", "image", text, history_string)
 
     if prompt_text == "false":
         output = "Please provide more details about the image you're looking for."
     else:
         try:
-            response = openai.Image.create(prompt=prompt_text, n=1, size=IMAGE_SIZE)
+            with metrics.timed("image"):
+                response = await dependency("images").call(
+                    lambda: openai.Image.acreate(prompt=prompt_text, n=1, size=IMAGE_SIZE))
             deissue = False
             image = response["data"][0]["url"]
+        except DependencyError:
+            raise
         except:
             deissue = True
 
@@ -193,7 +400,7 @@ async def process_image(text: str, history_string: str) -> str:
 
     return output
 
-def process_calendar(text: str, history_string: str) -> str:
+async def process_calendar(text: str, history_string: str) -> str:
     """
     Process a calendar event request and generate a response.
 
@@ -204,20 +411,12 @@ def process_calendar(text: str, history_string: str) -> str:
     Returns:
         str: The generated response.
     """
-    if agent is None:
+    if not ZAPIER_NLA_API_KEY:
         return f"{BOT_NAME}: I'm sorry, but I cannot access your calendar without proper configuration. Please configure the Zapier API key to enable calendar integration."
 
-    prompt_template = get_template("calendar")
-    prompt = PromptTemplate(input_variables=["history", "human_input"], template=prompt_template)
-
-    chatgpt_chain = LLMChain(
-        llm=initialize_language_model(SELECTED_MODEL),
-        prompt=prompt,
-        verbose=False,
-        memory=ConversationBufferMemory(),
-    )
-
-    prompt_calendar = chatgpt_chain.predict(history=history_string, human_input=text)
-    output = agent.run(prompt_calendar)
+    prompt_calendar = await predict_stage("calendar", "calendar", text, history_string)
+    # The Zapier tools are sync only. On timeout the worker thread finishes the call in the background.
+    with metrics.timed("calendar"):
+        output = await dependency("zapier").call(lambda: run_sync(lambda: get_calendar_agent().run(prompt_calendar)))
 
     return output
\ No newline at end of file
@@ -0,0 +1,200 @@
+import os
+import threading
+import faiss
+import numpy as np
+from typing import Tuple
+import config
+
+
+class VectorMemoryIndex:
+    """
+    Per-chat vector index used as the `index` of LangChain's FAISS vectorstore.
+
+    Vectors saved to disk live in a compact `base` index (float16, or
+    HNSW/IVF-PQ once a chat has many turns) in FAISS's native format, opened
+    memory-mapped where FAISS supports it, see build_index. Vectors added
+    since the last save sit in a small float32 `delta` index. Searches query
+    both and merge the results, so positions are the same as in a single
+    flat index. `lock` keeps a search from seeing a save halfway, see save_index.
+    """
+
+    def __init__(self, d: int, base=None):
+        self.d = d
+        self.base = base
+        self.delta = faiss.IndexFlatL2(d)
+        self.lock = threading.RLock()
+
+    @property
+    def base_ntotal(self) -> int:
+        return 0 if self.base is None else self.base.ntotal
+
+    @property
+    def ntotal(self) -> int:
+        return self.base_ntotal + self.delta.ntotal
+
+    def memory_bytes(self) -> int:
+        """ Rough RAM use: 4 bytes per dimension for the delta, 2 for a base that isn't memory-mapped """
+        base = 0 if self.base is None or is_mmapped(self.base) else self.base_ntotal * 2
+        return (base + self.delta.ntotal * 4) * self.d
+
+    def add(self, x: np.ndarray):
+        with self.lock:
+            self.delta.add(x)
+
+    def search(self, x: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        with self.lock:
+            distances, ids = self.delta.search(x, k)
+            ids = np.where(ids >= 0, ids + self.base_ntotal, ids)
+            if not self.base_ntotal:
+                return distances, ids
+            base_distances, base_ids = self.base.search(x, k)
+        distances = np.hstack([base_distances, distances])
+        ids = np.hstack([base_ids, ids])
+        # Missing results (-1) come back with huge distances, they sort last
+        order = np.argsort(distances, axis=1)[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def reconstruct(self, i: int) -> np.ndarray:
+        with self.lock:
+            if i >= self.base_ntotal:
+                return self.delta.reconstruct(i - self.base_ntotal)
+            return self.base.reconstruct(i)
+
+
+def is_mmapped(index) -> bool:
+    """ Whether open_index memory-maps the index: FAISS 1.7 only maps the inverted lists of IVF indexes """
+    if isinstance(index, faiss.IndexRefine):
+        return True
+    return faiss.try_extract_index_ivf(index) is not None
+
+
+def read_mapped(fp: str):
+    """
+    Open a saved index memory-mapped where FAISS supports it. IVF-PQ distance
+    tables are computed per query instead of precomputed, the table would take
+    more RAM than the mapped codes save.
+    """
+    return faiss.read_index(fp, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_SKIP_PRECOMPUTE_TABLE)
+
+
+def index_path(chat_id: str) -> str:
+    return os.path.join(config.VECTOR_MEMORY_DIR, '{}.faiss'.format(chat_id))
+
+
+def exact_index(vectors: np.ndarray):
+    """
+    Exact float16 index that FAISS can memory-map: an IVF index with a
+    single inverted list, so every search scans all vectors like a flat index.
+    """
+    d = vectors.shape[1]
+    # One fixed centroid, the quantizer needs no training
+    quantizer = faiss.IndexFlatL2(d)
+    quantizer.add(np.zeros((1, d), dtype=np.float32))
+    index = faiss.IndexIVFScalarQuantizer(quantizer, d, 1, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2, False)
+    index.train(vectors)
+    index.add(vectors)
+    # Positions map to vectors for reconstruct, the map is saved with the index
+    index.make_direct_map()
+    return index
+
+
+def build_index(vectors: np.ndarray):
+    """
+    Build a compact index for the given vectors.
+
+    Below VECTOR_MEMORY_ANN_THRESHOLD vectors this is an exact float16 index,
+    above it an HNSW graph over float16 codes or an IVF-PQ index, depending on
+    VECTOR_MEMORY_ANN. IVF-PQ codes are too coarse to rank on their own, its
+    VECTOR_MEMORY_PQ_RERANK times k candidates are reranked with the exact
+    float16 distances. All of them except HNSW are memory-mapped once saved.
+    """
+    n, d = vectors.shape
+    if n < config.VECTOR_MEMORY_ANN_THRESHOLD:
+        return exact_index(vectors)
+    if config.VECTOR_MEMORY_ANN == 'hnsw':
+        index = faiss.IndexHNSWSQ(d, faiss.ScalarQuantizer.QT_fp16, config.VECTOR_MEMORY_HNSW_M)
+        index.hnsw.efSearch = config.VECTOR_MEMORY_HNSW_EF_SEARCH
+    elif config.VECTOR_MEMORY_ANN == 'ivfpq':
+        nlist = max(1, int(4 * np.sqrt(n)))
+        pq = faiss.IndexIVFPQ(faiss.IndexFlatL2(d), d, nlist, config.VECTOR_MEMORY_PQ_M, 8)
+        pq.nprobe = config.VECTOR_MEMORY_IVF_NPROBE
+        pq.train(vectors)
+        pq.add(vectors)
+        index = faiss.IndexRefine(pq, exact_index(vectors))
+        index.k_factor = config.VECTOR_MEMORY_PQ_RERANK
+        return index
+    else:
+        raise ValueError(f"Invalid VECTOR_MEMORY_ANN: {config.VECTOR_MEMORY_ANN}")
+    index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def open_index(chat_id: str, d: int) -> VectorMemoryIndex:
+    """
+    Open the saved index of a chat, or an empty one if there is none.
+
+    Args:
+        chat_id (str): Chat id.
+        d (int): Vector dimension.
+
+    Returns:
+        VectorMemoryIndex: The index, base opened memory-mapped where possible.
+    """
+    fp = index_path(chat_id)
+    if not os.path.exists(fp):
+        return VectorMemoryIndex(d)
+    return VectorMemoryIndex(d, read_mapped(fp))
+
+
+def save_index(chat_id: str, index: VectorMemoryIndex) -> bool:
+    """
+    Merge the delta into the compact index and write it to disk.
+
+    The index is rebuilt (e.g. float16 to HNSW) when it crosses the ANN
+    threshold, otherwise the delta is appended to the existing index. Call
+    it while holding the chat's lock in the shared state, so no other save of
+    the chat runs at the same time. The index's own lock keeps searches of
+    this worker from seeing the base and the delta halfway through the save.
+
+    Returns:
+        bool: False if there was nothing to save.
+    """
+    with index.lock:
+        return _save_index(chat_id, index)
+
+
+def _save_index(chat_id: str, index: VectorMemoryIndex) -> bool:
+    if not index.delta.ntotal:
+        return False
+    fp = index_path(chat_id)
+    delta = index.delta.reconstruct_n(0, index.delta.ntotal)
+    if index.base is None:
+        base = build_index(delta)
+    else:
+        # Memory-mapped inverted lists are read only, load a writable copy
+        base = faiss.read_index(fp, faiss.IO_FLAG_SKIP_PRECOMPUTE_TABLE) if is_mmapped(index.base) else index.base
+        crossing = base.ntotal < config.VECTOR_MEMORY_ANN_THRESHOLD <= base.ntotal + len(delta)
+        if crossing:
+            base = build_index(np.vstack([base.reconstruct_n(0, base.ntotal), delta]))
+        else:
+            base.add(delta)
+
+    index.base = base
+    index.delta.reset()
+
+    os.makedirs(config.VECTOR_MEMORY_DIR, exist_ok=True)
+    # A unique temporary file per writer, so a crashed save never leaves a partial index behind
+    tmp_path = '{}.{}.{}.tmp'.format(fp, os.getpid(), threading.get_ident())
+    faiss.write_index(base, tmp_path)
+    os.replace(tmp_path, fp)
+    if is_mmapped(base):
+        index.base = read_mapped(fp)
+    return True
+
+
+def remove_index(chat_id: str):
+    try:
+        os.remove(index_path(chat_id))
+    except FileNotFoundError:
+        pass
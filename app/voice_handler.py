@@ -1,37 +1,89 @@
-import urllib.request
-import librosa
-import soundfile as sf
-import os
+import io
+from collections import Counter
+from concurrent.futures.process import BrokenProcessPool
+import httpx
 import openai
 from chat_handler import process_chat_message
+from executor import run_in_process
+from http_client import client
+from audio import transcode_for_whisper
+from config import VOICE_FORMAT, VOICE_MAX_BYTES, BOT_NAME
+from resilience import DependencyError, dependency
+import metrics
+import tracing
 
-def transcribe_audio(audio_filepath: str) -> str:
+# Create a custom user agent to bypass any restrictions
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0"
+
+# Voice messages answered with an apology instead of a reply, by reason
+stats = Counter({"too_large": 0, "download_failed": 0, "undecodable": 0})
+
+
+class VoiceTooLarge(ValueError):
+    pass
+
+
+async def download_voice(voice_url: str) -> bytes:
+    """
+    Stream a voice message into memory over the shared HTTP client.
+
+    Args:
+        voice_url (str): URL of the voice message.
+
+    Returns:
+        bytes: The downloaded file.
+
+    Raises:
+        VoiceTooLarge: The file is larger than VOICE_MAX_BYTES.
+        httpx.HTTPError: The download failed.
+    """
+    buffer = io.BytesIO()
+    async with client.stream("GET", voice_url, headers={"User-Agent": USER_AGENT}, follow_redirects=True) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            buffer.write(chunk)
+            if buffer.tell() > VOICE_MAX_BYTES:
+                raise VoiceTooLarge(f"Voice message is larger than {VOICE_MAX_BYTES} bytes")
+    return buffer.getvalue()
+
+async def transcribe_audio(audio: bytes) -> str:
     """
-    Transcribe an audio file using OpenAI's Whisper ASR API.
+    Transcribe audio using OpenAI's Whisper ASR API.
 
     Args:
-        audio_filepath (str): Path to the audio file.
+        audio (bytes): Encoded audio, see audio.transcode_for_whisper.
 
     Returns:
         str: Transcribed text.
     """
-    with open(audio_filepath, "rb") as audio:
-        transcript = openai.Audio.transcribe("whisper-1", audio)
-        return transcript["text"]
+    def transcribe():
+        # A fresh file per attempt, hedged requests read it at the same time
+        audio_file = io.BytesIO(audio)
+        # The file name tells Whisper the format
+        audio_file.name = f"voice.{VOICE_FORMAT.lower()}"
+        return openai.Audio.atranscribe("whisper-1", audio_file)
 
-async def handle_voice_message(audio_filepath: str, chat_id: int) -> str:
+    with metrics.timed("whisper"):
+        transcript = await dependency("whisper").call(transcribe)
+    return transcript["text"]
+
+async def handle_voice_message(audio: bytes, chat_id: int) -> str:
     """
     Handle an incoming voice message and generate an appropriate response.
 
     Args:
-        audio_filepath (str): Path to the audio file.
+        audio (bytes): Encoded audio, see audio.transcode_for_whisper.
         chat_id (int): Unique identifier for the chat.
 
     Returns:
         str: The generated response.
     """
     # Transcribe the audio file
-    transcribed_text = transcribe_audio(audio_filepath)
+    try:
+        transcribed_text = await transcribe_audio(audio)
+    except DependencyError as e:
+        print(f"Could not transcribe voice message of {chat_id}: {e}")
+        return f"{BOT_NAME}: {e.message}"
     print("transcribed text: " + transcribed_text)
     output = await process_chat_message(transcribed_text, chat_id)
     return output
@@ -40,6 +92,12 @@ async def process_voice_message(voice_url: str, chat_id: int) -> str:
     """
     Process an incoming voice message and generate an appropriate response.
 
+    Everything stays in per-request memory buffers, so concurrent voice
+    messages cannot overwrite each other's files. A voice message that is
+    too large, can't be downloaded or can't be decoded is answered with an
+    apology: the job is done, retrying it would fail the same way and leave
+    the user without a reply.
+
     Args:
         voice_url (str): URL of the voice message.
         chat_id (int): Unique identifier for the chat.
@@ -47,30 +105,33 @@ async def process_voice_message(voice_url: str, chat_id: int) -> str:
     Returns:
         str: The generated response.
     """
-    # Download the voice file from the URL
-    voice_file = "voice_message.ogg"
-
-    # Create a custom user agent to bypass any restrictions
-    user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0"
-    headers = {"User-Agent": user_agent}
-    request = urllib.request.Request(voice_url, headers=headers)
-
-    # Download the file using the custom user agent
-    with urllib.request.urlopen(request) as response:
-        with open(voice_file, 'wb') as out_file:
-            out_file.write(response.read())
-
-    # Convert the OGG/Opus audio file to a supported format (e.g., 'wav')
-    y, sr = librosa.load(voice_file, sr=None)
-    converted_voice_file = "converted_audio.wav"
-    sf.write(converted_voice_file, y, sr, format='wav', subtype='PCM_24')
-
-    # Process the voice file (transcribe, analyze, respond, etc.)
-    output = await handle_voice_message(converted_voice_file, chat_id)
-
-    # Clean up the voice files
-    os.remove(voice_file)
-    os.remove(converted_voice_file)
+    with tracing.span("process_voice_message"):
+        try:
+            with metrics.timed("voice_download"):
+                voice = await download_voice(voice_url)
+        except VoiceTooLarge as e:
+            print(f"Voice message of {chat_id} rejected: {e}")
+            stats["too_large"] += 1
+            return f"{BOT_NAME}: Sorry, your voice message is too long for me, please send a shorter one."
+        except httpx.HTTPError as e:
+            print(f"Could not download voice message of {chat_id}: {e!r}")
+            stats["download_failed"] += 1
+            return f"{BOT_NAME}: Sorry, I could not download your voice message, please send it again."
+
+        # Downmix to 16 kHz mono Opus in the process pool, off the event loop
+        try:
+            with metrics.timed("voice_decode"):
+                audio = await run_in_process(transcode_for_whisper, voice)
+        except BrokenProcessPool:
+            # The pool died, not the message's fault: let the job be retried
+            raise
+        except Exception as e:
+            print(f"Could not decode voice message of {chat_id}: {e!r}")
+            stats["undecodable"] += 1
+            return f"{BOT_NAME}: Sorry, I could not play your voice message, please record it again."
+
+        # Process the voice file (transcribe, analyze, respond, etc.)
+        output = await handle_voice_message(audio, chat_id)
 
     # Return the output (text, image, etc.)
     return output
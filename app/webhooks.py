@@ -0,0 +1,72 @@
+from fastapi import APIRouter, Form, Response, Request
+from twilio.twiml.messaging_response import MessagingResponse
+from config import TELEGRAM_BOT_TOKEN, TWILIO_WHATSAPP_NUMBER, FACEBOOK_PAGE_ID
+from job_queue import queue as job_queue
+import tracing
+
+# The webhooks only queue incoming messages, the handlers that answer them
+# (telegram_handler, twilio_handler) are imported in the background by main.py
+telegram_webhook = APIRouter()
+twilio_api_reply = APIRouter()
+
+
+@telegram_webhook.post("/webhook/")
+async def handle_telegram_webhook(req: Request):
+    """
+    Queue an incoming Telegram update and acknowledge it right away.
+
+    Telegram redelivers updates that are not acknowledged in time, the
+    update_id makes sure a redelivered update is only processed once. The
+    update gets a trace ID that follows it through processing.
+
+    Args:
+        req (Request): Incoming request containing message data.
+
+    Returns:
+        dict: {"ok": True} once the update is queued.
+    """
+    if TELEGRAM_BOT_TOKEN is None:
+        return {"message": "Telegram bot token is not configured. Please set the TELEGRAM_BOT_TOKEN environment variable."}
+
+    data = await req.json()
+    message = data.get("message")
+    if not isinstance(message, dict) or "id" not in message.get("chat", {}):
+        # Edited messages, channel posts etc. are not handled
+        return {"ok": True}
+
+    update_id = data.get("update_id")
+    await job_queue.aenqueue("telegram", data, None if update_id is None else f"telegram:{update_id}",
+                             trace_id=tracing.new_trace_id(), chat=f"telegram:{message['chat']['id']}")
+    return {"ok": True}
+
+
+@twilio_api_reply.post("/api")
+async def handle_twilio_api_reply(request: Request, Body: str = Form(""), MediaUrl0: str = Form(""), MessageSid: str = Form("")):
+    form_data = await request.form()
+    chat_id = form_data.get("From")
+    platform = form_data.get("To")
+
+    if not chat_id or not platform:
+        return Response(content="Missing From or To", media_type="text/plain", status_code=400)
+
+    if platform.startswith("whatsapp"):
+        platform = "whatsapp"
+    elif platform.startswith("messenger"):
+        platform = "messenger"
+    else:
+        return Response(content="Invalid platform", media_type="text/plain", status_code=400)
+
+    # Only process Twilio messages if the Twilio WhatsApp number or Facebook Page ID is configured.
+    # The message is queued and answered in the background, MessageSid makes sure a
+    # redelivered webhook is only processed once. The trace ID follows the message through processing.
+    if (platform == "whatsapp" and TWILIO_WHATSAPP_NUMBER) or (platform == "messenger" and FACEBOOK_PAGE_ID):
+        if MediaUrl0:
+            job = {"chat_id": chat_id, "message": MediaUrl0, "platform": platform, "is_voice": True}
+        else:
+            job = {"chat_id": chat_id, "message": Body.strip(), "platform": platform, "is_voice": False}
+        await job_queue.aenqueue("twilio", job, f"twilio:{MessageSid}" if MessageSid else None,
+                                 trace_id=tracing.new_trace_id(), chat=chat_id)
+
+    # Return an empty response to Twilio
+    resp = MessagingResponse()
+    return Response(content=str(resp), media_type="application/xml")
@@ -0,0 +1,118 @@
+"""
+Run several BabyAGI objectives at once against fake model calls.
+
+Model calls sleep for LATENCY seconds and report token usage. Checks that
+objectives in different chats keep separate task lists and context, that
+tasks of a round run concurrently, that budgets stop an objective, that
+/cancel works and that Telegram gets one edited status message per
+objective rather than a message per step.
+
+    python bench/babyagi_engine.py
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+from typing import List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import httpx
+from langchain.llms.base import LLM
+from langchain.schema import Generation, LLMResult
+
+import babyagi
+import models
+import embeddings
+import telegram_sender
+from result_store import LocalResultStore
+
+LATENCY = 0.1
+TOKENS_PER_CALL = 100
+
+
+def answer(prompt: str) -> str:
+    if prompt.startswith("You are an task creation AI"):
+        return "Research more\nWrite a summary"
+    if prompt.startswith("You are an task prioritization AI"):
+        start = int(prompt.rsplit("number ", 1)[1].rstrip("."))
+        names = json.loads(prompt.split("following tasks: ", 1)[1].split(". Consider", 1)[0].replace("'", '"'))
+        return "\n".join(f"{start + i}. {name}" for i, name in enumerate(names))
+    objective = prompt.split("objective: ", 1)[1].split(".\n", 1)[0]
+    return f"result for {objective}"
+
+
+class FakeLLM(LLM):
+    """Answers BabyAGI's prompts after LATENCY seconds and reports token usage."""
+
+    @property
+    def _llm_type(self) -> str:
+        return "babyagi-fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        return answer(prompt)
+
+    async def _agenerate(self, prompts: List[str], stop: Optional[List[str]] = None) -> LLMResult:
+        await asyncio.sleep(LATENCY)
+        return LLMResult(generations=[[Generation(text=answer(prompt))] for prompt in prompts],
+                         llm_output={"token_usage": {"total_tokens": TOKENS_PER_CALL}})
+
+
+def fake_embeddings(texts: List[str]) -> List[List[float]]:
+    return [[1.0 + len(text) % 5] + [1.0] * 1535 for text in texts]
+
+
+calls = []
+
+
+def fake_telegram(request: httpx.Request) -> httpx.Response:
+    calls.append((request.url.path.rsplit("/", 1)[-1], json.loads(request.content)))
+    return httpx.Response(200, json={"ok": True, "result": {"message_id": len(calls)}})
+
+
+async def run():
+    engine = babyagi.task_engine
+    start = time.perf_counter()
+    a = await babyagi.process_task("plan a trip", chat_id=1, platform="telegram")
+    b = await babyagi.process_task("learn python", chat_id=2, platform="telegram")
+    c = await babyagi.process_task("cancel me", chat_id=3, platform="telegram")
+    await asyncio.sleep(LATENCY / 2)
+    assert await babyagi.cancel_tasks(3) == 1
+    while engine.runs:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    await telegram_sender.dispatcher.close()
+    return a, b, c, elapsed
+
+
+def main():
+    babyagi.YOUR_FIRST_TASK = "Make a todo list"
+    babyagi.result_store = LocalResultStore(os.path.join(tempfile.mkdtemp(), "results"))
+    models.initialize_language_model = lambda selected_model, **kwargs: FakeLLM()
+    embeddings.service._arequest = lambda texts: asyncio.sleep(0, fake_embeddings(texts))
+    embeddings.service.path = ":memory:"
+    telegram_sender.client = httpx.AsyncClient(transport=httpx.MockTransport(fake_telegram))
+    telegram_sender.dispatcher.key_rate = None
+
+    a, b, c, elapsed = asyncio.run(run())
+    serial = (a.steps + b.steps) * 3 * LATENCY
+    print(f"2 objectives, {a.steps + b.steps} steps in {elapsed:.2f}s (one task at a time: ~{serial:.2f}s), "
+          f"tokens {a.usage['total_tokens']} / {b.usage['total_tokens']}")
+
+    for state, objective in ((a, "plan a trip"), (b, "learn python")):
+        assert all(result == f"result for {objective}" for _, result in state.completed), state.completed
+        assert state.steps <= babyagi.BABYAGI_MAX_STEPS
+    assert not c.completed, "cancelled objective kept running"
+    sends = [params["chat_id"] for method, params in calls if method == "sendMessage"]
+    edits = [params["chat_id"] for method, params in calls if method == "editMessageText"]
+    # One status message and one final report per finished objective, one status message for the cancelled one
+    print(f"telegram: {len(sends)} messages sent, {len(edits)} edits")
+    if sorted(sends) != [1, 1, 2, 2, 3]:
+        sys.exit(f"expected one status message and one report per objective, got {sends}")
+
+
+if __name__ == "__main__":
+    main()
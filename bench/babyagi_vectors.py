@@ -0,0 +1,72 @@
+"""
+Per-step latency of the BabyAGI result stores.
+
+A step is what the task engine does per round: one context query and one
+batched upsert of ROUND results. The local store is measured on an empty
+store and with many stored results; Pinecone is measured too when
+PINECONE_API_KEY and TABLE_NAME are set.
+
+    python bench/babyagi_vectors.py [STEPS]
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from result_store import LocalResultStore, PineconeResultStore
+
+ROUND = 3
+D = 1536
+
+
+def items(rng, objective_id: str, step: int):
+    return [(f"{objective_id}_result_{step}_{i}", rng.standard_normal(D).tolist(),
+             {"objective_id": objective_id, "task": f"task {step}.{i}", "result": "x" * 500})
+            for i in range(ROUND)]
+
+
+async def measure(store, steps: int, objective_id: str = "bench") -> np.ndarray:
+    rng = np.random.default_rng(0)
+    latencies = []
+    for step in range(steps):
+        start = time.perf_counter()
+        await store.query(rng.standard_normal(D).tolist(), 5, objective_id)
+        await store.upsert(items(rng, objective_id, step))
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies) * 1000
+
+
+def report(name: str, latencies: np.ndarray):
+    print(f"{name:<28} p50 {np.percentile(latencies, 50):7.2f} ms   p99 {np.percentile(latencies, 99):7.2f} ms")
+
+
+async def main():
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    directory = tempfile.mkdtemp()
+
+    report("local, empty", await measure(LocalResultStore(os.path.join(directory, "empty")), steps))
+
+    # Many results of other objectives, only the queried objective's rows are scored
+    crowded = LocalResultStore(os.path.join(directory, "crowded"))
+    rng = np.random.default_rng(1)
+    await crowded.upsert([(f"other_{i}", rng.standard_normal(D).tolist(), {"objective_id": f"o{i % 100}", "task": ""})
+                          for i in range(10000)])
+    report("local, 10k stored results", await measure(crowded, steps))
+
+    reopened = LocalResultStore(os.path.join(directory, "crowded"))
+    assert len(reopened._positions) == 10000 + steps * ROUND, "results were not saved"
+
+    if os.getenv("PINECONE_API_KEY") and os.getenv("TABLE_NAME"):
+        store = PineconeResultStore(os.getenv("TABLE_NAME"), os.getenv("PINECONE_API_KEY"),
+                                    os.getenv("PINECONE_ENVIRONMENT", "us-east1-gcp"))
+        report("pinecone", await measure(store, steps))
+    else:
+        print("pinecone: set PINECONE_API_KEY and TABLE_NAME to measure")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
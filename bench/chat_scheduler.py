@@ -0,0 +1,87 @@
+"""
+Exercise the per-chat scheduler with bursts of messages from many chats.
+
+The handler sleeps like an LLM call and records what it sees. The run fails
+if two messages of a chat overlap or run out of order, if more than WORKERS
+messages run at once, or if an overflow policy misbehaves.
+
+    python bench/chat_scheduler.py [CHATS] [MESSAGES_PER_CHAT]
+"""
+import os
+import sys
+import time
+import asyncio
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from scheduler import ChatScheduler, MailboxFull
+
+LATENCY = 0.05
+WORKERS = 8
+
+
+class Recorder:
+    def __init__(self):
+        self.seen = defaultdict(list)
+        self.active = set()
+        self.running = 0
+        self.max_running = 0
+
+    async def handle(self, text: str, chat_id) -> str:
+        assert chat_id not in self.active, f"chat {chat_id} processed two messages at once"
+        self.active.add(chat_id)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(LATENCY)
+        self.seen[chat_id].append(text)
+        self.running -= 1
+        self.active.discard(chat_id)
+        return f"reply to {text}"
+
+
+async def ordering(chats: int, per_chat: int):
+    recorder = Recorder()
+    scheduler = ChatScheduler(recorder.handle, workers=WORKERS, max_queue=per_chat)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(scheduler.run(c, str(i)) for i in range(per_chat) for c in range(chats)))
+    elapsed = time.perf_counter() - start
+
+    assert all(r is not None for r in results)
+    for chat_id, texts in recorder.seen.items():
+        assert texts == [str(i) for i in range(per_chat)], f"chat {chat_id} out of order: {texts}"
+    assert recorder.max_running <= WORKERS, recorder.max_running
+    print(f"{chats * per_chat} messages from {chats} chats in {elapsed:.2f}s, "
+          f"max {recorder.max_running} in flight, queue wait p50 {scheduler.wait_percentile(50):.2f}s "
+          f"p99 {scheduler.wait_percentile(99):.2f}s")
+
+
+async def overflow(policy: str):
+    recorder = Recorder()
+    scheduler = ChatScheduler(recorder.handle, workers=WORKERS, max_queue=2, overflow=policy)
+    futures = []
+    for i in range(5):
+        try:
+            futures.append(scheduler.submit(1, str(i)))
+        except MailboxFull:
+            futures.append(None)
+        # Let the chat's task pick up the first message
+        await asyncio.sleep(0)
+    await asyncio.gather(*(f for f in futures if f is not None))
+    results = [f.result() if f is not None else "rejected" for f in futures]
+    print(f"{policy}: processed {recorder.seen[1]}, results {results}")
+    return recorder.seen[1]
+
+
+async def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    per_chat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    await ordering(chats, per_chat)
+    # "0" starts right away, two more fit in the mailbox
+    assert await overflow("reject") == ["0", "1", "2"]
+    assert await overflow("drop_oldest") == ["0", "3", "4"]
+    assert await overflow("merge") == ["0", "1", "2\n3\n4"]
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+"""
+Check that concurrent Telegram webhooks overlap instead of queueing behind each other.
+
+The LLM and embeddings are replaced by local fakes that sleep for LATENCY
+seconds without blocking the event loop, so N concurrent chat messages should
+be answered in roughly the time of one. Every update is delivered twice, like
+Telegram does when a webhook times out, and must be answered once. Exits
+non-zero if the messages ran one after another or a redelivery was processed.
+
+    python bench/concurrent_webhooks.py [N]
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from typing import List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import httpx
+from langchain.llms.base import LLM
+
+import config
+import utils
+import models
+import conversation_store
+import embeddings
+import telegram_handler
+import telegram_sender
+from job_queue import queue as job_queue
+from main import app
+
+LATENCY = 0.5
+
+
+class SlowLLM(LLM):
+    """Answers every prompt after LATENCY seconds of non-blocking sleep."""
+
+    @property
+    def _llm_type(self) -> str:
+        return "slow-fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        time.sleep(LATENCY)
+        return "chat" if "Return a single word" in prompt else "fake reply"
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        global llm_calls
+        llm_calls += 1
+        await asyncio.sleep(LATENCY)
+        return "chat" if "Return a single word" in prompt else "fake reply"
+
+
+def fake_embeddings(texts: List[str]) -> List[List[float]]:
+    return [[float(len(text) % 7)] * 1536 for text in texts]
+
+
+replies = []
+llm_calls = 0
+
+
+def fake_telegram(request: httpx.Request) -> httpx.Response:
+    replies.append(request)
+    return httpx.Response(200, json={"ok": True})
+
+
+async def run(n: int) -> float:
+    worker = asyncio.create_task(job_queue.run(poll_interval=0.05))
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as http:
+        payloads = [{"update_id": i, "message": {"chat": {"id": i}, "text": f"hello number {i}"}} for i in range(n)]
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(http.post("/webhook/", json=p) for p in payloads + payloads))
+        while len(replies) < n:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        # Give duplicates a chance to show up
+        await asyncio.sleep(LATENCY)
+    worker.cancel()
+    job_queue.close()
+    await telegram_sender.dispatcher.close()
+    assert all(r.status_code == 200 for r in responses), [r.text for r in responses]
+    return elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    config.HISTORY_DIR = tempfile.mkdtemp()
+    conversation_store.store.path = os.path.join(config.HISTORY_DIR, "conversations.db")
+    config.VECTOR_MEMORY_DIR = os.path.join(config.HISTORY_DIR, "vectors")
+    utils.topic_router.log_path = None
+    models.initialize_language_model = lambda selected_model, **kwargs: SlowLLM()
+    job_queue.path = os.path.join(config.HISTORY_DIR, "jobs.db")
+    embeddings.service.path = os.path.join(config.HISTORY_DIR, "embeddings.db")
+    embeddings.service._request = fake_embeddings
+    telegram_handler.bot = object()
+    telegram_sender.client = httpx.AsyncClient(transport=httpx.MockTransport(fake_telegram))
+
+    elapsed = asyncio.run(run(n))
+    # Every message costs a topic call and a chat call
+    serial = n * 2 * LATENCY
+    print(f"{n} concurrent webhooks: {elapsed:.2f}s (serial would be {serial:.2f}s)")
+    if elapsed > serial / 2:
+        sys.exit("webhooks did not overlap")
+    if len(replies) != n or llm_calls != 2 * n:
+        sys.exit(f"redelivered updates were processed: {len(replies)} replies, {llm_calls} LLM calls")
+
+
+if __name__ == "__main__":
+    main()
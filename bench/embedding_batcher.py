@@ -0,0 +1,107 @@
+"""
+Embed texts from many concurrent callers against a local mock embeddings API.
+
+Async callers (BabyAGI, the response cache) and sync callers in worker
+threads (chat memory) embed distinct texts at the same time. The run is
+repeated with batching effectively off (one text per request). It fails if a
+caller gets the vector of another text.
+
+    python bench/embedding_batcher.py [ASYNC_CALLERS] [THREAD_CALLERS]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import openai
+from embeddings import EmbeddingService
+from executor import run_sync
+
+LATENCY = 0.05
+D = 8
+
+requests = 0
+lock = threading.Lock()
+
+
+def fake_vector(text: str):
+    digest = hashlib.sha256(text.encode()).digest()
+    return [b / 255 for b in digest[:D]]
+
+
+class MockEmbeddings(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        global requests
+        texts = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["input"]
+        time.sleep(LATENCY)
+        with lock:
+            requests += 1
+        body = json.dumps({
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": fake_vector(text)} for i, text in enumerate(texts)],
+            "model": "text-embedding-ada-002",
+            "usage": {"prompt_tokens": len(texts), "total_tokens": len(texts)},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+async def run(service: EmbeddingService, async_callers: int, thread_callers: int):
+    service.batcher.bind(asyncio.get_running_loop())
+    texts = [f"message {i}" for i in range(async_callers + thread_callers)]
+    start = time.monotonic()
+    vectors = await asyncio.gather(
+        *[service.aembed_query(text) for text in texts[:async_callers]],
+        *[run_sync(service.embed_query, text) for text in texts[async_callers:]],
+    )
+    elapsed = time.monotonic() - start
+    for text, vector in zip(texts, vectors):
+        assert max(abs(a - b) for a, b in zip(vector, fake_vector(text))) < 1e-6, f"wrong vector for {text!r}"
+    return elapsed
+
+
+def measure(label: str, window: float, batch_max: int, async_callers: int, thread_callers: int):
+    global requests
+    requests = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        service = EmbeddingService("text-embedding-ada-002", os.path.join(tmp, "embeddings.db"), 1000,
+                                   batch_window=window, batch_max=batch_max)
+        elapsed = asyncio.run(run(service, async_callers, thread_callers))
+        service.close()
+    sizes = ", ".join(f"{size}x{count}" for size, count in sorted(service.batcher.batch_sizes.items()))
+    print(f"{label:<12} {async_callers + thread_callers} texts in {elapsed:.2f}s, {requests} API requests "
+          f"(batch sizes: {sizes})")
+    return requests
+
+
+def main():
+    async_callers = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    thread_callers = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockEmbeddings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    openai.api_base = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    openai.api_key = "sk-test"
+
+    unbatched = measure("unbatched", 0.0, 1, async_callers, thread_callers)
+    batched = measure("batched", 0.01, 64, async_callers, thread_callers)
+    assert batched < unbatched, "batching did not reduce the number of API requests"
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
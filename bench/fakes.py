@@ -0,0 +1,307 @@
+"""
+Local stand-ins for the OpenAI, Telegram Bot and Twilio APIs, for load tests.
+
+One threaded HTTP server answers:
+- OpenAI: /v1/chat/completions and /v1/completions (streaming too),
+  /v1/embeddings, /v1/images/generations and /v1/audio/transcriptions
+- Telegram: /bot<token>/<method>, and voice files under /file/
+- Twilio: /2010-04-01/Accounts/<sid>/Messages.json, and voice media under /media/
+
+Each kind of call waits a lognormal latency given by its median and p99
+(see LATENCIES and --latency). Every message sent to a user through
+Telegram or Twilio is recorded, GET /_events?after=N lists them and GET
+/_stats counts the calls per endpoint. With --record-prompts the prompts of
+completions are kept too, GET /_prompts?after=N lists them.
+
+Run it alone and point the app at it to load test a real deployment:
+
+    python bench/fakes.py --port 8081 [--scale 0.5] [--latency chat=0.8:3]
+    OPENAI_API_BASE=http://127.0.0.1:8081/v1 TELEGRAM_API_BASE=http://127.0.0.1:8081 \\
+        TWILIO_API_BASE=http://127.0.0.1:8081 uvicorn main:app
+"""
+import io
+import re
+import sys
+import json
+import math
+import time
+import zlib
+import base64
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import soundfile as sf
+
+# Median and p99 latency (seconds) of each kind of call
+LATENCIES: Dict[str, Tuple[float, float]] = {
+    "chat": (0.8, 3.0),
+    "embeddings": (0.05, 0.3),
+    "images": (4.0, 10.0),
+    "whisper": (1.0, 3.0),
+    "telegram": (0.03, 0.2),
+    "twilio": (0.1, 0.5),
+    "files": (0.02, 0.1),
+}
+
+# Share of a streamed completion's latency before its first token
+FIRST_TOKEN_SHARE = 0.3
+EMBEDDING_SIZE = 1536
+WORDS = ("the quick answer depends on what you need most and how soon you want it done "
+         "here are a few ideas that should help you get started today").split()
+SPOKEN = ["what is the weather like tomorrow", "tell me a joke about cats", "remind me what we talked about",
+          "how do I cook rice", "explain how vaccines work"]
+
+
+class Latency:
+    def __init__(self, latencies: Dict[str, Tuple[float, float]], scale: float):
+        # Lognormal with the given median; sigma puts the 99th percentile (z = 2.326) at p99
+        self.params = {kind: (median * scale, math.log(p99 / median) / 2.326) for kind, (median, p99) in latencies.items()}
+
+    def sample(self, kind: str) -> float:
+        median, sigma = self.params[kind]
+        return median * math.exp(sigma * random.gauss(0, 1))
+
+
+def voice_file(seconds: float = 3.0, rate: int = 48000) -> bytes:
+    """ A voice message like Telegram's: OGG/Opus with a few tones """
+    t = np.arange(int(seconds * rate)) / rate
+    signal = 0.2 * np.sin(2 * np.pi * 220 * t) * np.sin(2 * np.pi * 3 * t) + 0.01 * np.random.randn(len(t))
+    buffer = io.BytesIO()
+    sf.write(buffer, signal.astype(np.float32), rate, format="OGG", subtype="OPUS")
+    return buffer.getvalue()
+
+
+def embedding(text: str) -> np.ndarray:
+    vector = np.random.default_rng(zlib.crc32(text.encode())).standard_normal(EMBEDDING_SIZE).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def answer(prompt: str, tokens: int) -> str:
+    """ Plausible model output for the app's prompts """
+    if "Return a single word" in prompt:
+        message = prompt.split("User message :")[-1].split("The user wants")[0].lower()
+        return "image" if "/image" in message or "draw" in message else "chat"
+    if "task creation AI" in prompt:
+        return "Research the topic\nWrite a short summary"
+    if "task prioritization AI" in prompt:
+        start = int((re.search(r"number (\d+)", prompt) or [0, 1])[1])
+        return f"{start}. Research the topic\n{start + 1}. Write a short summary"
+    words = [random.choice(WORDS) for _ in range(tokens)]
+    for i in range(11, tokens, 12):
+        words[i] += "."
+    return " ".join(words).capitalize() + "."
+
+
+class FakeServices(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency: Latency = None
+    reply_tokens = 60
+    voice = b""
+    events: List[Dict] = []
+    prompts: List[str] = []
+    record_prompts = False
+    stats = Counter()
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def params(self, body: bytes) -> Dict:
+        if "json" in (self.headers.get("Content-Type") or ""):
+            return json.loads(body or b"{}")
+        return {key: values[0] for key, values in parse_qs(body.decode(errors="replace")).items()}
+
+    def send_json(self, data, status: int = 200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_bytes(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def record(self, platform: str, chat, method: str):
+        with self.lock:
+            self.events.append({"seq": len(self.events) + 1, "time": time.time(), "platform": platform,
+                                "chat": str(chat), "method": method})
+
+    def wait(self, kind: str):
+        time.sleep(self.latency.sample(kind))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/_events":
+            after = int(parse_qs(url.query).get("after", ["0"])[0])
+            with self.lock:
+                events = self.events[after:]
+            return self.send_json(events)
+        if url.path == "/_prompts":
+            after = int(parse_qs(url.query).get("after", ["0"])[0])
+            with self.lock:
+                prompts = self.prompts[after:]
+            return self.send_json(prompts)
+        if url.path == "/_stats":
+            return self.send_json(dict(self.stats))
+        if url.path.startswith(("/file/", "/media/")):
+            self.stats["voice_download"] += 1
+            self.wait("files")
+            return self.send_bytes(self.voice, "audio/ogg")
+        self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        body = self.read_body()
+        path = urlparse(self.path).path
+        if path.startswith("/v1/"):
+            return self.openai(path[4:], body)
+        if path.startswith("/bot"):
+            return self.telegram(path.rsplit("/", 1)[-1], self.params(body))
+        if path.endswith("/Messages.json"):
+            return self.twilio(self.params(body))
+        self.send_json({"error": "not found"}, 404)
+
+    def openai(self, endpoint: str, body: bytes):
+        self.stats[endpoint] += 1
+        if endpoint == "audio/transcriptions":
+            self.wait("whisper")
+            return self.send_json({"text": random.choice(SPOKEN)})
+        request = json.loads(body or b"{}")
+        if endpoint == "embeddings":
+            self.wait("embeddings")
+            texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+            b64 = request.get("encoding_format") == "base64"
+            data = [{"object": "embedding", "index": i,
+                     "embedding": base64.b64encode(embedding(str(text)).tobytes()).decode() if b64 else embedding(str(text)).tolist()}
+                    for i, text in enumerate(texts)]
+            return self.send_json({"object": "list", "data": data, "model": request.get("model"),
+                                   "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+        if endpoint == "images/generations":
+            self.wait("images")
+            return self.send_json({"created": int(time.time()),
+                                   "data": [{"url": f"http://{self.headers['Host']}/media/image-{random.getrandbits(32):08x}.png"}]})
+        if endpoint in ("chat/completions", "completions"):
+            chat = endpoint == "chat/completions"
+            prompt = "\n".join(m["content"] for m in request["messages"]) if chat else (
+                request["prompt"][0] if isinstance(request["prompt"], list) else request["prompt"])
+            if self.record_prompts:
+                with self.lock:
+                    self.prompts.append(prompt)
+            text = answer(prompt, self.reply_tokens)
+            latency = self.latency.sample("chat")
+            if request.get("stream"):
+                return self.stream(text, latency, chat, request.get("model"))
+            time.sleep(latency)
+            choice = {"index": 0, "finish_reason": "stop"}
+            choice.update({"message": {"role": "assistant", "content": text}} if chat else {"text": text})
+            completion_tokens = len(text.split())
+            return self.send_json({"id": "bench", "object": "chat.completion" if chat else "text_completion",
+                                   "created": int(time.time()), "model": request.get("model"), "choices": [choice],
+                                   "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": completion_tokens,
+                                             "total_tokens": len(prompt) // 4 + completion_tokens}})
+        self.send_json({"error": {"message": f"unknown endpoint {endpoint}"}}, 404)
+
+    def stream(self, text: str, latency: float, chat: bool, model: str):
+        """ Server-sent events, the first token after FIRST_TOKEN_SHARE of the latency """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        tokens = re.findall(r"\S+\s*", text)
+        time.sleep(latency * FIRST_TOKEN_SHARE)
+        per_token = latency * (1 - FIRST_TOKEN_SHARE) / max(1, len(tokens))
+        for i, token in enumerate(tokens):
+            delta = {"delta": {"content": token}} if chat else {"text": token}
+            chunk = {"id": "bench", "object": "chat.completion.chunk" if chat else "text_completion",
+                     "created": int(time.time()), "model": model,
+                     "choices": [dict(delta, index=0, finish_reason="stop" if i == len(tokens) - 1 else None)]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(per_token)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def telegram(self, method: str, params: Dict):
+        self.stats[f"telegram.{method}"] += 1
+        if method == "getMe":
+            return self.send_json({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench",
+                                                          "username": "bench_bot"}})
+        if method == "getFile":
+            return self.send_json({"ok": True, "result": {"file_id": params.get("file_id", "voice"),
+                                                          "file_unique_id": "voice", "file_size": len(self.voice),
+                                                          "file_path": "voice/file.oga"}})
+        if method in ("sendMessage", "sendPhoto", "editMessageText"):
+            self.record("telegram", params.get("chat_id"), method)
+        self.wait("telegram")
+        self.send_json({"ok": True, "result": {"message_id": random.getrandbits(31), "date": int(time.time()),
+                                               "chat": {"id": params.get("chat_id"), "type": "private"},
+                                               "text": params.get("text", "")}})
+
+    def twilio(self, params: Dict):
+        self.stats["twilio.messages"] += 1
+        self.record("twilio", params.get("To"), "message")
+        self.wait("twilio")
+        self.send_json({"sid": f"SM{random.getrandbits(128):032x}", "status": "queued", "to": params.get("To")}, 201)
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 512
+
+
+def parse_latencies(specs: List[str]) -> Dict[str, Tuple[float, float]]:
+    latencies = dict(LATENCIES)
+    for spec in specs:
+        kind, _, values = spec.partition("=")
+        median, _, p99 = values.partition(":")
+        if kind not in latencies:
+            raise ValueError(f"unknown latency kind {kind}, one of {', '.join(latencies)}")
+        latencies[kind] = (float(median), float(p99 or median))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8081, help="0 picks a free port")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every latency")
+    parser.add_argument("--latency", action="append", default=[], metavar="KIND=MEDIAN:P99",
+                        help=f"latency of one kind of call ({', '.join(LATENCIES)})")
+    parser.add_argument("--reply-tokens", type=int, default=60, help="words per chat completion")
+    parser.add_argument("--record-prompts", action="store_true", help="keep the prompts for GET /_prompts")
+    args = parser.parse_args()
+
+    FakeServices.latency = Latency(parse_latencies(args.latency), args.scale)
+    FakeServices.reply_tokens = args.reply_tokens
+    FakeServices.record_prompts = args.record_prompts
+    FakeServices.voice = voice_file()
+    server = Server(("127.0.0.1", args.port), FakeServices)
+    # The load test reads the port from the first line
+    print(f"http://127.0.0.1:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Exercise timeouts, hedging and circuit breakers against a fault-injecting stub server.
+
+The stub answers in FAST seconds, except in 'tail' mode where TAIL_SHARE of
+requests take SLOW seconds, and in 'hang' mode where it never answers in
+time. Checks that hedging cuts the tail latency, that a hanging service
+trips its breaker so later calls fail fast, that the breaker closes again
+once the service recovers, and that a hanging Whisper API gets the user a
+fallback message instead of a stuck voice reply.
+
+    python bench/fault_injection.py [CALLS]
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import httpx
+import openai
+
+import resilience
+import voice_handler
+from resilience import CircuitOpen, Dependency, DependencyTimeout
+
+FAST = 0.01
+SLOW = 0.5
+TAIL_SHARE = 0.03
+
+mode = "ok"
+
+
+class FaultyStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        if mode == "hang":
+            time.sleep(5)
+        elif mode == "tail" and random.random() < TAIL_SHARE:
+            time.sleep(SLOW)
+        else:
+            time.sleep(FAST)
+        body = b'{"text": "ok"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = handle_request
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+async def timed_calls(dep: Dependency, client: httpx.AsyncClient, url: str, calls: int):
+    latencies = []
+
+    async def one():
+        start = time.perf_counter()
+        await dep.call(lambda: client.get(url))
+        latencies.append(time.perf_counter() - start)
+
+    for start in range(0, calls, 10):
+        await asyncio.gather(*(one() for _ in range(min(10, calls - start))))
+    return latencies
+
+
+async def hedging(url: str, calls: int):
+    global mode
+    mode = "tail"
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=100)) as client:
+        for hedge in (None, 95):
+            dep = Dependency("stub", timeout=5.0, hedge=hedge)
+            latencies = await timed_calls(dep, client, url, calls)
+            status = dep.status()
+            print(f"hedge={str(hedge):4s}  p50 {percentile(latencies, 50) * 1000:6.1f} ms  "
+                  f"p99 {percentile(latencies, 99) * 1000:6.1f} ms  hedged {status['hedged']}, "
+                  f"hedge win rate {status['hedge_win_rate']:.0%}")
+        assert percentile(latencies, 99) < SLOW / 2, "hedging did not cut the tail latency"
+
+
+async def breaker(url: str):
+    global mode
+    mode = "hang"
+    dep = Dependency("stub", timeout=0.2, threshold=3, reset_after=0.5)
+    outcomes = []
+    async with httpx.AsyncClient() as client:
+        for _ in range(8):
+            start = time.perf_counter()
+            try:
+                await dep.call(lambda: client.get(url))
+                outcomes.append(("ok", time.perf_counter() - start))
+            except (DependencyTimeout, CircuitOpen) as e:
+                outcomes.append((type(e).__name__, time.perf_counter() - start))
+        print("hanging service: " + ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in outcomes))
+        assert [name for name, _ in outcomes[:3]] == ["DependencyTimeout"] * 3
+        assert all(name == "CircuitOpen" and seconds < 0.01 for name, seconds in outcomes[3:]), "breaker did not open"
+
+        mode = "ok"
+        await asyncio.sleep(0.5)
+        await dep.call(lambda: client.get(url))
+        print(f"after recovery: breaker {dep.breaker.state}")
+        assert dep.breaker.state == "closed"
+
+
+async def voice_fallback():
+    global mode
+    mode = "hang"
+    whisper = resilience.dependency("whisper")
+    whisper.timeout = 0.2
+    whisper.breaker.threshold = 2
+    replies = []
+    for _ in range(3):
+        start = time.perf_counter()
+        replies.append((await voice_handler.handle_voice_message(b"audio", 1), time.perf_counter() - start))
+    print(f"voice with Whisper hanging: {replies[-1][0]!r} "
+          f"({', '.join(f'{seconds * 1000:.0f} ms' for _, seconds in replies)})")
+    assert all(reply.endswith(whisper.message) for reply, _ in replies)
+    assert whisper.breaker.state == "open" and replies[-1][1] < 0.01
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FaultyStub)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    openai.api_base = f"{url}/v1"
+
+    asyncio.run(hedging(url, calls))
+    asyncio.run(breaker(url))
+    asyncio.run(voice_fallback())
+
+
+if __name__ == "__main__":
+    main()
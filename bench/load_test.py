@@ -0,0 +1,395 @@
+"""
+End-to-end load test of the app against local stand-ins for OpenAI, Telegram and Twilio.
+
+Starts bench/fakes.py in a subprocess and runs the FastAPI app of main.py
+in this process with its background tasks. USERS virtual users each send
+a message to the webhooks, wait for the reply, wait for it to finish, and
+send the next one until DURATION seconds are over. The messages are a mix
+of text, voice, /image and /task messages on Telegram and WhatsApp
+(/task messages always go to WhatsApp, the Telegram handler only knows
+/task with BABYAGI on and then answers nothing else). With --replay the
+users replay recorded webhook payloads instead, one JSON object per line:
+
+    {"platform": "telegram", "update": {...Telegram update...}}
+    {"platform": "whatsapp", "form": {...Twilio webhook form...}}
+
+Reports throughput, the p50/p95/p99 time to the first reply and until the
+message's job is done per message kind, p50/p95/p99 of every pipeline
+stage (from the traces, see tracing.py) and peak RSS. Results are saved to
+bench/results/LABEL.json; --baseline compares them with an earlier run.
+
+    python bench/load_test.py [--users 20] [--duration 60] [--mix text=70,voice=10,image=10,task=10]
+                              [--platforms telegram=50,whatsapp=50] [--replay FILE] [--scale 1.0]
+                              [--label NAME] [--baseline bench/results/NAME.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+import urllib.request
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("ACCOUNT_SID", "ACbench")
+os.environ.setdefault("AUTH_TOKEN", "bench")
+os.environ.setdefault("TWILIO_WHATSAPP_NUMBER", "+15550000000")
+os.environ.setdefault("FACEBOOK_PAGE_ID", "bench")
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+TEXTS = ["What should I cook tonight with {} and rice?", "Can you explain how {} works?",
+         "Tell me something interesting about {}.", "Summarize what we said about {} earlier.",
+         "Write a short poem about {}."]
+IMAGES = ["/image a watercolor of {}", "/image a photo of {} at sunset"]
+TASKS = ["/task plan a weekend trip about {}", "/task write a study plan for {}"]
+SUBJECTS = ["tomatoes", "black holes", "bicycles", "jazz", "volcanoes", "sourdough", "penguins", "chess",
+            "solar panels", "the roman empire", "octopuses", "coffee"]
+
+
+def weights(spec: str) -> Dict[str, float]:
+    return {name: float(weight) for name, _, weight in (part.partition("=") for part in spec.split(",") if part)}
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    return {f"p{p}": round(values[min(len(values) - 1, int(p / 100 * len(values)))], 4) for p in (50, 95, 99)}
+
+
+def start_fakes(args) -> subprocess.Popen:
+    command = [sys.executable, os.path.join(BENCH_DIR, "fakes.py"), "--port", "0", "--scale", str(args.scale),
+               "--reply-tokens", str(args.reply_tokens)]
+    for spec in args.latency:
+        command += ["--latency", spec]
+    return subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+
+
+class LoadTest:
+    def __init__(self, args, fake_url: str):
+        self.args = args
+        self.fake_url = fake_url
+        self.rng = random.Random(args.seed)
+        self.results: List[Dict] = []
+        self.deadline = 0.0
+        self.counter = 0
+        # Reply events from the fakes: waiters per chat, time of the last reply per chat
+        self.waiters: Dict[str, List] = defaultdict(list)
+        self.last_reply: Dict[str, float] = {}
+
+    def next_id(self) -> int:
+        self.counter += 1
+        return self.counter
+
+    async def poll_events(self, fakes):
+        seen = 0
+        while True:
+            events = (await fakes.get(f"{self.fake_url}/_events", params={"after": seen})).json()
+            seen += len(events)
+            for event in events:
+                self.last_reply[event["chat"]] = event["time"]
+                waiting = self.waiters[event["chat"]]
+                for sent, future in list(waiting):
+                    if event["time"] >= sent and not future.done():
+                        future.set_result(event["time"])
+                        waiting.remove((sent, future))
+            await asyncio.sleep(0.01)
+
+    def synthetic(self, user: int, platform: str):
+        """ Messages of a synthetic user: (kind, platform, chat, build(n) -> request) forever """
+        mix = weights(self.args.mix)
+        while True:
+            kind = self.rng.choices(list(mix), list(mix.values()))[0]
+            subject = self.rng.choice(SUBJECTS)
+            text = {"text": TEXTS, "image": IMAGES, "task": TASKS}.get(kind, [""])
+            text = self.rng.choice(text).format(subject) + f" ({self.rng.randrange(10 ** 6)})"
+            if kind == "task":
+                # Objectives keep reporting in their chat, give each its own
+                yield kind, "whatsapp", f"whatsapp:+1666{self.next_id():07d}", {"text": text}
+            elif platform == "telegram":
+                yield kind, platform, str(100000 + user), {"text": text, "voice": kind == "voice"}
+            else:
+                yield kind, platform, f"{platform}:+1555{user:07d}", {"text": text, "voice": kind == "voice"}
+
+    def replayed(self, user: int, records: List[Dict]):
+        """ The recorded messages of a user, with the user's chat and fresh ids """
+        while True:
+            for record in records:
+                if record["platform"] == "telegram":
+                    message = record["update"]["message"]
+                    text, voice = message.get("text", ""), "voice" in message
+                else:
+                    text, voice = record["form"].get("Body", ""), bool(record["form"].get("MediaUrl0"))
+                kind = "voice" if voice else "task" if text.startswith("/task") else "image" if "/image" in text else "text"
+                if kind == "task":
+                    yield kind, "whatsapp", f"whatsapp:+1666{self.next_id():07d}", dict(record, text=text)
+                elif record["platform"] == "telegram":
+                    yield kind, "telegram", str(100000 + user), dict(record, text=text, voice=voice)
+                else:
+                    yield kind, record["platform"], f"{record['platform']}:+1555{user:07d}", dict(record, text=text, voice=voice)
+
+    def request(self, platform: str, chat: str, message: Dict):
+        """ The webhook request and the dedup key of its job """
+        n = self.next_id()
+        if platform == "telegram":
+            update = json.loads(json.dumps(message.get("update") or {"message": {}}))
+            update["update_id"] = n
+            update["message"].update({"message_id": n, "date": int(time.time()),
+                                      "chat": {"id": int(chat), "type": "private"}})
+            if message.get("voice"):
+                update["message"].pop("text", None)
+                update["message"]["voice"] = {"file_id": f"voice{n}", "file_unique_id": f"voice{n}", "duration": 3}
+            else:
+                update["message"]["text"] = message["text"]
+            return ("/webhook/", {"json": update}), f"telegram:{n}"
+        form = dict(message.get("form") or {})
+        sid = f"SM{n:032x}"
+        form.update({"From": chat, "To": f"{platform}:{os.environ['TWILIO_WHATSAPP_NUMBER']}", "MessageSid": sid,
+                     "Body": message["text"]})
+        if platform == "messenger":
+            form["To"] = f"messenger:{os.environ['FACEBOOK_PAGE_ID']}"
+        if message.get("voice"):
+            form.update({"Body": "", "MediaUrl0": f"{self.fake_url}/media/voice-{n}.ogg"})
+        return ("/api", {"data": form}), f"twilio:{sid}"
+
+    async def job_done(self, key: str) -> Optional[float]:
+        """ Wait for the message's job, returns when it finished or None if it failed """
+        from executor import run_sync
+        from job_queue import queue as job_queue
+
+        def state():
+            with job_queue._lock:
+                return job_queue._connect().execute(
+                    "SELECT state, updated, error FROM jobs WHERE dedup_key = ?", (key,)).fetchone()
+
+        while time.time() < self.deadline + self.args.timeout:
+            row = await run_sync(state)
+            if row is not None and row[0] == "done":
+                return row[1]
+            if row is not None and (row[0] == "failed" or row[2]):
+                return None
+            await asyncio.sleep(0.02)
+        return None
+
+    async def user(self, http, user: int, messages):
+        for kind, platform, chat, message in messages:
+            if time.time() >= self.deadline:
+                return
+            (path, body), key = self.request(platform, chat, message)
+            future = asyncio.get_running_loop().create_future()
+            sent = time.time()
+            self.waiters[chat].append((sent, future))
+            response = await http.post(path, **body)
+            result = {"kind": kind, "platform": platform, "ok": response.status_code == 200}
+            try:
+                result["first_reply"] = await asyncio.wait_for(future, self.args.timeout) - sent
+            except asyncio.TimeoutError:
+                result.update(first_reply=None, ok=False)
+            done = await self.job_done(key)
+            result["done"] = None if done is None else done - sent
+            result["ok"] = result["ok"] and done is not None
+            self.results.append(result)
+            # Let the rest of a streamed reply arrive before the next message
+            while kind != "task" and time.time() - self.last_reply.get(chat, 0) < self.args.settle:
+                await asyncio.sleep(self.args.settle / 4)
+
+    async def run(self, app) -> float:
+        import httpx
+        import main
+        import telegram
+        import telegram_handler
+        import babyagi
+
+        bot = telegram.Bot(os.environ["TELEGRAM_BOT_TOKEN"], base_url=f"{self.fake_url}/bot",
+                           base_file_url=f"{self.fake_url}/file/bot")
+        await bot.initialize()
+        telegram_handler.bot = bot
+        await main.start_background_tasks()
+        # Measure the pipeline, not its warm up
+        await main.pipeline_ready.wait()
+
+        if self.args.replay:
+            with open(self.args.replay) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+            plans = [self.replayed(user, records[user % len(records):] + records[:user % len(records)])
+                     for user in range(self.args.users)]
+        else:
+            platforms = weights(self.args.platforms)
+            plans = [self.synthetic(user, self.rng.choices(list(platforms), list(platforms.values()))[0])
+                     for user in range(self.args.users)]
+
+        limits = httpx.Limits(max_connections=self.args.users + 10)
+        async with httpx.AsyncClient(app=app, base_url="http://bench", timeout=self.args.timeout) as http, \
+                httpx.AsyncClient(limits=limits) as fakes:
+            poller = asyncio.create_task(self.poll_events(fakes))
+            start = time.time()
+            self.deadline = start + self.args.duration
+            await asyncio.gather(*(self.user(http, user, plan) for user, plan in enumerate(plans)))
+            elapsed = time.time() - start
+            poller.cancel()
+        for chat in list(babyagi.task_engine.runs):
+            babyagi.task_engine.cancel(chat)
+        await asyncio.sleep(0.1)
+        await main.flush_state()
+        await bot.shutdown()
+        return elapsed
+
+
+def stage_latencies(trace_log: str) -> Dict[str, Dict]:
+    """ Percentiles (seconds) of every span in the trace log, LLM calls per prompt stage """
+    durations = defaultdict(list)
+
+    def walk(span):
+        name = span["name"]
+        if name == "llm":
+            name = f"llm:{span.get('attributes', {}).get('prompt')}"
+        if span["duration_ms"] is not None:
+            durations[name].append(span["duration_ms"] / 1000)
+        for child in span.get("children", []):
+            walk(child)
+
+    if os.path.exists(trace_log):
+        with open(trace_log) as f:
+            for line in f:
+                walk(json.loads(line))
+    return {name: dict(count=len(values), **percentiles(values)) for name, values in sorted(durations.items())}
+
+
+def report(results: Dict):
+    print(f"\n{results['messages']} messages in {results['elapsed_seconds']:.1f}s with {results['settings']['users']} users: "
+          f"{results['throughput_per_second']:.2f} messages/s, {results['errors']} errors, "
+          f"peak RSS {results['peak_rss_mb']:.0f} MB (after startup {results['startup_rss_mb']:.0f} MB)")
+    print(f"\n{'message':<10}{'count':>7}  {'first reply p50/p95/p99 (s)':>30}  {'done p50/p95/p99 (s)':>30}")
+    for kind, stats in results["kinds"].items():
+        row = lambda p: "/".join("-" if p[k] is None else f"{p[k]:.2f}" for k in ("p50", "p95", "p99"))
+        print(f"{kind:<10}{stats['count']:>7}  {row(stats['first_reply']):>30}  {row(stats['done']):>30}")
+    print(f"\n{'stage':<26}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in results["stages"].items():
+        print(f"{name:<26}{stats['count']:>7}" + "".join(f"{stats[p] * 1000:>10.1f}" for p in ("p50", "p95", "p99")))
+
+
+def compare(results: Dict, baseline: Dict):
+    """ Print the change of every number against a baseline run """
+    rows = [("throughput/s", baseline["throughput_per_second"], results["throughput_per_second"]),
+            ("peak RSS MB", baseline["peak_rss_mb"], results["peak_rss_mb"])]
+    for kind, stats in results["kinds"].items():
+        for metric in ("first_reply", "done"):
+            for p in ("p50", "p95", "p99"):
+                old = baseline["kinds"].get(kind, {}).get(metric, {}).get(p)
+                rows.append((f"{kind} {metric} {p}", old, stats[metric][p]))
+    for name, stats in results["stages"].items():
+        rows.append((f"{name} p95", baseline["stages"].get(name, {}).get("p95"), stats["p95"]))
+    print(f"\nagainst {baseline['label']} ({baseline.get('commit', '?')[:10]}):")
+    print(f"{'':<34}{'baseline':>12}{'now':>12}{'change':>10}")
+    for name, old, new in rows:
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old:+.0%}" if old else ""
+        print(f"{name:<34}{old:>12.3f}{new:>12.3f}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=20, help="virtual users sending messages concurrently")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds to send messages for")
+    parser.add_argument("--mix", default="text=70,voice=10,image=10,task=10", help="message kinds and weights")
+    parser.add_argument("--platforms", default="telegram=50,whatsapp=50", help="platforms of the users and weights")
+    parser.add_argument("--replay", help="JSON lines of recorded webhook payloads to replay")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the latency of every fake service")
+    parser.add_argument("--latency", action="append", default=[], metavar="KIND=MEDIAN:P99",
+                        help="latency of a fake service, see bench/fakes.py")
+    parser.add_argument("--reply-tokens", type=int, default=60, help="words per fake chat completion")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for a reply")
+    parser.add_argument("--settle", type=float, default=0.2, help="quiet seconds after a reply before the next message")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default=time.strftime("%Y%m%d-%H%M%S"), help="name of the results file")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    fakes = start_fakes(args)
+    fake_url = fakes.stdout.readline().strip()
+    os.environ.setdefault("OPENAI_API_BASE", f"{fake_url}/v1")
+    os.environ["TELEGRAM_API_BASE"] = os.environ["TWILIO_API_BASE"] = fake_url
+    try:
+        import openai
+        import config
+        import utils
+        import babyagi
+        import conversation_store
+        import embeddings
+        from job_queue import queue as job_queue
+        from main import app
+
+        openai.api_base = f"{fake_url}/v1"
+        config.TELEGRAM_API_BASE = config.TWILIO_API_BASE = fake_url
+        config.HISTORY_DIR = tempfile.mkdtemp()
+        config.VECTOR_MEMORY_DIR = os.path.join(config.HISTORY_DIR, "vectors")
+        # Every trace is logged, the stage latencies are read from them
+        config.TRACE_LOG = os.path.join(config.HISTORY_DIR, "traces.jsonl")
+        config.TRACE_SLOW_SECONDS = 0
+        conversation_store.store.path = os.path.join(config.HISTORY_DIR, "conversations.db")
+        job_queue.path = os.path.join(config.HISTORY_DIR, "jobs.db")
+        embeddings.service.path = os.path.join(config.HISTORY_DIR, "embeddings.db")
+        utils.topic_router.log_path = None
+        babyagi.result_store = babyagi.LocalResultStore(os.path.join(config.HISTORY_DIR, "babyagi_results"))
+        babyagi.YOUR_FIRST_TASK = "Make a todo list"
+        # /task only works on WhatsApp and Messenger, see the docstring
+        import twilio_handler
+        twilio_handler.BABYAGI = True
+
+        startup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        test = LoadTest(args, fake_url)
+        elapsed = asyncio.run(test.run(app))
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        with urllib.request.urlopen(f"{fake_url}/_stats") as response:
+            fake_stats = json.load(response)
+    finally:
+        fakes.terminate()
+
+    by_kind = defaultdict(list)
+    for result in test.results:
+        by_kind[result["kind"]].append(result)
+    commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True).stdout.strip()
+    results = {
+        "label": args.label,
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("label", "baseline")},
+        "messages": len(test.results),
+        "errors": sum(not result["ok"] for result in test.results),
+        "elapsed_seconds": round(elapsed, 2),
+        "throughput_per_second": round(sum(result["ok"] for result in test.results) / elapsed, 3),
+        "kinds": {kind: {"count": len(items),
+                         "first_reply": percentiles([r["first_reply"] for r in items if r["first_reply"] is not None]),
+                         "done": percentiles([r["done"] for r in items if r["done"] is not None])}
+                  for kind, items in sorted(by_kind.items())},
+        "stages": stage_latencies(config.TRACE_LOG),
+        "peak_rss_mb": round(peak_rss, 1),
+        "startup_rss_mb": round(startup_rss, 1),
+        "fake_calls": fake_stats,
+    }
+    report(results)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{args.label}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nsaved to {os.path.relpath(path)}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    if not results["messages"] or results["errors"] > results["messages"] / 10:
+        sys.exit("more than 10% of the messages failed")
+
+
+if __name__ == "__main__":
+    main()
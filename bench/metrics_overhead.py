@@ -0,0 +1,131 @@
+"""
+Measure the cost of the metrics timing API and check what /metrics reports.
+
+Times metrics.timed() against an empty loop, renders a registry with
+SERIES label sets, then answers a few chat messages with fake models and
+checks that /metrics has the pipeline stages, per-model token counts and
+per-platform message counts.
+
+    python bench/metrics_overhead.py [CALLS] [SERIES]
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from typing import List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import httpx
+from langchain.llms.base import LLM
+from langchain.schema import Generation, LLMResult
+
+import config
+import utils
+import models
+import metrics
+import embeddings
+import conversation_store
+from chat_handler import process_chat_message
+from main import app
+
+
+class FakeLLM(LLM):
+    @property
+    def _llm_type(self) -> str:
+        return "metrics-fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        return "chat" if "Return a single word" in prompt else "fake reply"
+
+    async def _agenerate(self, prompts: List[str], stop: Optional[List[str]] = None) -> LLMResult:
+        return LLMResult(generations=[[Generation(text=self._call(prompt))] for prompt in prompts],
+                         llm_output={"token_usage": {"prompt_tokens": 50, "completion_tokens": 5}})
+
+
+def fake_embeddings(texts: List[str]) -> List[List[float]]:
+    return [[float(len(text) % 7)] * 1536 for text in texts]
+
+
+def overhead(calls: int):
+    start = time.perf_counter()
+    for _ in range(calls):
+        pass
+    empty = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(calls):
+        with metrics.timed("bench", model="gpt-4"):
+            pass
+    per_call = (time.perf_counter() - start - empty) / calls
+    print(f"metrics.timed: {per_call * 1e6:.2f} us per call")
+    return per_call
+
+
+def render_time(series: int):
+    histogram = metrics.Histogram("bench_seconds", "Render benchmark")
+    for i in range(series):
+        histogram.observe(i / series, chat=str(i))
+    start = time.perf_counter()
+    text = metrics.render()
+    elapsed = time.perf_counter() - start
+    metrics.registry.remove(histogram)
+    print(f"render: {series} histogram series, {len(text) / 1024:.0f} KiB in {elapsed * 1000:.1f} ms")
+
+
+async def scrape(messages: int) -> str:
+    metrics.current_platform.set("telegram")
+    for i in range(messages):
+        await process_chat_message(f"hello number {i}", i % 3)
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as http:
+        response = await http.get("/metrics")
+    assert response.status_code == 200
+    return response.text
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    series = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    if overhead(calls) > 20e-6:
+        sys.exit("metrics.timed is too slow to leave on")
+    render_time(series)
+
+    config.HISTORY_DIR = tempfile.mkdtemp()
+    conversation_store.store.path = os.path.join(config.HISTORY_DIR, "conversations.db")
+    config.VECTOR_MEMORY_DIR = os.path.join(config.HISTORY_DIR, "vectors")
+    embeddings.service.path = os.path.join(config.HISTORY_DIR, "embeddings.db")
+    embeddings.service._request = fake_embeddings
+    utils.topic_router.log_path = None
+    config.STREAM_REPLIES = False
+    models.initialize_language_model = lambda selected_model, **kwargs: FakeLLM(
+        callback_manager=models.AsyncCallbackManager([models.ModelMetricsHandler(selected_model, False)]))
+
+    text = asyncio.run(scrape(6))
+    expected = [
+        ("stage_seconds_count", {"stage": "reply", "platform": "telegram"}, 6),
+        ("stage_seconds_count", {"stage": "topic_routing"}, None),
+        ("stage_seconds_count", {"stage": "llm", "model": "gpt-4", "prompt": "chat"}, 6),
+        ("llm_tokens_total", {"model": "gpt-4", "kind": "completion"}, None),
+        ("messages_total", {"platform": "telegram", "topic": "chat"}, 6),
+        ("stage_in_flight", {"stage": "reply", "platform": "telegram"}, 0),
+    ]
+    for name, labels, value in expected:
+        found = [(sample, labels_of, sample_value) for sample, labels_of, sample_value in parse(text)
+                 if sample == name and labels.items() <= labels_of.items()]
+        assert found and (value is None or found[0][2] == value), f"missing {name} {labels} {value}"
+        print(f"{name} {found[0][1]} {found[0][2]:g}")
+
+
+def parse(text: str):
+    for line in text.splitlines():
+        if line.startswith("#"):
+            continue
+        series, value = line.rsplit(" ", 1)
+        name, _, labels = series.partition("{")
+        pairs = (pair.split("=", 1) for pair in labels.rstrip("}").split(",") if pair)
+        yield name, {key: raw.strip('"') for key, raw in pairs}, float(value)
+
+
+if __name__ == "__main__":
+    main()
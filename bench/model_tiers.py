@@ -0,0 +1,74 @@
+"""
+Exercise per-stage model fallback and latency-based step-down with fake models.
+
+The first model of a test stage fails every 5th call and is slower than the
+stage's latency target, the second one is fast. Checks that failed calls
+fall back to the second model, that the stage steps down once its p90 misses
+the target and that it tries the first model again later.
+
+    python bench/model_tiers.py
+"""
+import os
+import sys
+import time
+import asyncio
+from typing import List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+from langchain.llms.base import LLM
+
+import models
+from models import ModelTiers
+
+LATENCY = {"slow": 0.05, "fast": 0.005}
+FAIL_EVERY = 5
+
+
+class FakeLLM(LLM):
+    name: str
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "tier-fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        raise NotImplementedError
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        self.calls += 1
+        await asyncio.sleep(LATENCY[self.name])
+        if self.name == "slow" and self.calls % FAIL_EVERY == 0:
+            raise RuntimeError("model overloaded")
+        return self.name
+
+
+async def ask(llm: LLM) -> str:
+    return (await llm.agenerate(["hi"])).generations[0][0].text
+
+
+async def run(tiers: ModelTiers, calls: int) -> List[str]:
+    return [await tiers.call("test", ask) for _ in range(calls)]
+
+
+def main():
+    models.initialize_language_model = lambda selected_model, **kwargs: FakeLLM(name=selected_model)
+    stages = {"test": {"models": ["slow", "fast"], "timeout": 1.0, "target": 0.02}}
+    tiers = ModelTiers(stages, window=10, step_up_after=0.3)
+
+    start = time.monotonic()
+    answers = asyncio.run(run(tiers, 30))
+    print(f"30 calls in {time.monotonic() - start:.2f}s: {answers.count('slow')} on slow, "
+          f"{answers.count('fast')} on fast, stats {dict(tiers.stats)}")
+    assert answers[:4] == ["slow"] * 4 and answers[4] == "fast", "a failed call did not fall back"
+    assert tiers.stats["step_downs"] == 1 and tiers.model("test") == "fast", "stage did not step down"
+
+    time.sleep(0.3)
+    asyncio.run(run(tiers, 1))
+    assert tiers.stats["step_ups"] == 1, "stage did not try the first model again"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+Run the app in several uvicorn worker processes and check that they share the chat state.
+
+Starts bench/fakes.py and, for each run, `uvicorn main:app --workers W` in a
+fresh directory. Virtual users each own a Telegram chat and send text
+messages in a closed loop: the next message once the job of the previous one
+is done. Consecutive messages of a chat land on different workers, so the
+cached sessions of the other workers go stale all the time. Each run checks:
+
+- every message is stored once, in order, in its chat's history;
+- the chat prompt of every message has the previous message of the chat in
+  its recent conversation, a stale session would miss it;
+- throughput, against the run with one worker. Users scale with workers, so
+  with fewer CPUs than workers this shows that sharing the state costs no
+  throughput rather than added CPU capacity.
+
+Runs with STATE_BACKEND=sqlite, plus one run with the in-process backend and
+the most workers as a control, where stale prompts are expected. Exits
+non-zero if a sqlite run has stale prompts or history errors, or if the
+throughput scales less than MIN_EFFICIENCY per worker while there are enough
+CPUs for the workers.
+
+    python bench/multi_worker.py [--workers 1,4] [--users-per-worker 8] [--duration 20]
+"""
+import os
+import sys
+import time
+import socket
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+from typing import Dict, List
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(BENCH_DIR, "..", "app")
+
+# Throughput of W workers should be at least this share of W times one worker's
+MIN_EFFICIENCY = 0.7
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_fakes(args) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fakes.py"), "--port", "0", "--scale", str(args.scale),
+                             "--reply-tokens", "20", "--record-prompts"], stdout=subprocess.PIPE, text=True)
+
+
+def start_app(workers: int, backend: str, cwd: str, fake_url: str) -> (subprocess.Popen, str):
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_API_BASE": f"{fake_url}/v1",
+        "TELEGRAM_API_BASE": fake_url,
+        "TELEGRAM_BOT_TOKEN": "bench",
+        "STATE_BACKEND": backend,
+    })
+    for name in ("ZAPIER_NLA_API_KEY", "TWILIO_WHATSAPP_NUMBER", "FACEBOOK_PAGE_ID"):
+        env.pop(name, None)
+    port = free_port()
+    log = open(os.path.join(cwd, "app.log"), "w")
+    app = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", os.path.abspath(APP),
+                            "--workers", str(workers), "--port", str(port), "--log-level", "warning"],
+                           cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return app, f"http://127.0.0.1:{port}"
+
+
+async def wait_ready(http: httpx.AsyncClient, workers: int, timeout: float = 180):
+    """ Until enough scrapes in a row, served by random workers, report a loaded pipeline """
+    deadline = time.time() + timeout
+    ready = 0
+    while ready < 5 * workers:
+        if time.time() > deadline:
+            sys.exit("the workers did not load the message pipeline in time")
+        try:
+            response = await http.get("/metrics")
+            ready = ready + 1 if "\npipeline_ready 1" in response.text else 0
+        except httpx.TransportError:
+            ready = 0
+        await asyncio.sleep(0.1)
+
+
+class Run:
+    def __init__(self, args, number: int, workers: int, backend: str, cwd: str):
+        self.args = args
+        self.number = number
+        self.workers = workers
+        self.backend = backend
+        self.cwd = cwd
+        self.sent: Dict[str, List[str]] = defaultdict(list)
+        self.update_id = number * 10 ** 7
+        self.deadline = 0.0
+
+    def job_state(self, key: str):
+        conn = sqlite3.connect(os.path.join(self.cwd, "history", "jobs.db"))
+        try:
+            return conn.execute("SELECT state FROM jobs WHERE dedup_key = ?", (key,)).fetchone()
+        finally:
+            conn.close()
+
+    async def user(self, http: httpx.AsyncClient, user: int):
+        chat = self.number * 1000 + user
+        k = 0
+        while time.time() < self.deadline:
+            self.update_id += 1
+            update_id = self.update_id
+            text = f"run {self.number} chat {chat} message {k} hello"
+            await http.post("/webhook/", json={"update_id": update_id, "message": {"chat": {"id": chat}, "text": text}})
+            while True:
+                row = await asyncio.to_thread(self.job_state, f"telegram:{update_id}")
+                if row is not None and row[0] in ("done", "failed"):
+                    break
+                await asyncio.sleep(0.02)
+            if row[0] == "done":
+                self.sent[str(chat)].append(text)
+            k += 1
+
+    async def run(self, http: httpx.AsyncClient) -> float:
+        users = self.args.users_per_worker * self.workers
+        start = time.time()
+        self.deadline = start + self.args.duration
+        await asyncio.gather(*(self.user(http, user) for user in range(users)))
+        return time.time() - start
+
+    def history_errors(self) -> int:
+        conn = sqlite3.connect(os.path.join(self.cwd, "history", "conversations.db"))
+        errors = 0
+        for chat, texts in self.sent.items():
+            stored = [human for human, in conn.execute("SELECT human FROM turns WHERE chat_id = ? ORDER BY id", (chat,))]
+            if stored != texts:
+                errors += 1
+                if self.backend == "sqlite":
+                    print(f"  chat {chat}: sent {len(texts)} messages, stored {len(stored)}, in order: {stored == texts}")
+        conn.close()
+        return errors
+
+    def handoffs(self) -> int:
+        """ Consecutive messages of a chat answered by different workers """
+        conn = sqlite3.connect(os.path.join(self.cwd, "history", "jobs.db"))
+        owners = defaultdict(list)
+        for chat, owner in conn.execute("SELECT chat, owner FROM jobs ORDER BY id"):
+            owners[chat].append(owner)
+        conn.close()
+        return sum(a != b for chat in owners.values() for a, b in zip(chat, chat[1:]))
+
+    def stale_prompts(self, prompts: List[str]) -> int:
+        """ Messages whose chat prompt is missing the previous message of the chat """
+        recent = defaultdict(list)
+        for prompt in prompts:
+            if "Recent conversaton:" not in prompt:
+                continue
+            history, _, human = prompt.rpartition("Human:")
+            message = human.split("\n")[0].strip()
+            recent[message].append(history.split("Recent conversaton:")[-1])
+        stale = 0
+        for texts in self.sent.values():
+            for previous, text in zip(texts, texts[1:]):
+                if not recent[text] or any(previous not in section for section in recent[text]):
+                    stale += 1
+        return stale
+
+
+async def measure(args, number: int, workers: int, backend: str, fake_url: str) -> Dict:
+    with tempfile.TemporaryDirectory() as cwd:
+        app, url = start_app(workers, backend, cwd, fake_url)
+        try:
+            limits = httpx.Limits(max_connections=args.users_per_worker * workers + 10)
+            async with httpx.AsyncClient(base_url=url, timeout=60, limits=limits) as http, \
+                    httpx.AsyncClient(base_url=fake_url) as fakes:
+                await wait_ready(http, workers)
+                prompts_before = len((await fakes.get("/_prompts")).json())
+                run = Run(args, number, workers, backend, cwd)
+                elapsed = await run.run(http)
+                prompts = (await fakes.get(f"/_prompts?after={prompts_before}")).json()
+        finally:
+            app.terminate()
+            app.wait(60)
+        messages = sum(len(texts) for texts in run.sent.values())
+        return {"workers": workers, "backend": backend, "messages": messages, "throughput": messages / elapsed,
+                "handoffs": run.handoffs(), "stale": run.stale_prompts(prompts), "history_errors": run.history_errors()}
+
+
+async def main_async(args):
+    fakes = start_fakes(args)
+    fake_url = fakes.stdout.readline().strip()
+    results = []
+    try:
+        configs = [(workers, "sqlite") for workers in args.workers] + [(max(args.workers), "process")]
+        for number, (workers, backend) in enumerate(configs, start=1):
+            result = await measure(args, number, workers, backend, fake_url)
+            results.append(result)
+            print(f"{workers} workers, {backend:<7}: {result['messages']:4d} messages, {result['throughput']:6.2f} msg/s, "
+                  f"{result['handoffs']:4d} handoffs, {result['stale']:3d} stale prompts, "
+                  f"{result['history_errors']} history errors")
+    finally:
+        fakes.terminate()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", default="1,4", help="comma separated worker counts, the first is the baseline")
+    parser.add_argument("--users-per-worker", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds to send messages for, per run")
+    parser.add_argument("--scale", type=float, default=0.25, help="multiply the latency of every fake service")
+    args = parser.parse_args()
+    args.workers = [int(workers) for workers in args.workers.split(",")]
+
+    results = asyncio.run(main_async(args))
+    shared = [result for result in results if result["backend"] == "sqlite"]
+    baseline = shared[0]
+    failed = False
+    for result in shared:
+        if result["stale"] or result["history_errors"]:
+            print(f"{result['workers']} workers: inconsistent chat state")
+            failed = True
+        if result is baseline:
+            continue
+        speedup = result["throughput"] / baseline["throughput"]
+        efficiency = speedup / (result["workers"] / baseline["workers"])
+        print(f"{result['workers']} workers: {speedup:.2f}x the throughput of {baseline['workers']}, "
+              f"{efficiency:.0%} per worker")
+        if efficiency < MIN_EFFICIENCY:
+            if (os.cpu_count() or 1) >= result["workers"]:
+                failed = True
+            else:
+                print(f"  only {os.cpu_count()} CPUs for {result['workers']} workers, scaling is bounded by CPU")
+    control = results[-1]
+    print(f"control, in-process state with {control['workers']} workers: {control['stale']} stale prompts")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
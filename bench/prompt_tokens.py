@@ -0,0 +1,92 @@
+"""
+Compare the size of chat prompts before and after token-budgeted assembly.
+
+Replays a synthetic conversation into two chat chains. The old one builds its
+prompt with LangChain's memory (retrieved turns as stored, overlapping the
+recent window). The new one uses utils.assemble_chat_inputs. Token counts
+use tiktoken, or an estimate when its encodings can't be downloaded.
+Exits non-zero if an assembled prompt exceeds the budget.
+
+    python bench/prompt_tokens.py [TURNS]
+"""
+import os
+import sys
+import hashlib
+import tempfile
+from typing import List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import numpy as np
+from langchain.llms.base import LLM
+
+import config
+import utils
+import models
+import conversation_store
+import embeddings
+from prompt_budget import count_tokens
+
+WORDS = "order delivery invoice weather travel recipe music garden python budget meeting holiday".split()
+
+
+class EchoLLM(LLM):
+    @property
+    def _llm_type(self) -> str:
+        return "echo"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        return prompt
+
+
+def fake_embeddings(texts: List[str]) -> List[List[float]]:
+    return [np.random.default_rng(int(hashlib.sha256(text.encode()).hexdigest()[:8], 16)).normal(size=1536).tolist()
+            for text in texts]
+
+
+def turn(i: int):
+    rng = np.random.default_rng(i)
+    topic = " ".join(rng.choice(WORDS, 3))
+    human = f"Question {i} about {topic}?"
+    ai = f"Answer {i}: " + " ".join(rng.choice(WORDS, 120))
+    return human, ai
+
+
+def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    config.HISTORY_DIR = tempfile.mkdtemp()
+    conversation_store.store.path = os.path.join(config.HISTORY_DIR, "conversations.db")
+    config.VECTOR_MEMORY_DIR = os.path.join(config.HISTORY_DIR, "vectors")
+    embeddings.service.path = os.path.join(config.HISTORY_DIR, "embeddings.db")
+    embeddings.service._request = fake_embeddings
+    models.initialize_language_model = lambda selected_model, **kwargs: EchoLLM()
+    model = config.SELECTED_MODEL
+    budget = config.PROMPT_TOKEN_BUDGET[model]
+
+    old_chain = utils.load_chat_model("old")
+    new_chain = utils.load_chat_model("new")
+    old_sizes, new_sizes = [], []
+    for i in range(turns):
+        human, ai = turn(i)
+        old_inputs = old_chain.prep_inputs({"human_input": human})
+        old_sizes.append(count_tokens(old_chain.prompt.format(**old_inputs), model))
+        old_chain.memory.save_context(old_inputs, {"text": ai})
+
+        new_inputs = utils.assemble_chat_inputs(new_chain, human)
+        new_sizes.append(count_tokens(new_chain.prompt.format(**new_inputs), model))
+        new_chain.memory.save_context({"human_input": human}, {"text": ai})
+
+    stats = utils.prompt_budget.stats
+    print(f"{turns} turns, {model} budget {budget} tokens")
+    print(f"langchain memory   mean {np.mean(old_sizes):7.0f}  max {max(old_sizes):6d} tokens, "
+          f"{sum(size > budget for size in old_sizes)} prompts over budget")
+    print(f"assembled          mean {np.mean(new_sizes):7.0f}  max {max(new_sizes):6d} tokens "
+          f"({stats['duplicates_dropped']} duplicate turns dropped, {stats['retrieved_dropped']} retrieved "
+          f"and {stats['recent_dropped']} recent turns trimmed)")
+    if max(new_sizes) > budget:
+        sys.exit("an assembled prompt exceeds the budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Check that the app starts accepting webhooks quickly.
+
+Starts a fresh interpreter in an empty directory and measures, from process
+start, how long `import main` takes, when the first Telegram webhook is
+acknowledged after the startup event and when the message pipeline (LangChain,
+FAISS, OpenAI, the Telegram client) is loaded in the background. OpenAI and
+Telegram point at a closed local port, so nothing leaves the machine. Then
+prints the modules that `import main` spends its time in, from
+`python -X importtime`. Exits non-zero if the webhook was acknowledged later
+than BUDGET seconds after process start.
+
+    python bench/startup_time.py [BUDGET]
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+
+APP = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app"))
+
+CHILD = r"""
+import sys, time, json, asyncio
+sys.path.insert(0, APP)
+marks = {"interpreter": time.time()}
+import main
+marks["import main"] = time.time()
+
+
+async def post(app, path: str, body: bytes) -> int:
+    # A bare ASGI request, a test client would add its own imports to the measurement
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+             "headers": [(b"host", b"bench"), (b"content-type", b"application/json")],
+             "client": ("127.0.0.1", 1), "server": ("bench", 80)}
+    received = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        received.append(message)
+
+    await app(scope, receive, send)
+    return received[0]["status"]
+
+
+async def run():
+    await main.start_background_tasks()
+    update = {"update_id": 1, "message": {"chat": {"id": 1}, "text": "hello"}}
+    status = await post(main.app, "/webhook/", json.dumps(update).encode())
+    marks["webhook acknowledged"] = time.time()
+    await asyncio.wait_for(main.pipeline_ready.wait(), 60)
+    marks["pipeline ready"] = time.time()
+    for task in main.background_tasks:
+        task.cancel()
+    main.job_queue.close()
+    main.conversation_store.close()
+    return status
+
+
+status = asyncio.run(run())
+print(json.dumps({"status": status, "marks": marks, "import_times": main.import_times}))
+"""
+
+
+def environment() -> dict:
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_BOT_TOKEN": "bench",
+        "OPENAI_API_KEY": "bench",
+        # Closed port, nothing is sent anywhere
+        "OPENAI_API_BASE": "http://127.0.0.1:9/v1",
+        "TELEGRAM_API_BASE": "http://127.0.0.1:9",
+    })
+    env.pop("ZAPIER_NLA_API_KEY", None)
+    env.pop("PINECONE_API_KEY", None)
+    return env
+
+
+def startup(cwd: str) -> dict:
+    started = time.time()
+    child = subprocess.run([sys.executable, "-c", f"APP = {APP!r}\n" + CHILD], cwd=cwd, env=environment(),
+                           capture_output=True, text=True, timeout=120)
+    if child.returncode != 0:
+        sys.exit(child.stderr)
+    result = json.loads(child.stdout.strip().splitlines()[-1])
+    result["marks"] = {mark: at - started for mark, at in result["marks"].items()}
+    return result
+
+
+def import_table(cwd: str, top: int = 12):
+    """ Modules imported directly by `import main` and the app modules, by cumulative import time """
+    child = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {APP!r}); import main"],
+                           cwd=cwd, env=environment(), capture_output=True, text=True, timeout=120)
+    rows = []
+    for line in child.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented by two more spaces
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        module = name.strip()
+        if depth <= 1 or os.path.exists(os.path.join(APP, module + ".py")):
+            rows.append((int(cumulative) / 1000, int(own) / 1000, module))
+    print(f"\n{'module':<24}{'cumulative ms':>14}{'self ms':>10}")
+    for cumulative, own, module in sorted(rows, reverse=True)[:top]:
+        print(f"{module:<24}{cumulative:>14.1f}{own:>10.1f}")
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    with tempfile.TemporaryDirectory() as cwd:
+        # The first start compiles the app modules, measure the second
+        startup(cwd)
+        result = startup(cwd)
+        for mark, seconds in result["marks"].items():
+            print(f"{mark:<24}{seconds:8.2f}s after process start")
+        for module, seconds in result["import_times"].items():
+            print(f"  background import of {module:<17}{seconds:6.2f}s")
+        import_table(cwd)
+
+    accepted = result["marks"]["webhook acknowledged"]
+    assert result["status"] == 200, f"webhook returned {result['status']}"
+    if accepted > budget:
+        sys.exit(f"webhooks are accepted {accepted:.2f}s after process start, over the budget of {budget}s")
+    print(f"\nwebhooks accepted after {accepted:.2f}s, budget {budget}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Stream a long chat reply to a fake Telegram Bot API and a fake Twilio API.
+
+The LLM is replaced by a fake that emits one word every TOKEN_DELAY seconds
+through LangChain's streaming callbacks. Reports time to first token and to
+the first visible message against the full generation time, and fails if the
+final message differs from the reply or the turn was not saved exactly once.
+
+    python bench/streaming_reply.py
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+from typing import List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import httpx
+from langchain.llms.base import LLM
+from langchain.callbacks.base import AsyncCallbackManager
+
+import config
+import utils
+import models
+import embeddings
+import streaming
+from streaming import TokenStreamHandler
+import conversation_store
+import telegram_sender
+import twilio_sender
+from chat_handler import process_chat_message
+
+TOKEN_DELAY = 0.02
+REPLY = " ".join(f"Sentence {i} of the streamed reply has a few more words in it." for i in range(20))
+
+
+class StreamingFakeLLM(LLM):
+    """Emits REPLY word by word through the streaming callbacks."""
+
+    @property
+    def _llm_type(self) -> str:
+        return "streaming-fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        return "chat" if "Return a single word" in prompt else REPLY
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        if "Return a single word" in prompt:
+            return "chat"
+        words = REPLY.split(" ")
+        for i, word in enumerate(words):
+            await asyncio.sleep(TOKEN_DELAY)
+            await self.callback_manager.on_llm_new_token(word if i == 0 else " " + word, verbose=self.verbose)
+        return REPLY
+
+
+def fake_embeddings(texts: List[str]) -> List[List[float]]:
+    return [[float(len(text) % 7)] * 1536 for text in texts]
+
+
+calls = []
+
+
+def fake_api(request: httpx.Request) -> httpx.Response:
+    body = json.loads(request.content) if request.headers.get("content-type") == "application/json" else {}
+    calls.append((time.perf_counter(), request.url.path.rsplit("/", 1)[-1], body or request.content.decode()))
+    return httpx.Response(200, json={"ok": True, "result": {"message_id": 1}})
+
+
+async def run(stream: streaming.ReplyStream) -> float:
+    start = time.perf_counter()
+    with streaming.stream_reply(stream):
+        output = await process_chat_message("tell me a long story", "bench")
+    assert await stream.finish(output), "nothing was streamed"
+    await telegram_sender.dispatcher.close()
+    await twilio_sender.dispatcher.close()
+    return start
+
+
+def main():
+    config.HISTORY_DIR = tempfile.mkdtemp()
+    conversation_store.store.path = os.path.join(config.HISTORY_DIR, "conversations.db")
+    config.VECTOR_MEMORY_DIR = os.path.join(config.HISTORY_DIR, "vectors")
+    embeddings.service.path = os.path.join(config.HISTORY_DIR, "embeddings.db")
+    embeddings.service._request = fake_embeddings
+    utils.topic_router.log_path = None
+    config.ACCOUNT_SID, config.AUTH_TOKEN = "AC0", "token"
+    models.initialize_language_model = lambda selected_model, streaming=False, **kwargs: StreamingFakeLLM(
+        callback_manager=AsyncCallbackManager([TokenStreamHandler()])) if streaming else StreamingFakeLLM()
+    mock = httpx.AsyncClient(transport=httpx.MockTransport(fake_api))
+    telegram_sender.client = twilio_sender.client = mock
+    generation = len(REPLY.split(" ")) * TOKEN_DELAY
+
+    start = asyncio.run(run(telegram_sender.TelegramReplyStream(1, interval=0.2)))
+    edits = [c for c in calls if c[1] == "editMessageText"]
+    print(f"telegram: first token {streaming.first_token_percentile(50) * 1000:.0f} ms, "
+          f"first message {(calls[0][0] - start) * 1000:.0f} ms, {len(edits)} edits, "
+          f"generation {generation * 1000:.0f} ms")
+    if calls[0][1] != "sendMessage" or calls[0][0] - start > generation / 2 or edits[-1][2]["text"] != REPLY:
+        sys.exit("telegram reply was not streamed correctly")
+
+    calls.clear()
+    start = asyncio.run(run(twilio_sender.SentenceReplyStream("whatsapp:+1", "whatsapp:+2")))
+    parts = [c[2] for c in calls]
+    print(f"twilio: {len(parts)} messages, first after {(calls[0][0] - start) * 1000:.0f} ms")
+    bodies = [httpx.QueryParams(p)["Body"] for p in parts]
+    if len(bodies) < 2 or " ".join(bodies) != REPLY:
+        sys.exit("twilio reply was not split into sentences correctly")
+
+    turns = conversation_store.store.load("bench")
+    if [turn.ai for turn in turns] != [REPLY, REPLY]:
+        sys.exit(f"expected one saved turn per reply, got {len(turns)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Send a burst of replies through the Telegram sender to a local fake Bot API.
+
+The fake API enforces global and per-chat flood limits over a sliding one
+second window and answers violations with 429 and a retry_after, like
+Telegram. One reply is longer than 4096 characters and must arrive split.
+The run fails if a message is lost, reordered within a chat or too long.
+
+    python bench/telegram_send.py [MESSAGES] [CHATS]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import config
+import telegram_sender
+from outbound import TokenBucket
+
+LATENCY = 0.02
+# Limits of the fake API, and the (lower) limits the sender is configured with
+API_RATE, API_CHAT_RATE = 120, 15
+RATE, CHAT_RATE, CHAT_BURST = 100, 10, 3
+
+lock = threading.Lock()
+received = defaultdict(list)
+window = deque()
+chat_windows = defaultdict(deque)
+throttled = 0
+
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        global throttled
+        params = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(LATENCY)
+        now = time.monotonic()
+        chat_id = params["chat_id"]
+        with lock:
+            for times in (window, chat_windows[chat_id]):
+                while times and times[0] < now - 1:
+                    times.popleft()
+            if len(window) >= API_RATE or len(chat_windows[chat_id]) >= API_CHAT_RATE:
+                throttled += 1
+                status, body = 429, {"ok": False, "error_code": 429, "parameters": {"retry_after": 1}}
+            elif len(params["text"]) > telegram_sender.MAX_MESSAGE_LENGTH:
+                status, body = 400, {"ok": False, "description": "message is too long"}
+            else:
+                window.append(now)
+                chat_windows[chat_id].append(now)
+                received[chat_id].append(params["text"])
+                status, body = 200, {"ok": True, "result": {"message_id": len(window)}}
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+async def run(messages: int, chats: int, long_text: str):
+    dispatcher = telegram_sender.dispatcher
+    dispatcher.bucket = TokenBucket(RATE, burst=10)
+    dispatcher.key_rate, dispatcher.key_burst = CHAT_RATE, CHAT_BURST
+    start = time.monotonic()
+    futures = [telegram_sender.send_message(i % chats, f"{i}") for i in range(messages)]
+    futures.append(telegram_sender.send_message(0, long_text))
+    responses = await asyncio.gather(*futures)
+    elapsed = time.monotonic() - start
+    await dispatcher.close()
+    return responses, elapsed
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    chats = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config.TELEGRAM_API_BASE = f"http://127.0.0.1:{server.server_address[1]}"
+    long_text = "\n".join(f"line {i} " + "x" * 60 for i in range(150))
+
+    responses, elapsed = asyncio.run(run(messages, chats, long_text))
+    server.shutdown()
+
+    stats = telegram_sender.dispatcher.stats
+    print(f"{messages} messages to {chats} chats in {elapsed:.2f}s ({messages / elapsed:.0f} msg/s), "
+          f"{throttled} throttled by the API, {stats['retries']} retries, {stats['failed']} failed")
+
+    if any(r is None or not r.is_success for r in responses):
+        sys.exit("some messages were not sent")
+    for chat_id, texts in received.items():
+        numbers = [int(t) for t in texts if t.isdigit()]
+        if numbers != sorted(numbers) or len(numbers) != len(range(chat_id, messages, chats)):
+            sys.exit(f"messages to chat {chat_id} lost or out of order")
+    parts = [t for t in received[0] if not t.isdigit()]
+    if len(parts) < 2 or "\n".join(parts) != long_text:
+        sys.exit("long message was not split correctly")
+
+
+if __name__ == "__main__":
+    main()
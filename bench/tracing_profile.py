@@ -0,0 +1,180 @@
+"""
+Check per-message tracing and the on-demand profiling endpoint.
+
+Sends Telegram updates through the webhook with fake models; messages that
+contain "slow" take SLOW seconds per LLM call. Checks that only the slow
+messages end up in the slow trace log, under the trace ID of their job, with
+the spans of the chat pipeline. Then profiles a CPU-bound worker thread and
+event loop task through /admin/profile and checks they are the hot spots.
+
+    python bench/tracing_profile.py
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+from typing import List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import httpx
+from langchain.llms.base import LLM
+
+import config
+import utils
+import models
+import tracing
+import conversation_store
+import embeddings
+import telegram_handler
+import telegram_sender
+from executor import run_sync
+from job_queue import queue as job_queue
+from main import app
+
+FAST = 0.01
+SLOW = 0.3
+
+
+class FakeLLM(LLM):
+    @property
+    def _llm_type(self) -> str:
+        return "trace-fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        raise NotImplementedError
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        await asyncio.sleep(SLOW if "slow" in prompt else FAST)
+        return "chat" if "Return a single word" in prompt else "fake reply"
+
+
+def fake_embeddings(texts: List[str]) -> List[List[float]]:
+    return [[float(len(text) % 7)] * 1536 for text in texts]
+
+
+replies = []
+
+
+def fake_telegram(request: httpx.Request) -> httpx.Response:
+    replies.append(request)
+    return httpx.Response(200, json={"ok": True})
+
+
+def span_overhead(calls: int = 100000):
+    start = time.perf_counter()
+    for _ in range(calls):
+        with tracing.span("bench"):
+            pass
+    outside = (time.perf_counter() - start) / calls
+    token = tracing.current_span.set(tracing.Span("bench", {}))
+    start = time.perf_counter()
+    for _ in range(calls):
+        with tracing.span("bench"):
+            pass
+    inside = (time.perf_counter() - start) / calls
+    tracing.current_span.reset(token)
+    print(f"tracing.span: {outside * 1e6:.2f} us outside a trace, {inside * 1e6:.2f} us inside")
+
+
+def show(span: dict, depth: int = 0):
+    attributes = " ".join(f"{k}={v}" for k, v in span.get("attributes", {}).items())
+    print(f"{'  ' * depth}{span['name']:<{28 - 2 * depth}} +{span['start_ms']:7.1f} ms {span['duration_ms']:7.1f} ms  {attributes}")
+    for child in span.get("children", []):
+        show(child, depth + 1)
+
+
+def names(span: dict) -> set:
+    return {span["name"]}.union(*(names(child) for child in span.get("children", [])))
+
+
+async def traces(http: httpx.AsyncClient):
+    texts = ["hello", "a slow question", "hi there", "another slow one", "thanks"]
+    for i, text in enumerate(texts):
+        await http.post("/webhook/", json={"update_id": i, "message": {"chat": {"id": i}, "text": text}})
+    while len(replies) < len(texts):
+        await asyncio.sleep(0.01)
+
+    with open(config.TRACE_LOG) as f:
+        logged = [json.loads(line) for line in f]
+    print(f"{len(texts)} messages, {tracing.stats['traces']} traces, {len(logged)} over {config.TRACE_SLOW_SECONDS}s:")
+    show(logged[0])
+    assert len(logged) == 2 and all(trace["duration_ms"] >= SLOW * 1000 for trace in logged)
+    trace_ids = [row[0] for row in job_queue._connect().execute("SELECT trace_id FROM jobs ORDER BY id")]
+    assert {trace["trace_id"] for trace in logged} == {trace_ids[1], trace_ids[3]}, "trace IDs do not match the jobs"
+    expected = {"job:telegram", "process_chat_message", "reply", "topic_routing", "llm", "process_chat", "memory_load"}
+    assert expected <= names(logged[0]), expected - names(logged[0])
+
+
+def busy_loop(seconds: float) -> int:
+    n = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        n += sum(i * i for i in range(1000))
+    return n
+
+
+async def spin_on_loop(seconds: float):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        sum(i * i for i in range(20000))
+        await asyncio.sleep(0)
+
+
+async def profiles(http: httpx.AsyncClient):
+    config.ADMIN_TOKEN = "bench-admin"
+    admin = {"Authorization": "Bearer bench-admin"}
+    assert (await http.post("/admin/profile?seconds=1")).status_code == 403
+
+    busy = asyncio.ensure_future(run_sync(busy_loop, 1.5))
+    first, second = await asyncio.gather(
+        http.post("/admin/profile?seconds=1&mode=stack", headers=admin),
+        http.post("/admin/profile?seconds=1&mode=stack", headers=admin))
+    await busy
+    assert sorted([first.status_code, second.status_code]) == [200, 409], "profiles were not serialized"
+    top = (first if first.status_code == 200 else second).text.splitlines()[0]
+    print(f"stack samples, hottest: ...{top[-90:]}")
+    assert "busy_loop" in top
+
+    spin = asyncio.ensure_future(spin_on_loop(0.7))
+    response = await http.post("/admin/profile?seconds=0.5&mode=cprofile", headers=admin)
+    await spin
+    assert response.status_code == 200 and "spin_on_loop" in response.text
+    print(f"cProfile of the event loop: {len(response.text.splitlines())} lines, spin_on_loop found")
+
+
+async def run():
+    worker = asyncio.create_task(job_queue.run(poll_interval=0.05))
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as http:
+        await traces(http)
+        await profiles(http)
+    worker.cancel()
+    job_queue.close()
+    await telegram_sender.dispatcher.close()
+
+
+def main():
+    config.HISTORY_DIR = tempfile.mkdtemp()
+    config.TRACE_LOG = os.path.join(config.HISTORY_DIR, "slow_traces.jsonl")
+    config.TRACE_SLOW_SECONDS = SLOW
+    config.STREAM_REPLIES = False
+    conversation_store.store.path = os.path.join(config.HISTORY_DIR, "conversations.db")
+    config.VECTOR_MEMORY_DIR = os.path.join(config.HISTORY_DIR, "vectors")
+    utils.topic_router.log_path = None
+    models.initialize_language_model = lambda selected_model, **kwargs: FakeLLM()
+    job_queue.path = os.path.join(config.HISTORY_DIR, "jobs.db")
+    embeddings.service.path = os.path.join(config.HISTORY_DIR, "embeddings.db")
+    embeddings.service._request = fake_embeddings
+    telegram_handler.bot = object()
+    telegram_sender.client = httpx.AsyncClient(transport=httpx.MockTransport(fake_telegram))
+
+    span_overhead()
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
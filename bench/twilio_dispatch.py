@@ -0,0 +1,134 @@
+"""
+Send a burst of replies through the Twilio dispatcher to a local mock Twilio API.
+
+The mock server adds latency and answers every FAIL_EVERY-th request with a
+429 or 503, so the dispatcher has to retry. The run fails if a message is
+lost, if messages reach a recipient out of order or if the send rate limit
+is exceeded. Then messages are sent from separate traces, which fails unless
+every trace gets the send span of its own message, also the trace that
+started the dispatcher's workers.
+
+    python bench/twilio_dispatch.py [MESSAGES] [RECIPIENTS]
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import config
+import tracing
+import twilio_sender
+from outbound import TokenBucket
+
+LATENCY = 0.05
+FAIL_EVERY = 7
+RATE = 200
+TRACES = 50
+
+received = []
+# Off for the tracing check, so every message is sent in one attempt
+flaky = True
+lock = threading.Lock()
+counter = 0
+
+
+class MockTwilio(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        global counter
+        form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        time.sleep(LATENCY)
+        with lock:
+            counter += 1
+            failing = flaky and counter % FAIL_EVERY == 0
+            if not failing:
+                received.append((form["To"][0], int(form["Body"][0]), time.monotonic()))
+        status = (429 if counter % 2 else 503) if failing else 201
+        body = b'{"sid": "SM0"}'
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0.1")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+async def run(messages: int, recipients: int):
+    dispatcher = twilio_sender.dispatcher
+    dispatcher.bucket = TokenBucket(RATE, burst=10)
+    dispatcher.backoff = 0.05
+    start = time.monotonic()
+    futures = [twilio_sender.send_message(f"whatsapp:+1{i % recipients:04d}", "whatsapp:+15550000", str(i))
+               for i in range(messages)]
+    max_depth = dispatcher.depth()
+    responses = await asyncio.gather(*futures)
+    elapsed = time.monotonic() - start
+    await dispatcher.close()
+    roots = await traced_sends()
+    return responses, elapsed, max_depth, roots
+
+
+def send_spans(root: tracing.Span) -> int:
+    return sum(child.name == "send" for child in root.children)
+
+
+async def traced_sends() -> list:
+    """ Send one message from each of TRACES traces, the first one starts the dispatcher's workers """
+    global flaky
+    flaky = False
+    roots = []
+    for i in range(TRACES):
+        with tracing.trace("bench") as root:
+            await twilio_sender.send_message("whatsapp:+19999", "whatsapp:+15550000", str(i))
+        roots.append(root)
+    await twilio_sender.dispatcher.close()
+    return roots
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    recipients = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockTwilio)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config.TWILIO_API_BASE = f"http://127.0.0.1:{server.server_address[1]}"
+    config.ACCOUNT_SID, config.AUTH_TOKEN = "AC0", "token"
+
+    responses, elapsed, max_depth, roots = asyncio.run(run(messages, recipients))
+    server.shutdown()
+
+    stats = twilio_sender.dispatcher.stats
+    print(f"{messages} messages to {recipients} recipients in {elapsed:.2f}s ({messages / elapsed:.0f} msg/s), "
+          f"max queue depth {max_depth}, {stats['retries']} retries, {stats['failed']} failed")
+    print(f"send latency p50 {twilio_sender.dispatcher.latency_percentile(50) * 1000:.0f} ms, "
+          f"p99 {twilio_sender.dispatcher.latency_percentile(99) * 1000:.0f} ms")
+
+    spans = [send_spans(root) for root in roots]
+    print(f"send spans of {TRACES} traces: {spans[0]} in the first, {sum(spans[1:])} in the others")
+    if any(count != 1 for count in spans):
+        sys.exit(f"send spans landed in the wrong traces: {spans}")
+
+    received[messages:] = []
+    if len(received) != messages or any(r is None or not r.is_success for r in responses):
+        sys.exit(f"lost messages: {messages - len(received)}")
+    for recipient in {to for to, _, _ in received}:
+        bodies = [body for to, body, _ in received if to == recipient]
+        if bodies != sorted(bodies):
+            sys.exit(f"messages to {recipient} arrived out of order: {bodies}")
+    # Allow the initial burst on top of the rate
+    window = received[-1][2] - received[0][2]
+    if len(received) > RATE * window + 10 + FAIL_EVERY:
+        sys.exit(f"rate limit exceeded: {len(received)} messages in {window:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
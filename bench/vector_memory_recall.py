@@ -0,0 +1,79 @@
+"""
+Compare the compact vector memory indexes against the old flat float32 index.
+
+Reports recall@k (against exact search), mean query latency, on-disk size
+and the RAM the saved index takes when vector_memory opens it (memory-mapped
+indexes only take page cache) for clustered synthetic vectors shaped like
+OpenAI embeddings.
+
+    python bench/vector_memory_recall.py [N_VECTORS] [N_QUERIES]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import faiss
+import config
+import vector_memory
+
+D = 1536
+K = 4
+
+
+def synthetic(n: int, n_queries: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, n // 50), D)).astype("float32")
+    labels = rng.integers(0, len(centers), size=n + n_queries)
+    data = centers[labels] + 0.3 * rng.normal(size=(n + n_queries, D)).astype("float32")
+    return data[:n], data[n:]
+
+
+def rss() -> float:
+    """ Resident memory of this process in MiB, without file-backed (memory-mapped) pages """
+    with open("/proc/self/status") as f:
+        fields = dict(line.split(":", 1) for line in f)
+    return (int(fields["RssAnon"].split()[0])) / 2 ** 10
+
+
+def measure(name: str, index, queries: np.ndarray, truth: np.ndarray):
+    start = time.perf_counter()
+    _, ids = index.search(queries, K)
+    latency = (time.perf_counter() - start) / len(queries)
+    recall = np.mean([len(set(ids[i]) & set(truth[i])) / K for i in range(len(queries))])
+    fp = os.path.join(tempfile.mkdtemp(), "index.faiss")
+    faiss.write_index(index, fp)
+    size = os.path.getsize(fp) / 2 ** 20
+    before = rss()
+    opened = vector_memory.read_mapped(fp)
+    opened.search(queries, K)
+    ram = rss() - before
+    del opened
+    print(f"{name:10s} recall@{K}={recall:.3f}  latency={latency * 1000:.3f}ms  size={size:.1f}MiB  "
+          f"RAM when opened={ram:.1f}MiB")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    data, queries = synthetic(n, n_queries)
+
+    flat = faiss.IndexFlatL2(D)
+    flat.add(data)
+    _, truth = flat.search(queries, K)
+    measure("flat", flat, queries, truth)
+
+    threshold = config.VECTOR_MEMORY_ANN_THRESHOLD
+    config.VECTOR_MEMORY_ANN_THRESHOLD = n + 1
+    measure("fp16", vector_memory.build_index(data), queries, truth)
+    config.VECTOR_MEMORY_ANN_THRESHOLD = min(threshold, n)
+    for ann in ("hnsw", "ivfpq"):
+        config.VECTOR_MEMORY_ANN = ann
+        measure(ann, vector_memory.build_index(data), queries, truth)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Run many voice messages through the voice pipeline at once against a local file server.
+
+Each voice note is a tone with its own duration. Whisper is replaced by a
+fake that reports the duration of the audio it receives, so any mix-up
+between concurrent requests shows up as a wrong answer. Exits non-zero on a
+mismatch.
+
+    python bench/voice_concurrency.py [N]
+"""
+import io
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import threading
+import functools
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import numpy as np
+import openai
+import soundfile as sf
+
+import voice_handler
+from executor import start_process_pool, shutdown as shutdown_workers
+
+
+def duration_of(i: int) -> float:
+    return 1.0 + 0.5 * i
+
+
+def write_voice_notes(directory: str, n: int):
+    for i in range(n):
+        sr = 48000
+        t = np.arange(int(duration_of(i) * sr)) / sr
+        stereo = np.stack([np.sin(2 * np.pi * 440 * t), np.sin(2 * np.pi * 660 * t)], axis=1) * 0.5
+        sf.write(os.path.join(directory, f"{i}.ogg"), stereo, sr, format="OGG", subtype="OPUS")
+
+
+def serve(directory: str) -> ThreadingHTTPServer:
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def fake_transcribe(model, audio_file, **params):
+    info = sf.info(io.BytesIO(audio_file.getvalue()))
+    assert info.channels == 1 and info.samplerate == 16000, info
+    return {"text": f"{info.duration:.1f}"}
+
+
+async def echo(text, chat_id):
+    return text
+
+
+async def run(base_url: str, n: int):
+    start = time.perf_counter()
+    outputs = await asyncio.gather(*(voice_handler.process_voice_message(f"{base_url}/{i}.ogg", i) for i in range(n)))
+    return outputs, time.perf_counter() - start
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    directory = tempfile.mkdtemp()
+    write_voice_notes(directory, n)
+    server = serve(directory)
+    openai.Audio.atranscribe = fake_transcribe
+    voice_handler.process_chat_message = echo
+    # The app starts the decoding processes at startup, see main.warm_up
+    start_process_pool()
+
+    outputs, elapsed = asyncio.run(run(f"http://127.0.0.1:{server.server_address[1]}", n))
+    server.shutdown()
+    shutdown_workers()
+
+    wrong = [i for i, output in enumerate(outputs) if abs(float(output) - duration_of(i)) > 0.1]
+    print(f"{n} concurrent voice messages in {elapsed:.2f}s ({n / elapsed:.1f} msg/s)")
+    if wrong:
+        sys.exit(f"voice messages got mixed up: {wrong}")
+
+
+if __name__ == "__main__":
+    main()